@@ -0,0 +1,89 @@
+import os
+
+import streamlit as st
+
+from tools import explorer
+
+
+# ✅ Query results are cached per database file and modification time, so widget
+# changes only re-query what changed and finished results are never recomputed
+@st.cache_data(max_entries=64, show_spinner=False)
+def _cached(query_name, db_path, mtime, *args):
+    return getattr(explorer, query_name)(db_path, *args)
+
+
+def _load(query_name, db_path, *args):
+    return _cached(query_name, db_path, os.path.getmtime(db_path), *args)
+
+
+def show_mcr_explorer(step3_dir):
+    """Interactive MCR explorer on the compare database of a finished run."""
+    db_path = explorer.explorer_db(step3_dir)
+    if db_path is None:
+        st.info("ℹ The explorer needs `compare_output: database` (or `both`).")
+        return
+    import plotly.graph_objects as go  # ✅ Loaded only when the explorer is shown
+
+    conditions = _load("list_conditions", db_path)
+    names = list(conditions["Condition"])
+    st.caption(f"{len(names)} conditions, {int(conditions['Rows'].sum()):,} missed-cleavage peptide rows")
+
+    selected = st.multiselect("Conditions", names, default=names[:10], key="explorer_conditions")
+    quantified_only = st.checkbox("Only peptides quantified with and without the missed cleavage "
+                                  "(the boxplot's `rdf2` filter)", key="explorer_quantified")
+    if not selected:
+        st.warning("⚠ Select at least one condition.")
+        return
+    selected_key = tuple(selected)
+
+    dist_tab, box_tab, peptide_tab, scatter_tab = st.tabs(["MCR distribution", "Per-condition quantiles",
+                                                           "Peptide lookup", "MC vs NMC quantity"])
+
+    with dist_tab:
+        bins = st.slider("Bins", 10, 200, 50, step=10, key="explorer_bins")
+        hist = _load("mcr_histogram", db_path, selected_key, bins, quantified_only)
+        fig = go.Figure()
+        for condition in selected:
+            part = hist[hist["Condition"] == condition]
+            fig.add_trace(go.Bar(x=part["Bin"] + 50 / bins, y=part["Count"], name=str(condition), opacity=0.6))
+        fig.update_layout(barmode="overlay", xaxis_title="Missed Cleavage Ratio (%)", yaxis_title="Peptides",
+                          bargap=0)
+        st.plotly_chart(fig, use_container_width=True)
+
+    with box_tab:
+        stats = _load("condition_quantiles", db_path, selected_key, quantified_only)
+        fig = go.Figure(go.Box(
+            x=stats["Condition"].astype(str), q1=stats["Q1"], median=stats["Median"], q3=stats["Q3"],
+            lowerfence=stats["Lower"], upperfence=stats["Upper"], mean=stats["Mean"], name="MCR",
+        ))
+        fig.update_layout(xaxis_title="Condition", yaxis_title="Missed Cleavage Ratio (%)", showlegend=False)
+        st.plotly_chart(fig, use_container_width=True)
+        st.dataframe(stats, hide_index=True)
+
+    with peptide_tab:
+        prefix = st.text_input("Peptide sequence (prefix)", key="explorer_peptide").strip()
+        if prefix:
+            matches = _load("search_peptides", db_path, prefix)
+            if matches.empty:
+                st.warning("⚠ No missed-cleavage peptide starts with this sequence.")
+            else:
+                peptide = st.selectbox("Peptide", matches["MC_PEP"], key="explorer_peptide_match")
+                profile = _load("peptide_profile", db_path, peptide)
+                fig = go.Figure(go.Scattergl(x=profile["Condition"].astype(str), y=profile["MCR"],
+                                             mode="markers", marker={"size": 10}))
+                fig.update_layout(xaxis_title="Condition", yaxis_title="Missed Cleavage Ratio (%)",
+                                  yaxis_range=[0, 105])
+                st.plotly_chart(fig, use_container_width=True)
+                st.dataframe(profile, hide_index=True)
+
+    with scatter_tab:
+        condition = st.selectbox("Condition", selected, key="explorer_scatter_condition")
+        points, total = _load("quant_scatter", db_path, condition)
+        fig = go.Figure(go.Scattergl(
+            x=points["Log2NMC_PEP_Quant"], y=points["Log2MC_PEP_Quant"], mode="markers", text=points["MC_PEP"],
+            marker={"size": 4, "color": points["MCR"], "colorscale": "Viridis", "colorbar": {"title": "MCR (%)"}},
+        ))
+        fig.update_layout(xaxis_title="log2 NMC peptide quantity", yaxis_title="log2 MC peptide quantity")
+        st.plotly_chart(fig, use_container_width=True)
+        if len(points) < total:
+            st.caption(f"Showing {len(points):,} of {total:,} peptides (evenly thinned).")
@@ -4,10 +4,13 @@ import os
 import io
 import tempfile
 import shutil
-from tools.split_dia import split_dia
-from tools.prepare import get_peptides
-from tools.qc import qc_all
-from tools.compare import compare_all, merge_qc
+import time
+from tools.jobs import JobManager
+from tools.progress import summarize
+from tools.metrics import read_metrics, metrics_table
+from tools.archive import ARCHIVE_PARTS, DEFAULT_PARTS
+from tools.download_server import DownloadServer
+from tools.upload_store import UploadStore
 
 # Function to read the YAML parameter file
 def read_param(param_path):
@@ -15,17 +18,22 @@ def read_param(param_path):
         param = yaml.load(file, Loader=yaml.FullLoader)
     return param
 
-# Function wrappers for tasks
+# Function wrappers for tasks (stage modules are imported on first use only, so
+# loading this page never pulls in pandas, pyteomics or the plotting stack)
 def prepare_param(param):
+    from tools.prepare import get_peptides
     return get_peptides(param)
 
 def split_task(param):
+    from tools.split_dia import split_dia
     return split_dia(param)
 
 def qc_task(param):
+    from tools.qc import qc_all
     return qc_all(param)
 
 def compare_task(param):
+    from tools.compare import compare_all, merge_qc
     compare_all(param)
     merge_qc(param)
 
@@ -56,55 +64,154 @@ def provide_yaml_download():
         mime="text/yaml",
     )
 
+# ✅ One upload store per Streamlit server, shared by all sessions
+@st.cache_resource
+def get_upload_store():
+    root = os.environ.get("MC_PARSER_STORE_DIR", os.path.join(tempfile.gettempdir(), "mc_parser_store"))
+    max_gb = float(os.environ.get("MC_PARSER_STORE_MAX_GB", 20))
+    return UploadStore(root, max_bytes=int(max_gb * (1 << 30)))
+
 # ✅ Function to save uploaded files to disk
 def save_uploaded_file(uploaded_file):
-    """Stream uploaded file directly to disk to prevent memory issues."""
-    if "temp_dir" not in st.session_state:  # ✅ Extra safety check in case of page reset
-        st.session_state["temp_dir"] = tempfile.mkdtemp()
+    """Stores the upload in the shared store; identical files are kept only once."""
+    saved = st.session_state.setdefault("saved_uploads", {})
+    # ✅ Not re-hashed on every rerun (unless the stored copy was evicted since)
+    if uploaded_file.file_id not in saved or not os.path.exists(saved[uploaded_file.file_id]):
+        saved[uploaded_file.file_id] = get_upload_store().put(uploaded_file, uploaded_file.name)
+    return saved[uploaded_file.file_id]
+
+# ✅ One job manager per Streamlit server, shared by all sessions
+@st.cache_resource
+def get_job_manager():
+    return JobManager(max_jobs=int(os.environ.get("MC_PARSER_MAX_JOBS", 2)))
+
+# ✅ Function to start the full pipeline in a background worker
+def submit_pipeline(param):
+    """Queues the pipeline for `output_folder` and returns the job ID."""
+    output_dir = os.path.join(st.session_state.temp_dir, "output_folder")
+    os.makedirs(output_dir, exist_ok=True)
+    param["output_dir"] = output_dir
+    param["upload_store"] = get_upload_store().root  # ✅ Reuse the peptide database of any session
+    zip_output_path = os.path.join(st.session_state.temp_dir, "pipeline_results.zip")
+    return get_job_manager().submit(param, zip_output_path)
+
+# ✅ One download server per Streamlit server; archives are streamed from disk
+@st.cache_resource
+def get_download_server():
+    """
+    The download server, listening on `MC_PARSER_DOWNLOAD_HOST` (loopback by default),
+    or None if its port is taken. `MC_PARSER_DOWNLOAD_URL` is its address behind a
+    reverse proxy; without it, links use the host name the page was opened under.
+    """
+    try:
+        return DownloadServer(os.environ.get("MC_PARSER_DOWNLOAD_URL"),
+                              port=int(os.environ.get("MC_PARSER_DOWNLOAD_PORT", 8502)),
+                              host=os.environ.get("MC_PARSER_DOWNLOAD_HOST", "127.0.0.1"))
+    except OSError as e:
+        print(f"⚠ Download server not started ({e})")
+        return None
+
+# ✅ Archives up to this size may still go through st.download_button, which reads
+# the whole file into the Streamlit server's memory
+MAX_BUTTON_MB = float(os.environ.get("MC_PARSER_MAX_BUTTON_MB", 200))
+
+def download_url(zip_output_path):
+    """Streamed download URL of the archive for this browser, or None if it cannot reach the server."""
+    if "download_url" not in st.session_state:
+        server = get_download_server()
+        base_url = server and server.base_url(st.context.headers.get("Host"))
+        if not base_url:
+            return None
+        st.session_state["download_url"] = server.register(zip_output_path, "MC_parser_output.zip", base_url)
+    return st.session_state["download_url"]
+
+def clear_results():
+    """Forgets the finished job and deletes its temp folder (uploads stay in the shared store)."""
+    if "download_url" in st.session_state:
+        server = get_download_server()
+        url = st.session_state.pop("download_url")
+        if server is not None:
+            server.unregister(url)
+    st.session_state.pop("job_id", None)
+    if "temp_dir" in st.session_state and os.path.exists(st.session_state["temp_dir"]):
+        shutil.rmtree(st.session_state["temp_dir"], ignore_errors=True)
+    st.session_state["temp_dir"] = tempfile.mkdtemp()
 
-    temp_dir = st.session_state["temp_dir"]
-    file_path = os.path.join(temp_dir, uploaded_file.name)
+def format_seconds(seconds):
+    return time.strftime("%H:%M:%S", time.gmtime(seconds)) if seconds is not None else "--:--:--"
 
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(uploaded_file, f)  # Stream file to disk
+# ✅ Poll the background job without blocking the page
+@st.fragment(run_every=2)
+def show_job_progress():
+    status = get_job_manager().status(st.session_state["job_id"])
+    if status["state"] in ("done", "failed", "unknown"):
+        st.rerun()  # ✅ Leave polling; the full page shows the outcome
 
-    return file_path
+    progress = status["progress"]
+    if status["state"] == "queued" or progress is None:
+        st.info("⏳ Job is queued, waiting for a free worker...")
+        return
 
-# ✅ Function to run the full pipeline
-def run_full_pipeline(param):
-    """Runs the entire pipeline and stores results in `output_folder`."""
-    output_dir = os.path.join(st.session_state.temp_dir, "output_folder")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Update output directory in param
-    param["output_dir"] = output_dir  
-
-    # 🔹 Step 1: Prepare
-    st.write("🛠 Running Prepare step...")
-    get_peptides(param)
-    st.success("✔ Prepare step completed!")
-
-    # 🔹 Step 2: Split
-    st.write("🔬 Running Split step...")
-    split_dia(param)
-    st.success("✔ Split step completed!")
-
-    # 🔹 Step 3: QC
-    st.write("📊 Running QC step...")
-    qc_all(param)
-    st.success("✔ QC step completed!")
-
-    # 🔹 Step 4: Compare
-    st.write("📈 Running Compare step...")
-    compare_all(param)
-    merge_qc(param)
-    st.success("✅ Full pipeline completed!")
+    fraction, eta = summarize(progress)
+    elapsed = time.time() - progress["started"]
+    st.progress(fraction, text=f"{fraction:.0%} complete · elapsed {format_seconds(elapsed)} · ETA {format_seconds(eta)}")
+    samples = progress["samples"]
+    rows = []
+    for stage, entry in progress["stages"].items():
+        detail = ""
+        if stage == "qc" and samples["total"]:
+            detail = f'{samples["done"]}/{samples["total"]} samples' + (f' ({samples["failed"]} failed)' if samples["failed"] else "")
+        rows.append({"Stage": stage, "Status": entry["status"], "Samples": detail})
+    st.table(rows)
+
+def show_metrics(output_dir):
+    """Timing table of the finished run from its `metrics.json`."""
+    metrics = read_metrics(output_dir)
+    if metrics is None:
+        return
+    st.write("### ⏱ Stage Timings")
+    st.table(metrics_table(metrics))
+    if metrics["samples"]:
+        with st.expander("Per-sample QC timings"):
+            st.dataframe([{"Sample": name, **stats} for name, stats in metrics["samples"].items()])
+
+def show_job_result():
+    """Shows the outcome of a finished job and the results download."""
+    status = get_job_manager().status(st.session_state["job_id"])
+    if status["state"] == "failed":
+        st.error(f"❌ Pipeline failed: {status['error']}")
+    elif status["state"] == "unknown":
+        st.warning("⚠ The job was lost (was the server restarted?). Please run it again.")
+    else:
+        st.success("✅ Full pipeline completed!")
+        zip_output_path = status["result"]
 
-    # ✅ Zip the output folder
-    zip_output_path = os.path.join(st.session_state.temp_dir, "pipeline_results.zip")
-    shutil.make_archive(zip_output_path.replace(".zip", ""), 'zip', output_dir)
-    
-    return zip_output_path
+        # ✅ Provide a download link; the archive is streamed in chunks, never held in memory
+        if os.path.exists(zip_output_path):
+            size_mb = os.path.getsize(zip_output_path) / (1 << 20)
+            label = f"📥 Download Full Pipeline Results ({size_mb:.1f} MB)"
+            url = download_url(zip_output_path)
+            if url:
+                st.link_button(label, url)
+            elif size_mb <= MAX_BUTTON_MB:
+                with open(zip_output_path, "rb") as file:
+                    st.download_button(label=label, data=file, file_name="MC_parser_output.zip", mime="application/zip")
+            else:
+                st.warning(f"⚠ The results archive ({size_mb:,.0f} MB) is too large to send through the page, and "
+                           "the download server cannot be reached from this browser. Set `MC_PARSER_DOWNLOAD_HOST` "
+                           "(or `MC_PARSER_DOWNLOAD_URL` behind a proxy) on the server. "
+                           f"The archive is at `{zip_output_path}` on the server.")
+    if status["state"] != "unknown":
+        show_metrics(status["output_dir"])
+    if status["state"] == "done":
+        from Components.MCR_explorer import show_mcr_explorer  # ✅ pandas/plotly load only here
+        st.write("### 🔎 MCR Explorer")
+        show_mcr_explorer(os.path.join(status["output_dir"], "step3-compare"))
+
+    # ✅ Results stay available until the user clears them
+    if st.button("🧹 Clear Results and Start a New Run"):
+        clear_results()
+        st.rerun()
 
 # ✅ Streamlit UI
 def main():
@@ -148,23 +255,20 @@ def main():
     # ✅ Task Execution Section
     st.write("## Calculate Miscleavage Rate")
 
-    if st.button("Run Misclevage Parser"):
-        zip_output_path = run_full_pipeline(param)
-
-        # ✅ Provide download button for results
-        if os.path.exists(zip_output_path):
-            with open(zip_output_path, "rb") as file:
-                st.download_button(
-                    label="📥 Download Full Pipeline Results",
-                    data=file,
-                    file_name="MC_parser_output.zip",
-                    mime="application/zip"
-                )
-            
-            # ✅ Clean up the temp folder safely and reinitialize it
-            if "temp_dir" in st.session_state and os.path.exists(st.session_state["temp_dir"]):
-                shutil.rmtree(st.session_state["temp_dir"], ignore_errors=True)
-                st.session_state["temp_dir"] = tempfile.mkdtemp()  
+    job_id = st.session_state.get("job_id")
+    if job_id is None:
+        param["archive_parts"] = st.multiselect(
+            "Include in results archive", list(ARCHIVE_PARTS),
+            default=[p for p in param.get("archive_parts", DEFAULT_PARTS) if p in ARCHIVE_PARTS],
+            help="tables: compare tables, merged and per-sample QC; figures: PNG plots; "
+                 "mc2: per-sample `_mc2.tsv`; split: per-sample split input files")
+        if st.button("Run Misclevage Parser"):
+            st.session_state["job_id"] = submit_pipeline(param)
+            st.rerun()
+    elif get_job_manager().status(job_id)["state"] in ("queued", "running"):
+        show_job_progress()
+    else:
+        show_job_result()
 
 
 
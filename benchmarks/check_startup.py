@@ -0,0 +1,97 @@
+"""
+Guards the import cost of the app and of the pipeline worker processes.
+
+    python -m benchmarks.check_startup
+    python -m benchmarks.check_startup --repeat 5 --page-budget 1.0 --worker-budget 1.5
+
+Each check imports a module in a fresh interpreter (or a freshly spawned pool
+worker), times it, and lists the heavy libraries that came with it. A check fails
+when a library it must not load shows up, or when the median time exceeds its
+budget. Exits with status 1 on any failure.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# plotly is not listed: `import streamlit` already loads it whenever it is installed
+HEAVY = ["pandas", "numpy", "pyteomics", "matplotlib", "seaborn", "scipy"]
+
+# module -> heavy libraries it must not import
+IMPORT_CHECKS = {
+    "Components.Run_mc_parser": HEAVY,
+    "tools.jobs": HEAVY,
+    "tools.qc": ["pyteomics", "matplotlib", "seaborn", "scipy"],
+}
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - t, "modules": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module):
+    """Imports `module` in a fresh interpreter; returns (seconds, heavy modules loaded)."""
+    out = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)], cwd=REPO_DIR,
+                         capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    return result["seconds"], result["modules"]
+
+
+def _qc_worker_probe():
+    t = time.perf_counter()
+    import tools.qc  # noqa: F401  (what a QC worker unpickles `run_qc_sample` from)
+    return time.perf_counter() - t, [m for m in HEAVY if m in sys.modules]
+
+
+def time_worker_spawn():
+    """Starts a spawn-context worker and runs a QC import in it; returns (seconds, heavy modules)."""
+    t = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        _, modules = executor.submit(_qc_worker_probe).result()
+    return time.perf_counter() - t, modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check app startup and worker spawn time.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per check; the median is compared.")
+    parser.add_argument("--page-budget", type=float, default=1.5, help="Seconds allowed for the import checks.")
+    parser.add_argument("--worker-budget", type=float, default=3.0, help="Seconds allowed to spawn a QC worker.")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, REPO_DIR)
+    failures = []
+
+    def _check(name, runs, forbidden, budget):
+        seconds = statistics.median(s for s, _ in runs)
+        loaded = sorted({m for _, modules in runs for m in modules} & set(forbidden))
+        ok = not loaded and seconds <= budget
+        print(f"{'✔' if ok else '❌'} {name}: {seconds:.2f} s (budget {budget:.2f} s)"
+              + (f", loads {loaded}" if loaded else ""))
+        if not ok:
+            failures.append(name)
+
+    for module, forbidden in IMPORT_CHECKS.items():
+        _check(f"import {module}", [time_import(module) for _ in range(args.repeat)], forbidden, args.page_budget)
+    _check("spawn QC worker", [time_worker_spawn() for _ in range(args.repeat)], IMPORT_CHECKS["tools.qc"],
+           args.worker_budget)
+
+    if failures:
+        print(f"❌ {len(failures)} startup checks failed")
+        return 1
+    print("✅ All startup checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+Times `get_peptides`, `split_dia`, `qc_all`, `rollup_all` and `compare_all` on synthetic data.
+
+    python -m benchmarks.run_benchmarks --scale small
+    python -m benchmarks.run_benchmarks --scale small medium --save          # new baseline
+    python -m benchmarks.run_benchmarks --scale small --proteins 500 --samples 8
+
+Each run is compared against `benchmarks/baseline.json` (if it has the same
+scale and worker count; `--workers` defaults to the baseline's) and exits with status 1 when a stage is slower than `--threshold` times
+its baseline. Baselines are machine specific: record one on the box you compare on.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import yaml
+
+from benchmarks.synthetic import make_fasta, make_report
+from tools.compare import compare_all, merge_qc
+from tools.metrics import Metrics, count_rows
+from tools.prepare import get_peptides, peptide_db_path
+from tools.qc import qc_all
+from tools.rollup import rollup_all
+from tools.split_dia import split_dia
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+DEFAULT_PARAM = os.path.join(BENCHMARK_DIR, os.pardir, "param", "mc_parser.yml")
+
+SCALES = {
+    "small": {"proteins": 100, "samples": 3, "mc_rate": 0.15},
+    "medium": {"proteins": 500, "samples": 12, "mc_rate": 0.15},
+    "large": {"proteins": 5000, "samples": 200, "mc_rate": 0.15},
+}
+
+STAGES = ["get_peptides", "split_dia", "qc_all", "rollup_all", "compare_all"]
+
+
+def _peptide_count(sqlite_path):
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM peptides;").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_scale(name, knobs, work_dir, workers, seed=0):
+    """
+    Generates the data for one scale and times every stage on it.
+    :return: Dict with the knobs, the data size and the per-stage metrics.
+    """
+    scale_dir = os.path.join(work_dir, name)
+    output_dir = os.path.join(scale_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(DEFAULT_PARAM) as f:
+        param = yaml.load(f, Loader=yaml.FullLoader)
+    param.update(fasta_path=os.path.join(scale_dir, "bench.fasta"), input_file=os.path.join(scale_dir, "report.tsv"),
+                 output_dir=output_dir, workers=workers, make_figures=False, profile_stage=None)
+
+    print(f"🧪 [{name}] Generating {knobs['proteins']} proteins, {knobs['samples']} samples...")
+    entries = make_fasta(param['fasta_path'], knobs['proteins'], seed=seed)
+    peptides = make_report(param['input_file'], entries, knobs['samples'], mc_rate=knobs['mc_rate'], seed=seed)
+
+    metrics = Metrics(output_dir)
+    with metrics.stage("get_peptides") as m:
+        get_peptides(param)
+        m["rows"] = _peptide_count(peptide_db_path(param))
+    with metrics.stage("split_dia") as m:
+        split_dia(param)
+        m["rows"] = count_rows(param['input_file'])
+    with metrics.stage("qc_all") as m:
+        qc_all(param)
+        m["rows"] = peptides * knobs['samples']
+    with metrics.stage("rollup_all") as m:
+        rollup_all(param)
+        m["rows"] = count_rows(param['input_file'])
+    with metrics.stage("compare_all") as m:
+        compare_all(param)
+        merge_qc(param)
+        step2_dir = os.path.join(output_dir, "step2-qc")
+        m["rows"] = sum(count_rows(os.path.join(step2_dir, f)) for f in os.listdir(step2_dir) if f.endswith("_mc2.tsv"))
+
+    for stage, entry in metrics.data["stages"].items():
+        print(f"⏱ [{name}] {stage}: {entry['wall_s']} s wall, {entry['cpu_s']} s CPU, "
+              f"{entry['peak_rss_mb']} MB peak RSS, {entry.get('rows_per_s')} rows/s")
+    return {"knobs": knobs, "report_rows": peptides, "workers": workers, "stages": metrics.data["stages"]}
+
+
+def machine_info():
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()}
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Prints the wall-time ratio of every stage against the baseline.
+    :return: List of (scale, stage, ratio) that are slower than `threshold`.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("scales", {}).get(name)
+        if base is None or base["knobs"] != result["knobs"] or base.get("workers") != result["workers"]:
+            print(f"⚠ [{name}] No baseline with the same knobs and workers; skipping comparison.")
+            continue
+        for stage in STAGES:
+            if stage not in base["stages"]:
+                print(f"⚠ [{name}] {stage}: not in the baseline; skipping comparison.")
+                continue
+            old, new = base["stages"][stage]["wall_s"], result["stages"][stage]["wall_s"]
+            ratio = new / old if old else float("inf")
+            flag = "❌" if ratio > threshold else "✔"
+            print(f"{flag} [{name}] {stage}: {old} s -> {new} s ({ratio:.2f}x)")
+            if ratio > threshold:
+                regressions.append((name, stage, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MC parser stages on synthetic data.")
+    parser.add_argument("--scale", nargs="+", choices=list(SCALES), default=["small"])
+    parser.add_argument("--proteins", type=int, help="Override the protein count of every selected scale.")
+    parser.add_argument("--samples", type=int, help="Override the sample count of every selected scale.")
+    parser.add_argument("--mc-rate", type=float, help="Override the missed-cleavage rate of every selected scale.")
+    parser.add_argument("--workers", type=int, help="QC workers (default: the baseline's, else up to 4).")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio reported as a regression.")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--keep", help="Keep the generated data and outputs in this folder.")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix="mc_bench_")
+    results = {}
+    try:
+        for name in args.scale:
+            knobs = dict(SCALES[name])
+            for key, value in (("proteins", args.proteins), ("samples", args.samples), ("mc_rate", args.mc_rate)):
+                if value is not None:
+                    knobs[key] = value
+            # ✅ Timings only compare at the same worker count
+            workers = args.workers or (baseline or {}).get("scales", {}).get(name, {}).get("workers") \
+                or min(4, os.cpu_count() or 1)
+            results[name] = run_scale(name, knobs, work_dir, workers)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+
+    if args.save:
+        baseline = {"machine": machine_info(), "scales": (baseline or {}).get("scales", {})}
+        baseline["scales"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"❌ {len(regressions)} stages regressed beyond {args.threshold}x")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import random
+
+from pyteomics import parser
+
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def make_fasta(path, proteins, seed=0, min_length=150, max_length=600):
+    """
+    Writes a random UniProt-style FASTA (`>sp|P00000|P00000_HUMAN ...`); every
+    third protein is a mouse entry so the human/mouse QC counts are exercised.
+    :return: List of (protein name, sequence).
+    """
+    rng = random.Random(seed)
+    entries = []
+    with open(path, "w") as f:
+        for i in range(proteins):
+            sequence = "M" + "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(min_length, max_length)))
+            name = f"P{i:05d}_{'MOUSE' if i % 3 == 0 else 'HUMAN'}"
+            f.write(f">sp|P{i:05d}|{name} Synthetic protein {i}\n")
+            for j in range(0, len(sequence), 60):
+                f.write(sequence[j:j + 60] + "\n")
+            entries.append((name, sequence))
+    return entries
+
+
+def make_report(path, entries, samples, mc_rate=0.15, coverage=0.5, missing_rate=0.1, seed=0,
+                min_length=7, max_length=52):
+    """
+    Writes a wide DIA report in the layout `split_dia` expects: `PG.ProteinNames`,
+    `PEP.StrippedSequence` and one `[k] Sk.raw.PEP.Quantity` column per sample.
+    :param entries: Proteins as returned by `make_fasta`.
+    :param samples: Number of sample columns.
+    :param mc_rate: Fraction of reported peptides that have missed cleavages.
+    :param coverage: Fraction of the fully cleaved peptides that are reported.
+    :param missing_rate: Fraction of empty (not quantified) values per sample.
+    :return: Number of peptide rows written.
+    """
+    rng = random.Random(seed)
+    cleaved, missed = {}, {}
+    for name, sequence in entries:
+        full = {p for _, p in parser.xcleave(sequence, r'[KR]', missed_cleavages=0, min_length=min_length)}
+        for _, peptide in parser.xcleave(sequence, r'[KR]', missed_cleavages=2, min_length=min_length):
+            if len(peptide) <= max_length:
+                (cleaved if peptide in full else missed).setdefault(peptide, name)
+
+    peptides = rng.sample(sorted(cleaved.items()), int(len(cleaved) * coverage))
+    n_missed = min(len(missed), int(len(peptides) * mc_rate / (1 - mc_rate)))
+    peptides += rng.sample(sorted(missed.items()), n_missed)
+    rng.shuffle(peptides)
+
+    columns = ["PG.ProteinNames", "PEP.StrippedSequence"] + \
+              [f"[{k}] S{k}.raw.PEP.Quantity" for k in range(1, samples + 1)]
+    with open(path, "w") as f:
+        f.write("\t".join(columns) + "\n")
+        for peptide, name in peptides:
+            values = ["" if rng.random() < missing_rate else f"{rng.lognormvariate(10, 2):.2f}"
+                      for _ in range(samples)]
+            f.write("\t".join([name, peptide] + values) + "\n")
+    return len(peptides)
@@ -0,0 +1,172 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+import yaml
+from filelock import FileLock
+
+from tools.pipeline import STAGES, run_pipeline, completed_stages
+from tools.prepare import digest_enzymes, digest_key, enzyme_db_path, run_enzymes, stored_digest_key
+
+
+# Function to read the YAML parameter file
+def read_param(param_path):
+    with open(param_path) as file:
+        param = yaml.load(file, Loader=yaml.FullLoader)
+    return param
+
+
+def run_study(param, stages=None, force=False):
+    """
+    Runs one study and reports whether every requested stage completed.
+    :return: (output_dir, ok, error message or None)
+    """
+    stages = stages or STAGES
+    try:
+        run_pipeline(param, stages=stages, force=force)
+    except Exception as e:
+        return param['output_dir'], False, str(e)
+    missing = [s for s in stages if s not in completed_stages(param['output_dir'])]
+    if missing:
+        return param['output_dir'], False, f"stages not completed: {missing}"
+    return param['output_dir'], True, None
+
+
+def load_batch(manifest_path):
+    """
+    Reads a batch manifest:
+
+        defaults: param/mc_parser.yml   # YAML path or inline parameters
+        peptide_cache: peptide_cache    # optional, shared digested databases
+        studies:
+          - output_dir: studies/plate1
+            fasta_path: human.fasta
+            input_file: plate1_report.tsv
+          - ...                          # any other key overrides the defaults
+
+    Relative paths are resolved against the manifest's folder.
+    :return: (list of study params, peptide cache folder)
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    manifest = read_param(manifest_path)
+
+    def _path(p):
+        return p if os.path.isabs(p) else os.path.join(base_dir, p)
+
+    defaults = manifest.get('defaults') or {}
+    if isinstance(defaults, str):
+        defaults = read_param(_path(defaults))
+    studies = []
+    for study in manifest['studies']:
+        param = {**defaults, **study}
+        for key in ('output_dir', 'fasta_path', 'input_file', 'results_db'):
+            if param.get(key):
+                param[key] = _path(param[key])
+        studies.append(param)
+    return studies, _path(manifest.get('peptide_cache', "peptide_cache"))
+
+
+def digest_shared(param, peptide_db, force=False):
+    """
+    Digests one FASTA/parameter set into a database shared by several studies.
+    An existing database is reused only if its stored `digest_key` matches; new ones
+    are written to `.partial` files and moved into place under a lock, so a crashed
+    or concurrent batch never leaves a truncated database behind to be reused.
+    """
+    param = {**param, 'peptide_db': peptide_db}
+    targets = {enzyme: enzyme_db_path(param, enzyme) for enzyme in run_enzymes(param)}
+    with ExitStack() as stack:
+        for path in sorted(targets.values()):
+            stack.enter_context(FileLock(path + ".lock"))
+        missing = {enzyme: path for enzyme, path in targets.items()
+                   if force or stored_digest_key(path) != digest_key({**param, 'enzyme': enzyme})}
+        if not missing:
+            print(f"♻ Reusing peptide database {peptide_db}")
+        else:
+            digest_enzymes(param, {enzyme: path + ".partial" for enzyme, path in missing.items()})
+            for path in missing.values():
+                os.replace(path + ".partial", path)
+    return peptide_db
+
+
+def run_batch(studies, peptide_cache, jobs=2, force=False):
+    """
+    Runs many studies concurrently. Studies with the same FASTA contents and
+    digestion parameters share one peptide database, digested once up front.
+    :return: List of (output_dir, ok, error message or None).
+    """
+    os.makedirs(peptide_cache, exist_ok=True)
+    groups = {}
+    for param in studies:
+        groups.setdefault(digest_key(param), []).append(param)
+    print(f"📚 {len(studies)} studies, {len(groups)} distinct FASTA/digestion parameter sets")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # ✅ One digestion per distinct FASTA/parameter set
+        digests = {}
+        for key, params in groups.items():
+            peptide_db = os.path.join(peptide_cache, f"{key}.sqlite")
+            for param in params:
+                param['peptide_db'] = peptide_db
+            digests[executor.submit(digest_shared, params[0], peptide_db, force)] = params
+        failed = []
+        for future in as_completed(digests):
+            try:
+                print(f"✔ Peptide database ready: {future.result()}")
+            except Exception as e:
+                print(f"❌ Digestion failed: {e}")
+                failed.extend(digests[future])
+        for param in failed:
+            results.append((param['output_dir'], False, "digestion failed"))
+        studies = [s for s in studies if not any(s is f for f in failed)]
+
+        futures = [executor.submit(run_study, param, [s for s in STAGES if s != "prepare"], force)
+                   for param in studies]
+        for future in as_completed(futures):
+            output_dir, ok, error = future.result()
+            print(f"{'✔' if ok else '❌'} {output_dir}" + (f": {error}" if error else ""))
+            results.append((output_dir, ok, error))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Miscleavage Parser command line")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_p = sub.add_parser("run", help="Run the pipeline (or some stages) for one study")
+    run_p.add_argument("param", help="YAML parameter file")
+    run_p.add_argument("--stages", nargs="+", choices=STAGES, help="Stages to run (default: all)")
+    run_p.add_argument("--output-dir", help="Overrides `output_dir`")
+    run_p.add_argument("--fasta", help="Overrides `fasta_path`")
+    run_p.add_argument("--input", help="Overrides `input_file`")
+    run_p.add_argument("--force", action="store_true", help="Re-run stages even if up to date")
+
+    batch_p = sub.add_parser("batch", help="Run many studies from a batch manifest")
+    batch_p.add_argument("manifest", help="Batch manifest YAML (see `load_batch`)")
+    batch_p.add_argument("--jobs", type=int, default=2, help="Studies run at the same time")
+    batch_p.add_argument("--force", action="store_true", help="Re-run stages even if up to date")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        param = read_param(args.param)
+        for key, value in (("output_dir", args.output_dir), ("fasta_path", args.fasta), ("input_file", args.input)):
+            if value:
+                param[key] = value
+        output_dir, ok, error = run_study(param, args.stages, args.force)
+        if not ok:
+            print(f"❌ {output_dir}: {error}", file=sys.stderr)
+        return 0 if ok else 1
+
+    studies, peptide_cache = load_batch(args.manifest)
+    results = run_batch(studies, peptide_cache, jobs=args.jobs, force=args.force)
+    failed = [r for r in results if not r[1]]
+    print(f"✅ {len(results) - len(failed)} studies completed, ❌ {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import os
+import zipfile
+
+from tools.progress import Progress
+
+
+# Parts of the output folder that can be packaged into the results archive.
+# Each part is a folder (relative to `output_dir`) and a filename filter.
+ARCHIVE_PARTS = {
+    "tables": [("step3-compare", lambda f: f.endswith((".csv", ".tsv", ".sqlite"))),
+               ("step2-qc", lambda f: f.endswith("_qc.tsv")),
+               ("step4-rollup", lambda f: f.endswith(".tsv")),
+               ("", lambda f: f.endswith(".json") and f != "progress.json")],
+    "figures": [("step3-compare", lambda f: f.endswith(".png"))],
+    "mc2": [("step2-qc", lambda f: f.endswith("_mc2.tsv"))],
+    "split": [("step1-split", lambda f: f.endswith(".split.tsv"))],
+}
+
+DEFAULT_PARTS = ["tables", "figures", "mc2"]
+
+# stage -> output folders it finishes, so their files can be zipped right away
+STAGE_FOLDERS = {
+    "split": ["step1-split"],
+    "qc": ["step2-qc"],
+    "rollup": ["step4-rollup"],
+    "compare": ["step3-compare"],
+}
+
+
+class ResultArchive:
+    """
+    Results zip that is filled while the pipeline runs: the files of each stage are
+    streamed into it (`ZipFile.write` copies in chunks) as soon as the stage
+    finishes, so there is no separate `make_archive` pass over the whole output
+    folder at the end. Only the selected `parts` (see `ARCHIVE_PARTS`) are added.
+    """
+
+    def __init__(self, output_dir, zip_path, parts=None):
+        self.output_dir = output_dir
+        self.zip_path = zip_path
+        self.parts = parts or DEFAULT_PARTS
+        self.added = set()
+        self.zip = zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def _wanted(self, folder, file_name):
+        return any(folder == part_folder and keep(file_name)
+                   for part in self.parts for part_folder, keep in ARCHIVE_PARTS[part])
+
+    def add_folder(self, folder):
+        """Adds every selected file of `folder` (relative to `output_dir`) not added yet."""
+        path = os.path.join(self.output_dir, folder)
+        if not os.path.isdir(path):
+            return
+        for file_name in sorted(os.listdir(path)):
+            arcname = os.path.join(folder, file_name)
+            file_path = os.path.join(path, file_name)
+            if arcname in self.added or not os.path.isfile(file_path) or not self._wanted(folder, file_name):
+                continue
+            self.zip.write(file_path, arcname)
+            self.added.add(arcname)
+
+    def add_stage(self, stage):
+        for folder in STAGE_FOLDERS.get(stage, []):
+            self.add_folder(folder)
+
+    def close(self):
+        """Adds the remaining selected files (manifest, metrics) and finalizes the zip."""
+        for folder in [""] + [f for folders in STAGE_FOLDERS.values() for f in folders]:
+            self.add_folder(folder)
+        self.zip.close()
+        return self.zip_path
+
+
+class ArchivingProgress(Progress):
+    """`Progress` that also streams each finished stage into a `ResultArchive`."""
+
+    def __init__(self, output_dir, stages, archive):
+        super().__init__(output_dir, stages)
+        self.archive = archive
+
+    def stage(self, name, status):
+        super().stage(name, status)
+        if status in ("done", "skipped"):
+            self.archive.add_stage(name)
+
+
+def build_archive(output_dir, zip_path, parts=None):
+    """Packages the selected parts of a finished output folder in one pass."""
+    archive = ResultArchive(output_dir, zip_path, parts)
+    return archive.close()
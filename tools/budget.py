@@ -0,0 +1,168 @@
+import itertools
+import os
+import re
+import sqlite3
+import sys
+
+
+# `memory_budget` in mc_parser.yml: the memory (per job) the stages plan their
+# chunk sizes, insert batches, worker counts and out-of-core fallbacks against.
+# Accepts a size ("8GB", "512MB", a plain number is MB), "auto" (80 % of the
+# memory this process may use, cgroup limit included) or null for no limit, which
+# keeps the in-memory behaviour of every stage.
+DEFAULT_BATCH_SIZE = 5000  # SQLite insert batch without a budget
+
+# Share of the budget each structure may take before a stage switches strategy
+DIGEST_FRACTION = 0.5  # digestion `pep_map` before it spills to SQLite
+CSV_FRACTION = 0.25  # a DIA report or table held as a DataFrame
+BATCH_FRACTION = 0.01  # one batch of SQLite inserts
+
+# Rough in-memory size of parsed data relative to its text size, and of the QC
+# peptide map relative to the FASTA file (2 missed cleavages)
+CSV_EXPANSION = 4
+QC_EXPANSION = 20
+PEP_MAP_PER_FASTA_BYTE = 70
+
+_UNITS = {"": 1, "K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+
+
+def available_memory_mb():
+    """Memory this process may use: the cgroup limit if any, else the available RAM."""
+    limits = []
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            limits.append(int(value) / (1 << 20))
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        limits.append(int(meminfo["MemAvailable"].split()[0]) / 1024)
+    except (OSError, KeyError, ValueError):
+        pass
+    return min(limits) if limits else None
+
+
+def parse_memory_budget(value):
+    """`memory_budget` value -> megabytes, or None for no limit."""
+    if value is None or value is False or str(value).strip().lower() in ("", "none", "null"):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().upper()
+    if text == "AUTO":
+        available = available_memory_mb()
+        return 0.8 * available if available else None
+    match = re.fullmatch(r"([0-9.]+)\s*([KMGT]?)I?B?", text)
+    if not match:
+        raise ValueError(f"Invalid memory_budget: {value!r} (use e.g. 8GB, 512MB, auto or null)")
+    return float(match.group(1)) * _UNITS[match.group(2)]
+
+
+def mapping_size_mb(mapping, sample_size=1000):
+    """Rough memory footprint of a str -> collection of str dict, extrapolated from a sample."""
+    if not mapping:
+        return 0.0
+    sample = list(itertools.islice(mapping.items(), sample_size))
+    per_entry = sum(sys.getsizeof(k) + sys.getsizeof(v) + sum(sys.getsizeof(p) for p in v)
+                    for k, v in sample) / len(sample)
+    return (sys.getsizeof(mapping) + per_entry * len(mapping)) / (1 << 20)
+
+
+def pep_map_estimate_mb(sqlite_path):
+    """QC peptide map size estimated from the `peptides` table, without loading it."""
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        count, chars = conn.execute("SELECT COUNT(*), SUM(LENGTH(peptide) + LENGTH(protein)) FROM peptides;").fetchone()
+    finally:
+        conn.close()
+    return (count * 200 + (chars or 0) * 2.5) / (1 << 20)
+
+
+def _file_mb(path):
+    return os.path.getsize(path) / (1 << 20)
+
+
+def qc_sample_mb(paths):
+    """Memory a QC worker needs for the largest of the split files `paths`."""
+    return max((_file_mb(p) * QC_EXPANSION for p in paths), default=0)
+
+
+def fasta_pep_map_mb(fasta_path):
+    """QC peptide map size estimated from the FASTA file, before it is digested."""
+    return _file_mb(fasta_path) * PEP_MAP_PER_FASTA_BYTE
+
+
+class MemoryBudget:
+    """
+    Turns `memory_budget` into the sizes each stage works with. Without a budget
+    every method returns the stage's in-memory default.
+    """
+
+    def __init__(self, total_mb=None):
+        self.total_mb = total_mb
+
+    @property
+    def limited(self):
+        return self.total_mb is not None
+
+    def __str__(self):
+        return f"{self.total_mb:,.0f} MB" if self.limited else "unlimited"
+
+    def share_mb(self, fraction):
+        return None if not self.limited else self.total_mb * fraction
+
+    def insert_batch(self, row_bytes=200):
+        """Rows per SQLite `executemany` batch."""
+        if not self.limited:
+            return DEFAULT_BATCH_SIZE
+        rows = int(self.share_mb(BATCH_FRACTION) * (1 << 20) / row_bytes)
+        return max(500, min(rows, 100000))
+
+    def digest_spill_mb(self):
+        """Size of the in-memory digestion map at which it spills to SQLite (None: never)."""
+        return self.share_mb(DIGEST_FRACTION)
+
+    def csv_chunk_rows(self, path, fraction=CSV_FRACTION):
+        """
+        Rows per chunk to read a delimited file in, or None if the whole file fits
+        in its share of the budget.
+        """
+        if not self.limited or _file_mb(path) * CSV_EXPANSION <= self.share_mb(fraction):
+            return None
+        with open(path, "rb") as f:
+            head = f.read(1 << 20)
+        line_bytes = max(len(head) / max(head.count(b"\n"), 1), 1)
+        return max(1000, int(self.share_mb(fraction) * (1 << 20) / (line_bytes * CSV_EXPANSION)))
+
+    def workers(self, requested, per_worker_mb, fixed_mb=0):
+        """Workers (at most `requested`, at least 1) that fit next to `fixed_mb`."""
+        if not self.limited:
+            return requested
+        fit = int((self.total_mb - fixed_mb) // max(per_worker_mb, 1))
+        return max(1, min(requested, fit))
+
+    def qc_plan(self, requested, pep_map_mb, sample_mb):
+        """
+        Worker count and peptide map scope for QC. Each worker is counted with its
+        own copy of the full peptide map (copy-on-write pages of a forked pool do
+        not stay shared). If that does not fit, workers load only the peptides of
+        their sample (`"sample"` scope) instead of the whole map.
+        :param sample_mb: Memory one worker needs for a sample (see `qc_sample_mb`).
+        :return: `(workers, scope)` with scope "all" or "sample".
+        """
+        if not self.limited:
+            return requested, "all"
+        if pep_map_mb * (1 + requested) + sample_mb * requested <= self.total_mb:
+            return requested, "all"
+        if pep_map_mb * 2 + sample_mb <= self.total_mb:
+            return self.workers(requested, pep_map_mb + sample_mb, fixed_mb=pep_map_mb), "all"
+        return self.workers(requested, sample_mb * 2), "sample"
+
+
+def memory_budget(param):
+    """`MemoryBudget` of a run from its parameters."""
+    return MemoryBudget(parse_memory_budget(param.get('memory_budget')))
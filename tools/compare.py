@@ -1,18 +1,22 @@
 import pandas as pd
 import os,re,sys
-import yaml
 from tqdm import tqdm
 import sqlite3
-import seaborn as sns
 import numpy as np
-import matplotlib.pyplot as plt
 import gc
 
+from tools.plots import FigureRenderer
+from tools import store
+from tools.budget import memory_budget
+from tools.qc import merged_qc_path, start_merged_qc, append_merged_qc
+
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def merge_qc(param):
     """
     Merges all QC results into a single file.
+    `qc_all` already appends each sample to `merged_qc.tsv` as soon as its QC job
+    finishes, so only `_qc.tsv` files missing from it are read here.
     :param param: Dictionary of parameters loaded from YAML.
     """
 
@@ -30,169 +34,289 @@ def merge_qc(param):
         print("⚠ No QC files found! Skipping merging step.")
         return
 
-    # ✅ Read and concatenate all QC files
-    df_list = [pd.read_csv(os.path.join(step2_dir, f), sep="\t") for f in files]
-    merged_df = pd.concat(df_list)
+    merged_path = merged_qc_path(output_dir)
+
+    if param.get('incremental', False):
+        # ✅ Only new or changed QC files are read; the rest come from the study store
+        conn = store.open_store(param)
+        dropped = store.drop_missing_samples(conn, "qc", [f[:-len("_qc.tsv")] for f in files])
+        if dropped:
+            print(f"🗑 {len(dropped)} QC samples no longer in `{step2_dir}` removed from the results: {dropped}")
+        added = 0
+        for f in files:
+            path = os.path.join(step2_dir, f)
+            sample = f[:-len("_qc.tsv")]
+            digest = store.file_hash(path)
+            if not store.is_current(conn, sample, "qc", digest):
+                store.replace_sample_qc(conn, sample, digest, pd.read_csv(path, sep="\t"))
+                added += 1
+        print(f"🔄 {added} new/changed QC files added to `{store.results_db_path(param)}`")
+        start_merged_qc(merged_path)
+        append_merged_qc(merged_path, store.read_merged_qc(conn))
+        conn.close()
+    else:
+        # ✅ Append only the samples not yet in the merged file
+        merged = set()
+        if os.path.exists(merged_path):
+            merged = set(pd.read_csv(merged_path, sep="\t", usecols=['sample_name'], dtype=str)['sample_name'])
+        missing = [f for f in files if f[:-len("_qc.tsv")] not in merged]
+        for f in missing:
+            append_merged_qc(merged_path, pd.read_csv(os.path.join(step2_dir, f), sep="\t"))
+        print(f"🔄 {len(missing)} QC files appended to the merged QC")
+    gc.collect()
+
+    print(f"✅ Merged QC saved to {merged_path}")
+
+
+AA_LIST = sorted(["A", "R", "N", "D", "C", "E", "Q", "G", "H", "I", "L", "K", "M", "F", "P", "S", "T", "W", "Y", "V"])
+
+
+def sample_condition(df):
+    return df.columns[2].split(".")[0].split(" ")[1]
+
+
+def sample_long_table(df):
+    """
+    Converts one `_mc2.tsv` table into this sample's rows of the study long table:
+    the `rdf` columns plus the missed cleavage count and, for single missed cleavage
+    peptides, the residues on each side of the missed site.
+    """
+    mc_pep = df['PEP.StrippedSequence']
+    long_df = pd.DataFrame({
+        'Condition': sample_condition(df),
+        'MC_PEP': mc_pep,
+        'NMC_PEP': "NA",
+        'MC_PEP_Quant': df.iloc[:, 2],
+        'NMC_PEP_Quant': df["NMC.PEP.Quantity"],
+        'MCR': df["Missed.Cleavage.Ratio"],
+        'MC_Count': df["Missed.Cleavages.Count"],
+        'PRE_AA': None,
+        'POST_AA': None,
+    })
+
+    # for trypsin/p
+    mc1 = long_df['MC_Count'] == 1
+    sites = df.loc[mc1, "Missed.Cleavages.Sites"].astype(str).str.split(",", expand=True)
+    if sites.shape[1] != 2 or sites[1].isna().any():
+        bad = df.loc[mc1, "Missed.Cleavages.Sites"]
+        raise ValueError(f"Malformed Missed.Cleavages.Sites in {sample_condition(df)}: {list(bad[:5])}")
+    long_df.loc[mc1, 'PRE_AA'] = [pep[int(pos)] for pep, pos in zip(mc_pep[mc1], sites[0])]
+    long_df.loc[mc1, 'POST_AA'] = sites[1]
+    return long_df
+
+
+MC2_COLUMNS = ['PEP.StrippedSequence', 'Missed.Cleavages.Sites', 'Missed.Cleavages.Count',
+               'NMC.PEP.Quantity', 'Missed.Cleavage.Ratio']
+
+
+def read_mc2(path):
+    """
+    Reads only the columns of a `_mc2.tsv` file that compare needs, keeping the
+    sample quantity as the third column.
+    """
+    header = list(pd.read_csv(path, sep="\t", nrows=0).columns)
+    columns = header[:3] + [c for c in MC2_COLUMNS if c not in header[:3]]
+    return pd.read_csv(path, sep="\t", usecols=columns)[columns]
+
+
+def _aa_count_table(counts):
+    """
+    Builds `mc_aa_count.csv` from {condition: {(pre_aa, post_aa): count}}.
+    """
+    rows = []
+    for sample in counts:
+        for pre_aa in ["K", "R"]:
+            rows.append([sample, pre_aa] + [counts[sample].get((pre_aa, post_aa), 0) for post_aa in AA_LIST])
+    return pd.DataFrame(rows, columns=["Sample", "PRE_AA"] + AA_LIST)
+
+
+COMPARE_OUTPUTS = ("database", "csv", "both")
+
 
-    # ✅ Save merged QC file
-    merged_qc_path = os.path.join(step3_dir, "merged_qc.tsv")
-    merged_df.to_csv(merged_qc_path, sep="\t", index=False)
-    del merged_df
-    gc.collect
+class CompareAccumulator:
+    """
+    Single-pass compare over the samples of a study. Each sample's long table is
+    appended to the compare database and/or the row-level CSVs as soon as it is
+    added; only the aggregated outputs (wide MCR matrix, residue counts, per-sample
+    MCR of the common peptides) are kept in memory until `finish`.
+    :param output: "database" (compare.sqlite with views), "csv" (legacy per-variant
+        CSV files) or "both".
+    :param batch_size: Rows per insert into the compare database (None: all of a
+        sample at once).
+    """
+
+    TABLES = ["rdf", "rdf2", "new_rdf", "new_rdf2", "wide_df", "wdf"]
+
+    def __init__(self, step3_dir, renderer, output="database", batch_size=None):
+        if output not in COMPARE_OUTPUTS:
+            raise ValueError(f"Unknown compare_output: {output}. Choose from {COMPARE_OUTPUTS}")
+        self.step3_dir = step3_dir
+        self.renderer = renderer
+        self.write_csv = output in ("csv", "both")
+        self.batch_size = batch_size
+        self.db = store.create_compare_db(step3_dir) if output in ("database", "both") else None
+        self.conditions = []
+        self.common_peps = None
+        self.common_mcr = {}  # condition -> MCR of peptides still common to all samples
+        self.wide_cols = {}  # condition -> MCR of rows kept in rdf2 (CSV output only)
+        self.counts = {}  # condition -> {(pre_aa, post_aa): count}
+        for table_name in self.TABLES:
+            path = os.path.join(step3_dir, table_name + ".csv")
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _append(self, df, table_name):
+        path = os.path.join(self.step3_dir, table_name + ".csv")
+        df.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+    def add(self, long_df):
+        """
+        Adds one sample (see `sample_long_table`) to all compare outputs.
+        """
+        condition = long_df['Condition'].iloc[0] if len(long_df) else None
+        if condition is None:
+            return
+        self.conditions.append(condition)
+
+        peps = set(long_df['MC_PEP'])
+        self.common_peps = peps if self.common_peps is None else self.common_peps & peps
+        mcr = long_df.set_index('MC_PEP')['MCR']
+        self.common_mcr[condition] = mcr[mcr.index.isin(self.common_peps)]
+
+        rdf = long_df[['Condition', 'MC_PEP', 'NMC_PEP', 'MC_PEP_Quant', 'NMC_PEP_Quant', 'MCR']].copy()
+        rdf['Log2MC_PEP_Quant'] = np.log2(rdf['MC_PEP_Quant'].replace(0, np.nan))
+        rdf['Log2NMC_PEP_Quant'] = np.log2(rdf['NMC_PEP_Quant'].replace(0, np.nan))
+        rdf2 = rdf.replace([np.inf, -np.inf], np.nan)
+        rdf2 = rdf2.dropna()
+        if self.write_csv:
+            self.wide_cols[condition] = rdf2.set_index('MC_PEP')['MCR']
+
+        # for trypsin/p
+        new_rdf = long_df.loc[long_df['MC_Count'] == 1,
+                              ['Condition', 'MC_PEP', 'NMC_PEP', 'MC_PEP_Quant', 'NMC_PEP_Quant', 'MCR', "PRE_AA", "POST_AA"]]
+        counts = self.counts.setdefault(condition, {})
+        for key, n in new_rdf.groupby(["PRE_AA", "POST_AA"]).size().items():
+            counts[key] = counts.get(key, 0) + int(n)
+
+        if self.db is not None:
+            db_df = rdf.drop(columns='NMC_PEP').replace([np.inf, -np.inf], np.nan)
+            db_df[['MC_Count', 'PRE_AA', 'POST_AA']] = long_df[['MC_Count', 'PRE_AA', 'POST_AA']]
+            db_df.to_sql("mcr_long", self.db, if_exists="append", index=False, chunksize=self.batch_size)
+        if self.write_csv:
+            self._append(rdf, "rdf")
+            self._append(rdf2, "rdf2")
+            self._append(new_rdf, "new_rdf")
+            self._append(new_rdf[new_rdf['POST_AA'] != "P"], "new_rdf2")
+
+    def finish(self):
+        """
+        Writes the aggregated outputs. Each table is handed to the figure renderer as
+        soon as it is committed, so figures render while the rest is still written.
+        """
+        step3_dir = self.step3_dir
+        if self.db is not None:
+            store.define_compare_views(self.db)
+        # ✅ The row-level tables are complete once the last sample is in
+        self.renderer.table_written("rdf")
+        self.renderer.table_written("rdf2")
+        if not self.write_csv:
+            self.renderer.table_written("wdf")  # ✅ Pivoted from the rdf2 view on demand
+
+        common_peps = self.common_peps or set()
+        print(f"Common peptides: {len(common_peps)}")
+        med_list = [s[s.index.isin(common_peps)].median() for s in self.common_mcr.values()]
+        med_df = pd.DataFrame({"Condition": self.conditions, "Median.MCR": med_list})
+        if self.db is not None:
+            med_df.to_sql("median_mcr", self.db, index=False)
+        med_df.to_csv(os.path.join(step3_dir, "median_mcr.csv"), index=False)
+        self.renderer.table_written("median_mcr")
+
+        xdf = _aa_count_table(self.counts)
+        if self.db is not None:
+            xdf.to_sql("mc_aa_count", self.db, index=False)
+        xdf.to_csv(os.path.join(step3_dir, "mc_aa_count.csv"), index=False)
+        self.renderer.table_written("mc_aa_count")
+
+        if self.write_csv:
+            # same layout as rdf2.pivot(index='MC_PEP', columns='Condition', values='MCR')
+            wide = pd.concat(self.wide_cols, axis=1) if self.wide_cols else pd.DataFrame()
+            wide = wide.sort_index().sort_index(axis=1)
+            wide.index.name = 'MC_PEP'
+            wide.columns.name = 'Condition'
+            wide_df = wide.reset_index()
+            wdf = wide_df.dropna().set_index('MC_PEP')
+            wide_df.to_csv(os.path.join(step3_dir, "wide_df.csv"), index=False)
+            wdf.to_csv(os.path.join(step3_dir, "wdf.csv"))
+            self.renderer.table_written("wdf")
+
+        if self.db is not None:
+            store.finish_compare_db(self.db)
+
+    def close(self):
+        """Closes the compare database; call after the renderer has finished reading it."""
+        if self.db is not None:
+            store.close_compare_db(self.db)
+            self.db = None
 
-    print(f"✅ Merged QC saved to {merged_qc_path}")
-        
-        
 
 def compare_all(param):
+    """
+    Compares the missed cleavage results of all samples in `step2-qc`.
+    Every `_mc2.tsv` is read exactly once and streamed into the outputs, so peak
+    memory is one sample plus the aggregated tables. Row-level tables go to
+    `compare.sqlite` unless `compare_output` asks for the legacy CSV files
+    ("csv" or "both"). With `incremental: True`, only new or changed files are
+    parsed and the rest is read back sample by sample from the study results
+    database (see `tools/store.py`); the outputs are still rebuilt from every sample.
+    :param param: Dictionary of parameters loaded from YAML.
+    :return: List of logs/messages for Streamlit UI.
+    """
     output_dir = param['output_dir']
     step3_dir = os.path.join(output_dir,"step3-compare")
     step2_dir = os.path.join(output_dir,"step2-qc")
     if not os.path.exists(step3_dir):
         os.makedirs(step3_dir)
     files = [i for i in os.listdir(step2_dir) if i.endswith("_mc2.tsv")]
-    
-    df_list = []
-    for i in files:
-        df = pd.read_csv(os.path.join(step2_dir, i), sep="\t")
-        df_list.append(df)
-    
-    common_peps = set(df_list[0]["PEP.StrippedSequence"])
-    for i in tqdm(df_list):
-        common_peps.intersection(set(i["PEP.StrippedSequence"]))
-    print(f"Common peptides: {len(common_peps)}")
-    
-    med_list = []
-    for df in df_list:
-        med = df[df['PEP.StrippedSequence'].isin(common_peps)]['Missed.Cleavage.Ratio'].median()
-        med_list.append(med)
-        
-    sns.histplot(med_list)
-    
-    # Save the figure to a PNG file
-    hist_path = os.path.join(step3_dir, "histogram.png")
-    plt.savefig(hist_path, dpi=300, bbox_inches="tight")
-    plt.close()
-    rows = []
 
-    for df in tqdm(df_list):
-        for index, row in df.iterrows():
-            condition = df.columns[2].split(".")[0].split(" ")[1]
-            mc_pep = row['PEP.StrippedSequence']
-            nmc_pep = "NA"
-            mc_pep_quant = list(row)[2]
-            nmc_pep_quant = row["NMC.PEP.Quantity"]
-            mcr = row["Missed.Cleavage.Ratio"]
-            r = [condition, mc_pep, nmc_pep, mc_pep_quant, nmc_pep_quant, mcr]
-            rows.append(r)
-            
-    rdf = pd.DataFrame(rows, columns=['Condition', 'MC_PEP', 'NMC_PEP', 'MC_PEP_Quant', 'NMC_PEP_Quant', 'MCR'])
-    
-    # rdf['Log2MC_PEP_Quant'] = np.log2(rdf['MC_PEP_Quant'])
-    # rdf['Log2NMC_PEP_Quant'] = np.log2(rdf['NMC_PEP_Quant'])
-    rdf['Log2MC_PEP_Quant'] = np.log2(rdf['MC_PEP_Quant'].replace(0, np.nan))
-    rdf['Log2NMC_PEP_Quant'] = np.log2(rdf['NMC_PEP_Quant'].replace(0, np.nan))
-    
-    rdf2 = rdf.replace([np.inf, -np.inf], np.nan)
-    rdf2 = rdf2.dropna()
-    
-    wide_df = rdf2.pivot(index='MC_PEP', columns='Condition', values='MCR').reset_index()
-    wdf = wide_df.dropna().set_index('MC_PEP')
-    
-    # 3. Save the DataFrames to CSV files.
-    rdf.to_csv(os.path.join(step3_dir, "rdf.csv"), index=False)
-    rdf2.to_csv(os.path.join(step3_dir, "rdf2.csv"), index=False)
-    wide_df.to_csv(os.path.join(step3_dir, "wide_df.csv"), index=False)
-    wdf.to_csv(os.path.join(step3_dir, "wdf.csv"))
-
-    
-    g = sns.clustermap(wdf, cmap="vlag", center=0, figsize=(20, 8))
-    clustermap_path = os.path.join(step3_dir, "clustermap.png")
-    g.savefig(clustermap_path)
-    plt.close()
-
-    g2 = sns.clustermap(wdf, cmap="vlag", center=0, figsize=(20, 8), z_score=0, )
-    clustermap2_path = os.path.join(step3_dir, "clustermap_zscore.png")
-    g2.savefig(clustermap2_path)
-    plt.close()
-    
-    fig,ax = plt.subplots(figsize=(20, 8))
-    sns.boxplot(data = rdf2, x= 'Condition', y = 'MCR')
-    tmp = plt.xticks(rotation=90)
-    boxplot_path = os.path.join(step3_dir, "boxplot.png")
-    plt.savefig(boxplot_path, dpi=300, bbox_inches="tight")
-    plt.close(fig)
-    
-    
-    fig,ax = plt.subplots(figsize=(20, 8))
-    sns.violinplot(data = rdf, x= 'Condition', y = 'MCR', hue="Condition")
-    tmp = plt.xticks(rotation=90)  
-    violinplot_path = os.path.join(step3_dir, "violinplot.png")
-    plt.savefig(violinplot_path, dpi=300, bbox_inches="tight")
-    plt.close(fig)
-    
-    print(f"All figures and DataFrames have been saved to {output_dir}.")
-    
-    # for trypsin/p
-    for ii, df in tqdm(enumerate(df_list)):
-        for index, row in df.iterrows():
-            condition = df.columns[2].split(".")[0].split(" ")[1]
-            mc_pep = row['PEP.StrippedSequence']
-            nmc_pep = "NA"
-            mc_pep_quant = list(row)[2]
-            nmc_pep_quant = row["NMC.PEP.Quantity"]
-            mcr = row["Missed.Cleavage.Ratio"]
-            mc_count = row["Missed.Cleavages.Count"]
-            if mc_count != 1:
-                continue
+    # ✅ Figures render in a process pool as soon as their source table is saved
+    renderer = FigureRenderer(param, step3_dir)
+    budget = memory_budget(param)
+    acc = None
+    try:
+        acc = CompareAccumulator(step3_dir, renderer, output=param.get('compare_output', "database"),
+                                 batch_size=budget.insert_batch() if budget.limited else None)
+
+        if param.get('incremental', False):
+            conn = store.open_store(param)
             try:
-                pos,aa = row["Missed.Cleavages.Sites"].split(",")
-            except:
-                print(ii,index, row["Missed.Cleavages.Sites"])
-                sys.exit(1)
-            
-            pre_aa = mc_pep[int(pos)]
-            r = [condition, mc_pep, nmc_pep, mc_pep_quant, nmc_pep_quant, mcr, pre_aa, aa]
-            rows.append(r)
-            
-    rdf = pd.DataFrame(rows, columns=['Condition', 'MC_PEP', 'NMC_PEP', 'MC_PEP_Quant', 'NMC_PEP_Quant', 'MCR', "PRE_AA", "POST_AA"])
-    
-    rdf2 = rdf[rdf['POST_AA'] != "P"]
-    
-    rdf.to_csv(os.path.join(step3_dir, "new_rdf.csv"), index=False)
-    rdf2.to_csv(os.path.join(step3_dir, "new_rdf2.csv"), index=False)
-    
-    d = dict()
-    for index,row in tqdm(rdf.iterrows()):
-        sample = row['Condition']
-        pre_aa = row['PRE_AA']
-        post_aa = row['POST_AA']
-        if sample not in d:
-            d[sample] = dict()
-        if pre_aa not in d[sample]:
-            d[sample][pre_aa] = dict()
-        if post_aa not in d[sample][pre_aa]:
-            d[sample][pre_aa][post_aa] = 0
-        d[sample][pre_aa][post_aa] += 1
-    
-    rows = []
-    aa_list = sorted(["A", "R", "N", "D", "C", "E", "Q", "G", "H", "I","L", "K", "M", "F", "P", "S", "T", "W", "Y", "V"])
-    for sample in d:
-        for pre_aa in ["K", "R"]:
-            x = []
-            if pre_aa not in d[sample]:
-                x = [0] * 20 
-            else:
-                for post_aa in aa_list:
-                    x.append(d[sample][pre_aa].get(post_aa, 0))
-            rows.append([sample, pre_aa] + x)
-    
-    xdf = pd.DataFrame(rows,columns=["Sample", "PRE_AA"] + aa_list)
-    
-    xdf.to_csv(os.path.join(step3_dir, "mc_aa_count.csv"), index=False)
-    g3 = sns.clustermap(xdf.set_index(["Sample","PRE_AA"]), cmap="vlag", center=0, figsize=(20, 8), row_cluster=False, col_cluster=False)
-    clustermap3_path = os.path.join(step3_dir, "heatmap_mc_aa_count.png")
-    g3.savefig(clustermap3_path)
-    del rdf, rdf2, wdf, wide_df, xdf, g, g2, g3
-    gc.collect
-    plt.close() 
\ No newline at end of file
+                # ✅ Samples whose `_mc2.tsv` is gone must not stay in the aggregates
+                dropped = store.drop_missing_samples(conn, "mc2", [i[:-len("_mc2.tsv")] for i in files])
+                if dropped:
+                    print(f"🗑 {len(dropped)} samples no longer in `{step2_dir}` removed from the results: {dropped}")
+                added = 0
+                for i in tqdm(files):
+                    path = os.path.join(step2_dir, i)
+                    sample = i[:-len("_mc2.tsv")]
+                    digest = store.file_hash(path)
+                    if store.is_current(conn, sample, "mc2", digest):
+                        continue
+                    store.replace_sample_mc(conn, sample, digest, sample_long_table(read_mc2(path)))
+                    added += 1
+                print(f"🔄 {added} new/changed samples added to `{store.results_db_path(param)}`")
+                for long_df in store.iter_long_tables(conn):
+                    acc.add(long_df)
+            finally:
+                conn.close()
+        else:
+            for i in tqdm(files):
+                acc.add(sample_long_table(read_mc2(os.path.join(step2_dir, i))))
+                gc.collect()
+
+        acc.finish()
+    finally:
+        logs = renderer.close()  # ✅ Never leave the figure pool running, even if a sample fails
+        if acc is not None:
+            acc.close()
+
+    print(f"All figures and DataFrames have been saved to {output_dir}.")
+    return logs
@@ -0,0 +1,80 @@
+import os
+import shutil
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlsplit
+
+
+CHUNK_SIZE = 1 << 20
+
+
+class DownloadServer:
+    """
+    Small HTTP server, run in a daemon thread next to Streamlit, that streams
+    registered result archives from disk in `CHUNK_SIZE` chunks. Unlike
+    `st.download_button` the file is never loaded into the server's memory, and
+    unlike Streamlit's static file serving it has no size limit. Only files
+    registered with `register` are served, under a random token.
+    It listens on `host` (loopback by default). `public_url` is the address browsers
+    reach it under when a reverse proxy is in front of it; without one, the caller
+    derives it from the request (see `base_url`). Raises `OSError` if the port is taken.
+    """
+
+    LOOPBACK = ("localhost", "127.0.0.1", "::1")
+
+    def __init__(self, public_url=None, port=8502, host="127.0.0.1"):
+        self.files = {}
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.port = port
+        self.host = host
+        files = self.files
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                entry = files.get(self.path.strip("/").split("/")[0])
+                if entry is None or not os.path.exists(entry[0]):
+                    self.send_error(404)
+                    return
+                path, file_name = entry
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Length", str(os.path.getsize(path)))
+                self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(file_name)}")
+                self.end_headers()
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def base_url(self, request_host, scheme="http"):
+        """
+        Address browsers reach the server under, for a page requested from
+        `request_host` (its Host header): `public_url` if set, else the same host name
+        on this server's port. None if that host cannot reach it (a non-loopback host
+        while the server only listens on loopback).
+        """
+        if self.public_url:
+            return self.public_url
+        if not request_host:
+            return None
+        hostname = urlsplit(f"//{request_host}").hostname
+        if self.host in self.LOOPBACK and hostname not in self.LOOPBACK:
+            return None
+        if ":" in hostname:
+            hostname = f"[{hostname}]"  # IPv6 literal
+        return f"{scheme}://{hostname}:{self.port}"
+
+    def register(self, path, file_name, base_url):
+        """Makes `path` downloadable and returns its URL under `base_url`."""
+        token = uuid.uuid4().hex
+        self.files[token] = (path, file_name)
+        return f"{base_url.rstrip('/')}/{token}/{quote(file_name)}"
+
+    def unregister(self, url):
+        self.files.pop(urlsplit(url).path.rstrip("/").split("/")[-2], None)
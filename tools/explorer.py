@@ -0,0 +1,126 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from tools import store
+
+
+# Server-side aggregations of the compare database (`step3-compare/compare.sqlite`)
+# for the interactive MCR explorer. Distributions and quantiles come from the
+# pre-binned `mcr_bins` table (0.1 % MCR resolution) written when compare finishes;
+# peptide lookups and scatter samples use the indexed `MC_PEP` / `Condition`
+# columns of `mcr_long`. The browser only ever receives aggregates or a capped
+# sample of points, however many rows `mcr_long` holds.
+
+
+def explorer_db(step3_dir):
+    """Path of the compare database, or None if compare ran with CSV output only."""
+    db_path = store.compare_db_path(step3_dir)
+    return db_path if os.path.exists(db_path) else None
+
+
+def _query(db_path, sql, params=()):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def _bins_source(db_path):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        has_bins = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'mcr_bins';").fetchone() is not None
+    finally:
+        conn.close()
+    return "mcr_bins" if has_bins else f"({store.MCR_BINS_QUERY})"  # ✅ Older databases: bin on the fly
+
+
+def _fine_bins(db_path, conditions=None, quantified_only=False):
+    """Condition, Bin (0.1 % MCR), Count and Total rows for the selected conditions."""
+    source = _bins_source(db_path)
+    clauses, params = [], []
+    if conditions:
+        clauses.append(f"Condition IN ({', '.join('?' for _ in conditions)})")
+        params.extend(conditions)
+    if quantified_only:
+        clauses.append("Quantified = 1")  # ✅ Same filter as `rdf2`: both quantities present
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    return _query(db_path,
+                  f"SELECT Condition, Bin, SUM(Count) AS Count, SUM(Total) AS Total FROM {source}{where} "
+                  f"GROUP BY Condition, Bin ORDER BY Condition, Bin;", params)
+
+
+def list_conditions(db_path):
+    """Conditions with their row counts."""
+    return _query(db_path, f"SELECT Condition, SUM(Count) AS Rows FROM {_bins_source(db_path)} "
+                           f"GROUP BY Condition ORDER BY Condition;")
+
+
+def mcr_histogram(db_path, conditions=None, bins=50, quantified_only=False):
+    """
+    MCR histogram per condition, re-binned from the 0.1 % bins.
+    :return: DataFrame with Condition, Bin (left edge, %), Count.
+    """
+    fine = _fine_bins(db_path, conditions, quantified_only)
+    width = 100.0 / bins
+    fine["Bin"] = np.minimum((fine["Bin"] * store.MCR_BIN_WIDTH // width).astype(int), bins - 1) * width
+    return fine.groupby(["Condition", "Bin"], as_index=False)["Count"].sum()
+
+
+def condition_quantiles(db_path, conditions=None, quantified_only=False):
+    """
+    Per-condition box statistics (quartiles, whiskers at 1.5 IQR clipped to the
+    data, mean, count), approximated to the 0.1 % MCR bin centres.
+    """
+    rows = []
+    for condition, part in _fine_bins(db_path, conditions, quantified_only).groupby("Condition", sort=True):
+        centers = (part["Bin"].to_numpy() + 0.5) * store.MCR_BIN_WIDTH
+        cumulative = np.cumsum(part["Count"].to_numpy())
+        n = int(cumulative[-1])
+
+        def _q(q):
+            return float(centers[np.searchsorted(cumulative, q * n)])
+
+        q1, median, q3 = _q(0.25), _q(0.5), _q(0.75)
+        iqr = q3 - q1
+        rows.append({
+            "Condition": condition, "Count": n, "Mean": float(part["Total"].sum() / n),
+            "Q1": q1, "Median": median, "Q3": q3,
+            "Lower": float(centers[centers >= q1 - 1.5 * iqr].min()),
+            "Upper": float(centers[centers <= q3 + 1.5 * iqr].max()),
+        })
+    return pd.DataFrame(rows, columns=["Condition", "Count", "Mean", "Q1", "Median", "Q3", "Lower", "Upper"])
+
+
+def search_peptides(db_path, prefix, limit=50):
+    """Missed-cleavage peptides starting with `prefix` (an index range scan)."""
+    prefix = prefix.upper()
+    return _query(db_path,
+                  "SELECT MC_PEP, COUNT(*) AS Conditions FROM mcr_long "
+                  "WHERE MC_PEP >= ? AND MC_PEP < ? GROUP BY MC_PEP ORDER BY MC_PEP LIMIT ?;",
+                  (prefix, prefix + "\uffff", limit))
+
+
+def peptide_profile(db_path, peptide):
+    """MCR and quantities of one missed-cleavage peptide across conditions."""
+    return _query(db_path,
+                  "SELECT Condition, MCR, MC_PEP_Quant, NMC_PEP_Quant, PRE_AA, POST_AA "
+                  "FROM mcr_long WHERE MC_PEP = ? ORDER BY rowid;", (peptide,))
+
+
+def quant_scatter(db_path, condition, max_points=50000):
+    """
+    Log2 MC vs NMC peptide quantities of one condition. Conditions with more rows
+    than `max_points` are thinned by a rowid stride so the sample stays spread out.
+    :return: (points, number of rows before thinning)
+    """
+    where = " WHERE Condition = ? AND Log2MC_PEP_Quant IS NOT NULL AND Log2NMC_PEP_Quant IS NOT NULL"
+    n = int(_query(db_path, f"SELECT COUNT(*) AS n FROM mcr_long{where};", (condition,))["n"].iloc[0])
+    stride = max(1, -(-n // max_points))
+    points = _query(db_path,
+                    f"SELECT MC_PEP, Log2MC_PEP_Quant, Log2NMC_PEP_Quant, MCR FROM mcr_long{where} "
+                    f"AND rowid % ? = 0;", (condition, stride))
+    return points, n
@@ -0,0 +1,243 @@
+import mmap
+import os
+import sqlite3
+
+
+# faidx-style offset index of a FASTA file, written once next to it as
+# `<fasta>.mcidx` (its own extension, so a `samtools faidx` `.fai` is never
+# mistaken for it). A header line `#mcidx`, FASTA_INDEX_VERSION, and the size and
+# modification time (ns) of the indexed FASTA is followed by one tab-separated line
+# per protein with NAME, LENGTH, OFFSET, LINEBASES, LINEWIDTH (as `samtools faidx`)
+# plus SPAN, the number of bytes the sequence occupies. NAME is the protein id
+# `get_peptides` uses (the last `|` field of the first header word). Records whose
+# lines are not all the same width have LINEBASES 0 and are read by stripping each
+# of the lines in their SPAN bytes at both ends instead (spaces inside a line are kept,
+# as pyteomics does).
+FASTA_INDEX_EXT = ".mcidx"
+FASTA_INDEX_VERSION = "2"
+
+# Process-wide open readers keyed by FASTA path, modification time and size
+FASTA_INDEX_CACHE = {}
+
+
+def protein_id(header):
+    """Protein id of a FASTA header (without the leading `>`), as used in `pep_map` entries."""
+    return header.split(" ")[0].split("|")[-1]
+
+
+def index_path(fasta_path):
+    return fasta_path + FASTA_INDEX_EXT
+
+
+def scan_fasta(fasta_path):
+    """
+    Reads a FASTA file once and returns its index entries
+    `(name, length, offset, linebases, linewidth, span)` in file order.
+    Records follow `pyteomics.fasta.read`: blank lines are skipped, a trailing `*`
+    is dropped and a header without sequence lines merges into the next one.
+    """
+    entries = []
+    record = None
+
+    def _finish(record):
+        name, offset, lines, end, regular, last = record
+        length = sum(bases for bases, _ in lines)
+        if last == b"*":
+            length -= 1  # ✅ Translation stop sign, dropped like pyteomics does
+        linebases, linewidth = lines[0]
+        if any(line != (linebases, linewidth) for line in lines[:-1]) or lines[-1][0] > linebases:
+            regular = False
+        entries.append((name, length, offset, linebases if regular else 0, linewidth if regular else 0,
+                        end - offset))
+
+    with open(fasta_path, "rb") as f:
+        pos = 0
+        for line in f:
+            stripped = line.strip()
+            if stripped[:1] in (b">", b";"):
+                if record is not None and not record[2]:
+                    # ✅ A header without sequence continues the previous one, as in pyteomics
+                    record[1] = record[3] = pos + len(line)
+                    pos += len(line)
+                    continue
+                if record is not None:
+                    _finish(record)
+                header = stripped[1:].decode("utf-8", errors="replace")
+                record = [protein_id(header), pos + len(line), [], pos + len(line), True, b""]
+            elif record is not None:
+                if not stripped:
+                    record[4] = False  # blank line inside a record
+                else:
+                    if line.rstrip(b"\r\n") != stripped:
+                        record[4] = False  # leading or trailing spaces
+                    record[2].append((len(stripped), len(line)))
+                    record[5] = stripped[-1:]
+                record[3] = pos + len(line)
+            pos += len(line)
+        if record is not None and record[2]:
+            _finish(record)
+    return entries
+
+
+def _index_header(fasta_path):
+    stat = os.stat(fasta_path)
+    return ["#mcidx", FASTA_INDEX_VERSION, str(stat.st_size), str(stat.st_mtime_ns)]
+
+
+def write_fasta_index(fasta_path, entries):
+    path = index_path(fasta_path)
+    partial = path + ".partial"
+    with open(partial, "w") as f:
+        f.write("\t".join(_index_header(fasta_path)) + "\n")
+        for entry in entries:
+            f.write("\t".join(str(v) for v in entry) + "\n")
+    os.replace(partial, path)  # ✅ Other processes never read a half-written index
+    return path
+
+
+def read_fasta_index(fasta_path):
+    """
+    Index entries saved for `fasta_path`, or None if there is no index, it has
+    another format or version, or it was built for a different size or
+    modification time of the FASTA file.
+    """
+    path = index_path(fasta_path)
+    if not os.path.exists(path):
+        return None
+    entries = []
+    with open(path) as f:
+        if f.readline().rstrip("\n").split("\t") != _index_header(fasta_path):
+            return None
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 6:
+                return None
+            try:
+                entries.append((fields[0], *map(int, fields[1:])))
+            except ValueError:
+                return None
+    return entries
+
+
+def build_fasta_index(fasta_path):
+    """
+    Index entries of `fasta_path`, read from `<fasta>.mcidx` if it matches the FASTA
+    file, otherwise scanned and (if the folder is writable) saved there.
+    """
+    entries = read_fasta_index(fasta_path)
+    if entries is not None:
+        return entries
+    print(f"🗂 Indexing FASTA file {fasta_path}")
+    entries = scan_fasta(fasta_path)
+    try:
+        write_fasta_index(fasta_path, entries)
+    except OSError as e:
+        print(f"⚠ Could not save the FASTA index ({e}); keeping it in memory")
+    return entries
+
+
+class FastaIndex:
+    """
+    Random access to the proteins of a FASTA file through its offset index and a
+    read-only memory map: a sequence is sliced straight out of the file without
+    parsing it.
+    """
+
+    def __init__(self, fasta_path, entries=None):
+        self.fasta_path = fasta_path
+        self.entries = build_fasta_index(fasta_path) if entries is None else entries
+        self.positions = {}
+        for i, entry in enumerate(self.entries):
+            self.positions.setdefault(entry[0], i)  # ✅ Duplicate ids: the first record wins
+        self._file = open(fasta_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def names(self):
+        return [entry[0] for entry in self.entries]
+
+    def length(self, name):
+        return self.entries[self.positions[name]][1]
+
+    def _fetch(self, entry, start, end):
+        _, length, offset, linebases, linewidth, span = entry
+        start, end = max(start, 0), min(end, length)
+        if start >= end:
+            return ""
+        if linebases == 0:
+            # ✅ Like pyteomics: each line stripped at its ends, spaces inside a line kept
+            data = b"".join(line.strip() for line in self._map[offset:offset + span].splitlines())
+            return data[start:end].decode("ascii")
+        first = offset + start // linebases * linewidth + start % linebases
+        last = offset + (end - 1) // linebases * linewidth + (end - 1) % linebases
+        data = self._map[first:last + 1]
+        if end - start > linebases - start % linebases:
+            data = data.replace(b"\r", b"").replace(b"\n", b"")  # ✅ Crosses a line break
+        return data.decode("ascii")
+
+    def window(self, name, start, end):
+        """Residues `start` to `end` of a protein (0-based, end exclusive, clipped to the protein)."""
+        return self._fetch(self.entries[self.positions[name]], start, end)
+
+    def flanks(self, name, start, length, pad="_"):
+        """Residues before and after a peptide at `start`, as in `protein:start:pre:post` entries."""
+        return self.window(name, start - 1, start) or pad, self.window(name, start + length, start + length + 1) or pad
+
+    def sequence(self, name):
+        entry = self.entries[self.positions[name]]
+        return self._fetch(entry, 0, entry[1])
+
+    def records(self):
+        """All `(name, sequence)` records in file order, like `pyteomics.fasta.read`."""
+        for entry in self.entries:
+            yield entry[0], self._fetch(entry, 0, entry[1])
+
+
+def open_fasta_index(fasta_path):
+    """Shared `FastaIndex` of `fasta_path` for this process, reopened if the file changed."""
+    stat = os.stat(fasta_path)
+    key = (os.path.abspath(fasta_path), stat.st_mtime_ns, stat.st_size)
+    if key not in FASTA_INDEX_CACHE:
+        for old in [k for k in FASTA_INDEX_CACHE if k[0] == key[0]]:
+            FASTA_INDEX_CACHE.pop(old).close()
+        FASTA_INDEX_CACHE[key] = FastaIndex(fasta_path)
+    return FASTA_INDEX_CACHE[key]
+
+
+def fasta_index_for(sqlite_path):
+    """
+    Shared `FastaIndex` of the FASTA file a peptide database was digested from, or
+    None if the database does not record it, or the file is gone or has changed
+    since (its stored size and modification time no longer match).
+    """
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        meta = dict(conn.execute("SELECT name, value FROM meta WHERE name LIKE 'fasta_%';").fetchall())
+    except sqlite3.OperationalError:
+        meta = {}  # database from before the `meta` table
+    finally:
+        conn.close()
+    fasta_path = meta.get('fasta_path')
+    if fasta_path is None or not os.path.exists(fasta_path):
+        return None
+    stat = os.stat(fasta_path)
+    if meta.get('fasta_stat') != f"{stat.st_size}:{stat.st_mtime_ns}":
+        return None
+    return open_fasta_index(fasta_path)
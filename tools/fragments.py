@@ -0,0 +1,105 @@
+import sqlite3
+
+
+# Missed-cleavage fragment table written by `get_peptides` next to `peptides`: for
+# every digested peptide with exactly one missed cleavage site (by the compiled rule
+# of the database's enzyme, see `tools.enzymes`),
+# the two fully cleaved peptides it splits into at that site, whether each of them
+# is unique to one protein ("True", "False", or "NA" if it was not digested), and
+# the residues flanking the missed-cleavage peptide. QC resolves the MC1 peptides of
+# a sample with one join against it instead of slicing and probing `pep_map` per row.
+FRAGMENT_COLUMNS = ["mc_peptide", "site", "site_aa", "pep1", "pep2", "pep1_unique", "pep2_unique",
+                    "pre_aa", "post_aa"]
+
+FRAGMENT_SCHEMA = """
+CREATE TABLE fragments (
+    mc_peptide TEXT PRIMARY KEY,
+    site INTEGER,
+    site_aa TEXT,
+    pep1 TEXT,
+    pep2 TEXT,
+    pep1_unique TEXT,
+    pep2_unique TEXT,
+    pre_aa TEXT,
+    post_aa TEXT
+) WITHOUT ROWID;
+"""
+
+def _uniqueness(peptide, pep_map):
+    """`is_unique_peptide` as stored in the table."""
+    return "NA" if peptide not in pep_map else str(len(pep_map[peptide]) == 1)
+
+
+def fragment_rows(items, enzyme, pep_map=None):
+    """
+    Yields one fragment row per MC1 peptide of a digestion.
+    :param items: `(peptide, sorted protein entries)` pairs, as in the `peptides` table.
+    :param enzyme: `tools.enzymes.Enzyme` the peptides were digested with.
+    :param pep_map: peptide -> protein entries (as built by `get_peptides`) to look
+        the fragments' uniqueness up in; None leaves it to `fill_uniqueness`.
+    """
+    for peptide, proteins in items:
+        _, _, pre_aa, post_aa = proteins[0].rsplit(":", 3)
+        sites = enzyme.missed_cleavages(peptide, pre_aa, post_aa)
+        if len(sites) != 1:
+            continue
+        pos, aa = sites[0]
+        pep1, pep2 = peptide[:pos + 1], peptide[pos + 1:]
+        if pep_map is None:
+            uniq1 = uniq2 = None
+        else:
+            uniq1, uniq2 = _uniqueness(pep1, pep_map), _uniqueness(pep2, pep_map)
+        yield (peptide, pos, aa, pep1, pep2, uniq1, uniq2, pre_aa, post_aa)
+
+
+def fill_uniqueness(conn):
+    """Sets the fragments' uniqueness from the `peptides` table (out-of-core digestion)."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_peptides_peptide ON peptides(peptide);")
+    for column, fragment in (("pep1_unique", "pep1"), ("pep2_unique", "pep2")):
+        conn.execute(f"UPDATE fragments SET {column} = COALESCE((SELECT CASE WHEN INSTR(protein, ';') = 0 "
+                     f"THEN 'True' ELSE 'False' END FROM peptides WHERE peptide = fragments.{fragment}), 'NA');")
+
+
+def write_fragments(conn, enzyme, pep_map=None, batch_size=5000):
+    """
+    Writes the fragment table for the `peptides` table of the database; returns the
+    row count.
+    :param enzyme: `tools.enzymes.Enzyme` the peptides were digested with.
+    :param pep_map: In-memory peptide map of the digestion, if it was not spilled.
+    """
+    conn.execute("DROP TABLE IF EXISTS fragments;")
+    conn.execute(FRAGMENT_SCHEMA)
+    items = ((peptide, protein.split(";")) for peptide, protein in conn.execute("SELECT peptide, protein FROM peptides;"))
+    count = 0
+    batch = []
+    for row in fragment_rows(items, enzyme, pep_map):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.executemany("INSERT INTO fragments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO fragments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", batch)
+        count += len(batch)
+    if pep_map is None:
+        fill_uniqueness(conn)
+    conn.commit()
+    return count
+
+
+def fragments_for(sqlite_path, peptides):
+    """
+    Fragment rows of `peptides`, fetched with one join against a temporary table.
+    :return: List of row tuples in `FRAGMENT_COLUMNS` order, or None if the database
+        has no fragment table (digested before it existed).
+    """
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'fragments';").fetchone() is None:
+            return None
+        conn.execute("CREATE TEMP TABLE wanted (peptide TEXT PRIMARY KEY) WITHOUT ROWID;")
+        conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?);", ((p,) for p in peptides))
+        return conn.execute(f"SELECT {', '.join('f.' + c for c in FRAGMENT_COLUMNS)} "
+                            "FROM wanted w JOIN fragments f ON f.mc_peptide = w.peptide;").fetchall()
+    finally:
+        conn.close()
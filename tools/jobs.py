@@ -0,0 +1,88 @@
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from tools.progress import read_progress
+from tools.archive import ResultArchive, ArchivingProgress
+from tools.upload_store import UploadStore
+
+
+def run_job(param, zip_output_path):
+    """
+    Runs the pipeline in a worker process. Each stage's outputs are zipped as soon
+    as the stage finishes (only the `archive_parts` chosen in `param`).
+    Progress is written to `progress.json` so the page can poll it. The job fails
+    if any requested stage did not complete (e.g. some QC samples failed).
+    With `upload_store` set, the peptide database is taken from (or digested once
+    into) that shared store instead of being digested for this job.
+    :return: Path of the results archive.
+    """
+    from tools.pipeline import STAGES, run_pipeline, completed_stages  # ✅ Loaded in the job process only
+
+    output_dir = param['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    archive = ResultArchive(output_dir, zip_output_path, param.get('archive_parts'))
+    progress = ArchivingProgress(output_dir, STAGES, archive)
+    stages = None
+    try:
+        if param.get('upload_store'):
+            progress.stage("prepare", "running")
+            param['peptide_db'] = UploadStore(param['upload_store']).peptide_db(param)
+            progress.stage("prepare", "done")
+            stages = [s for s in STAGES if s != "prepare"]
+        run_pipeline(param, stages=stages, log=print, progress=progress)
+        # ✅ Failed QC samples, a skipped compare or an empty split do not raise; fail the job as `cli.run_study` does
+        missing = [s for s in stages or STAGES if s not in completed_stages(output_dir)]
+        if missing:
+            raise RuntimeError(f"stages not completed: {missing}")
+    except Exception as e:
+        archive.close()
+        progress.finish(error=e)
+        raise
+    archive.close()
+    progress.finish()
+    return zip_output_path
+
+
+class JobManager:
+    """
+    Runs pipeline jobs in background worker processes, at most `max_jobs` at a
+    time (further jobs wait in the queue). The Streamlit server only keeps the job
+    ID and polls `status`, so it is never blocked by a running pipeline.
+    """
+
+    def __init__(self, max_jobs=2):
+        self.max_jobs = max_jobs
+        # ✅ Spawn: never fork the Streamlit server with its running threads
+        self.executor = ProcessPoolExecutor(max_workers=max_jobs, mp_context=multiprocessing.get_context("spawn"))
+        self.jobs = {}
+
+    def submit(self, param, zip_output_path):
+        job_id = uuid.uuid4().hex
+        future = self.executor.submit(run_job, param, zip_output_path)
+        self.jobs[job_id] = {"future": future, "output_dir": param['output_dir'], "submitted": time.time()}
+        return job_id
+
+    def status(self, job_id):
+        """
+        :return: Dict with `state` (queued, running, done, failed or unknown), the
+            polled progress dict, the archive path once done, any error and the
+            job's `output_dir`.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return {"state": "unknown"}
+        future = job["future"]
+        progress = read_progress(job["output_dir"])
+        status = {"state": "queued", "progress": progress, "result": None, "error": None,
+                  "submitted": job["submitted"], "output_dir": job["output_dir"]}
+        if future.done():
+            error = future.exception()
+            status["state"] = "failed" if error else "done"
+            status["error"] = None if error is None else str(error)
+            status["result"] = None if error else future.result()
+        elif future.running() and progress is not None:
+            status["state"] = "running"
+        return status
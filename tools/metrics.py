@@ -0,0 +1,293 @@
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+
+METRICS_FILE = "metrics.json"
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size (MB) of this process and of its finished child processes
+    over their whole lifetime (`ru_maxrss` cannot be reset); the fallback where
+    `/proc` is not available.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)  # ru_maxrss is in KB on Linux
+
+
+def _status_kb(pid, field):
+    """A `VmRSS`/`VmHWM`-style field of `/proc/<pid>/status` in KB (None if gone)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_hwm():
+    """Resets this process's `VmHWM` to its current RSS. :return: False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _descendants(pid):
+    """PIDs of the live child processes of `pid` and of their children."""
+    pids = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return pids
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = [int(c) for c in f.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            pids.append(child)
+            pids.extend(_descendants(child))
+    return pids
+
+
+class RssSampler:
+    """
+    Peak RSS of this process and its worker processes while a stage runs. A
+    background thread reads (and resets) this process's `VmHWM` and reads the
+    `VmHWM` of every live child process every `interval` seconds, so the peak of
+    one stage is not hidden by an earlier stage's high-water mark. Open stages may
+    overlap; each one gets the peak over its own span.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peaks = {}  # token -> peak KB
+        self.thread = None
+
+    def _tick(self):
+        own = _status_kb("self", "VmHWM")
+        _reset_hwm()
+        kb = max([own or 0] + [_status_kb(pid, "VmHWM") or 0 for pid in _descendants(os.getpid())])
+        with self.lock:
+            for token in self.peaks:
+                self.peaks[token] = max(self.peaks[token], kb)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.peaks:
+                    self.thread = None
+                    return
+            self._tick()
+            time.sleep(self.interval)
+
+    def start(self):
+        """Starts tracking a stage. :return: Token for `stop`, or None without `/proc`."""
+        if not _reset_hwm():
+            return None
+        token = object()
+        with self.lock:
+            self.peaks[token] = _status_kb("self", "VmRSS") or 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return token
+
+    def stop(self, token):
+        """:return: Peak RSS (MB) since `start(token)`; the lifetime peak if `token` is None."""
+        if token is None:
+            return _peak_rss_mb()
+        self._tick()
+        with self.lock:
+            kb = self.peaks.pop(token)
+        return round(kb / 1024, 1)
+
+
+RSS_SAMPLER = RssSampler()
+
+
+def _cpu_seconds():
+    """CPU time (user + system) of this process and of its finished child processes."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def count_rows(path):
+    """Number of data rows in a delimited text file with a header line."""
+    with open(path, "rb") as f:
+        lines = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+    return max(lines - 1, 0)
+
+
+def _finish_entry(entry, wall, cpu, peak_rss_mb):
+    entry["wall_s"] = round(wall, 3)
+    entry["cpu_s"] = round(cpu, 3)
+    entry["peak_rss_mb"] = peak_rss_mb
+    if entry.get("rows") is not None and wall > 0:
+        entry["rows_per_s"] = round(entry["rows"] / wall, 1)
+    return entry
+
+
+def measure(func, *args, profile_path=None):
+    """
+    Calls `func(*args)` (typically inside a pool worker) and measures it.
+    :param profile_path: Optional path to dump a cProfile of the call to.
+    :return: `(result, stats)` with wall/CPU seconds and the peak RSS of the worker
+        during the call (`VmHWM` is reset first, so earlier samples of a reused
+        worker do not count; without `/proc`, the worker's lifetime peak).
+    """
+    profiler = cProfile.Profile() if profile_path else None
+    resettable = _reset_hwm()
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+    stats = {"wall_s": round(time.perf_counter() - wall, 3), "cpu_s": round(time.process_time() - cpu, 3),
+             "peak_rss_mb": round((_status_kb("self", "VmHWM") if resettable else
+                                   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024, 1)}
+    return result, stats
+
+
+def combine_stats(parts, wall_s=None):
+    """
+    Stats of a stage measured in several parts (see `measure`): the summed wall and CPU
+    seconds (`wall_s` instead when the parts ran in parallel) and the largest peak RSS.
+    """
+    parts = list(parts)
+    return {"wall_s": round(sum(p["wall_s"] for p in parts) if wall_s is None else wall_s, 3),
+            "cpu_s": round(sum(p["cpu_s"] for p in parts), 3),
+            "peak_rss_mb": max((p["peak_rss_mb"] for p in parts), default=None)}
+
+
+class Metrics:
+    """
+    Wall time, CPU time, peak RSS, rows processed and throughput of every stage and
+    every QC sample of one pipeline run, written to `metrics.json` in `output_dir`.
+    Peak RSS covers only the stage's own span, including its worker processes (see
+    `RssSampler`); where `/proc` is missing it is the process-lifetime peak.
+    With `profile_stage` set, that stage is also profiled with cProfile into
+    `profile_<stage>.prof` (for `qc`, one profile per sample from the workers).
+    """
+
+    def __init__(self, output_dir, profile_stage=None):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, METRICS_FILE)
+        self.profile_stage = profile_stage
+        self.data = {"started": time.time(), "stages": {}, "samples": {}}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def profile_path(self, stage, sample=None):
+        """Where to dump the cProfile of `stage` (None unless it is the profiled stage)."""
+        if stage != self.profile_stage:
+            return None
+        name = f"profile_{stage}" + (f"_{sample}" if sample else "") + ".prof"
+        return os.path.join(self.output_dir, name)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures the enclosed block as stage `name`. The yielded dict can be given a
+        `rows` count (and a `status`) before the block ends.
+        """
+        entry = {"status": "done", "rows": None}
+        profile_path = self.profile_path(name)
+        profiler = cProfile.Profile() if profile_path else None
+        rss = RSS_SAMPLER.start()
+        wall, cpu = time.perf_counter(), _cpu_seconds()
+        if profiler:
+            profiler.enable()
+        try:
+            yield entry
+        except Exception:
+            entry["status"] = "failed"
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(profile_path)
+                entry["profile"] = profile_path
+            # ✅ Worker pools are shut down inside the stage, so their CPU time is included
+            self.data["stages"][name] = _finish_entry(entry, time.perf_counter() - wall, _cpu_seconds() - cpu,
+                                                      RSS_SAMPLER.stop(rss))
+            self.save()
+
+    def stage_stats(self, name, stats, rows=None):
+        """Records stage `name` measured elsewhere, e.g. by `measure` in a worker process."""
+        entry = {"status": "done", "rows": rows, **stats}
+        if rows is not None and entry.get("wall_s"):
+            entry["rows_per_s"] = round(rows / entry["wall_s"], 1)
+        self.data["stages"][name] = entry
+        self.save()
+
+    def skipped(self, name):
+        self.data["stages"][name] = {"status": "skipped"}
+        self.save()
+
+    def sample(self, name, stats):
+        """Records the stats of one QC sample (see `qc.run_qc_sample`)."""
+        entry = dict(stats)
+        if entry.get("rows") is not None and entry["wall_s"] > 0:
+            entry["rows_per_s"] = round(entry["rows"] / entry["wall_s"], 1)
+        self.data["samples"][name] = entry
+        self.save()
+
+
+def read_metrics(output_dir):
+    path = os.path.join(output_dir, METRICS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def metrics_table(metrics):
+    """Stage rows of a metrics dict as a list of dicts for display."""
+    rows = []
+    for stage, entry in metrics["stages"].items():
+        rows.append({
+            "Stage": stage,
+            "Status": entry.get("status"),
+            "Wall (s)": entry.get("wall_s"),
+            "CPU (s)": entry.get("cpu_s"),
+            "Peak RSS (MB)": entry.get("peak_rss_mb"),
+            "Rows": entry.get("rows"),
+            "Rows/s": entry.get("rows_per_s"),
+        })
+    return rows
+
+
+class NullMetrics:
+    """Stand-in used when a stage runs outside the instrumented pipeline."""
+
+    def profile_path(self, stage, sample=None):
+        return None
+
+    def sample(self, name, stats):
+        pass
+
+    def stage_stats(self, name, stats, rows=None):
+        pass
@@ -0,0 +1,546 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+
+from tools.prepare import get_peptides, peptide_db_path, DIGEST_PARAMS
+from tools.split_dia import split_dia
+from tools.qc import qc_all, qc_function, merged_qc_path, start_merged_qc, append_merged_qc, run_qc_sample
+from tools.rollup import rollup_all, ROLLUP_DIR
+from tools.compare import compare_all, merge_qc, CompareAccumulator, sample_long_table, read_mc2
+from tools.plots import FigureRenderer, render_figures
+from tools.store import file_hash
+from tools.progress import NullProgress
+from tools.metrics import Metrics, NullMetrics, combine_stats, count_rows, measure
+from tools.budget import memory_budget, fasta_pep_map_mb, QC_EXPANSION
+
+
+# Pipeline stages in dependency order. Each stage is fingerprinted from the content
+# hashes of its inputs, the parameters it reads and the fingerprint of the stage it
+# depends on; a stage only re-runs when that fingerprint changes or its outputs are
+# missing. The manifest is rewritten after every stage (and every QC sample), so an
+# interrupted run resumes from the last completed step.
+STAGES = ["prepare", "split", "qc", "rollup", "compare"]
+
+STAGE_PARAMS = {
+    "prepare": DIGEST_PARAMS + ["enzymes"],
+    "split": [],
+    "qc": ["enzyme"],
+    "rollup": ["enzyme"],
+    "compare": ["compare_output", "incremental", "results_db"],
+    "figures": ["make_figures", "figures", "figure_dpi"],
+}
+
+MANIFEST = "pipeline_manifest.json"
+
+
+def _fingerprint(*parts):
+    h = hashlib.sha256()
+    h.update(json.dumps(parts, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _stage_param(param, stage):
+    return {k: param.get(k) for k in STAGE_PARAMS[stage]}
+
+
+class Manifest:
+    """
+    `pipeline_manifest.json` in `output_dir`: stage -> fingerprint of the inputs and
+    parameters it was last completed with, plus the status of every QC sample.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST)
+        self.data = {"stages": {}, "qc_samples": {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data = json.load(f)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)  # ✅ Never leave a half-written manifest
+
+    def is_current(self, stage, fingerprint):
+        return self.data["stages"].get(stage, {}).get("fingerprint") == fingerprint
+
+    def complete(self, stage, fingerprint):
+        self.data["stages"][stage] = {"fingerprint": fingerprint, "completed": time.time()}
+        self.save()
+
+    def invalidate(self, stage):
+        self.data["stages"].pop(stage, None)
+        self.save()
+
+
+def completed_stages(output_dir):
+    """Stages recorded as complete in the manifest of `output_dir`."""
+    return set(Manifest(output_dir).data["stages"])
+
+
+def _split_files(output_dir):
+    step1_dir = os.path.join(output_dir, "step1-split")
+    if not os.path.exists(step1_dir):
+        return []
+    return sorted(f for f in os.listdir(step1_dir) if f.endswith(".split.tsv"))
+
+
+def _qc_outputs_exist(output_dir, split_file):
+    base_name = re.sub('.split.tsv', '', split_file)
+    step2_dir = os.path.join(output_dir, "step2-qc")
+    return all(os.path.exists(os.path.join(step2_dir, base_name + suffix)) for suffix in ("_mc2.tsv", "_qc.tsv"))
+
+
+def _peptide_count(sqlite_path):
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM peptides;").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _mc2_rows(output_dir):
+    step2_dir = os.path.join(output_dir, "step2-qc")
+    return sum(count_rows(os.path.join(step2_dir, f)) for f in os.listdir(step2_dir) if f.endswith("_mc2.tsv"))
+
+
+def _concurrent_qc_plan(param):
+    """
+    `plan_qc` for `run_concurrent`, where neither the peptide database nor the split
+    files exist yet: the peptide map is estimated from the FASTA file and a sample
+    from the DIA report divided by its sample columns.
+    """
+    requested = int(param.get('workers', 4))
+    budget = memory_budget(param)
+    if not budget.limited:
+        return requested, "all"
+    with open(param['input_file']) as f:
+        n_samples = sum(1 for c in f.readline().split("\t") if re.search(r".PEP.Quantity", c))
+    sample_mb = os.path.getsize(param['input_file']) / (1 << 20) / max(n_samples, 1) * QC_EXPANSION
+    workers, scope = budget.qc_plan(requested, fasta_pep_map_mb(param['fasta_path']), sample_mb)
+    print(f"🧮 Memory budget {budget}: QC with {workers} workers, {scope} peptides per worker")
+    return workers, scope
+
+
+def run_concurrent(param, log=print, on_result=None, progress=None, metrics=None, on_prepared=None, prepare=True):
+    """
+    Runs the whole pipeline as a producer/consumer chain instead of stage by stage:
+    prepare (in its own process) and split run at the same time, each split sample
+    is handed to the QC pool as soon as both its file and the peptide database exist,
+    and compare consumes every QC result as it finishes.
+    :param param: Dictionary of parameters loaded from YAML.
+    :param prepare: False when the peptide database is already built (e.g. taken
+        from the upload store): QC then starts with the first split file.
+    :param log: Callback for progress messages (e.g. `st.write`).
+    :param on_result: Optional callback `on_result(file_name, result, error)` per QC sample.
+    :param progress: Optional `tools.progress.Progress` to report stage/sample progress.
+    :param metrics: Optional `tools.metrics.Metrics` to record per-sample timings.
+    :param on_prepared: Optional callback `on_prepared()` called once prepare and split
+        are done, to start work that only needs the peptide database (it must run
+        that work in its own pool so compare is not held up by it).
+    :return: List of logs/messages for Streamlit UI.
+    """
+    progress = progress or NullProgress()
+    metrics = metrics or NullMetrics()
+    output_dir = param['output_dir']
+    enzyme = param['enzyme']
+    step2_dir = os.path.join(output_dir, "step2-qc")
+    step3_dir = os.path.join(output_dir, "step3-compare")
+    os.makedirs(step2_dir, exist_ok=True)
+    os.makedirs(step3_dir, exist_ok=True)
+    sqlite_path = peptide_db_path(param)
+    workers, pep_map_scope = _concurrent_qc_plan(param)
+    incremental = param.get('incremental', False)
+    qc_job = qc_function(enzyme, pep_map_scope)
+    merged_path = merged_qc_path(output_dir)
+    start_merged_qc(merged_path)
+
+    logs = []
+    waiting = []  # split files waiting for the peptide database
+    qc_futures = {}
+    failed = []
+    # ✅ Stages overlap, so each is measured on its own: prepare in its worker, split and
+    # compare in this process, QC from its samples' stats
+    qc_started = []
+    qc_stats = []
+    compare_stats = []
+
+    # ✅ Figures render as soon as compare has written their tables
+    renderer = FigureRenderer(param, step3_dir)
+    acc = None
+    try:
+        budget = memory_budget(param)
+        if not incremental:
+            acc = CompareAccumulator(step3_dir, renderer, output=param.get('compare_output', "database"),
+                                     batch_size=budget.insert_batch() if budget.limited else None)
+
+        with ProcessPoolExecutor(max_workers=1) as prepare_pool, ProcessPoolExecutor(max_workers=workers) as qc_pool:
+            if prepare:
+                prepare_future = prepare_pool.submit(measure, get_peptides, param,
+                                                     profile_path=metrics.profile_path("prepare"))
+            else:
+                prepare_future = Future()
+                prepare_future.set_result((sqlite_path, None))
+
+            def _submit_ready():
+                # ✅ Never raises: a digestion error would otherwise surface inside split_dia's
+                # per-sample handling; it is raised once after split instead
+                if not prepare_future.done() or prepare_future.exception() is not None:
+                    return
+                if waiting and not qc_started:
+                    qc_started.append(time.perf_counter())
+                while waiting:
+                    path = waiting.pop(0)
+                    f = os.path.basename(path)
+                    profile_path = metrics.profile_path("qc", re.sub('.split.tsv', '', f))
+                    qc_futures[qc_pool.submit(run_qc_sample, qc_job, path, step2_dir, sqlite_path, enzyme, profile_path)] = f
+
+            def _on_split(path):
+                waiting.append(path)
+                _submit_ready()
+
+            if prepare:
+                log("⚡ Running Prepare and Split concurrently...")
+                progress.stage("prepare", "running")
+            else:
+                log("⚡ Running Split and QC concurrently on the existing peptide database...")
+            progress.stage("split", "running")
+            split_logs, stats = measure(functools.partial(split_dia, on_file=_on_split), param,
+                                        profile_path=metrics.profile_path("split"))
+            logs.extend(split_logs)
+            metrics.stage_stats("split", stats, rows=count_rows(param['input_file']))
+            progress.stage("split", "done")
+            log("✔ Split step completed!")
+            if prepare_future.exception() is not None:
+                progress.stage("prepare", "failed")
+                log(f"❌ Prepare step failed: {prepare_future.exception()}")
+            _, stats = prepare_future.result()  # ✅ Raise digestion errors before any QC starts
+            if prepare:
+                metrics.stage_stats("prepare", stats, rows=_peptide_count(sqlite_path))
+                progress.stage("prepare", "done")
+                log("✔ Prepare step completed!")
+            if on_prepared:
+                on_prepared()
+            _submit_ready()
+            progress.stage("qc", "running")
+            progress.samples_total(len(qc_futures))
+
+            log(f"📊 Running QC on {len(qc_futures)} samples; Compare consumes each result as it finishes...")
+            for future in as_completed(qc_futures):
+                f = qc_futures[future]
+                try:
+                    result, stats = future.result()
+                except Exception as e:
+                    error_msg = f"❌ Error processing {f}: {e}"
+                    logs.append(error_msg)
+                    log(error_msg)
+                    failed.append(f)
+                    progress.sample_done(failed=True)
+                    if on_result:
+                        on_result(f, None, e)
+                    continue
+                metrics.sample(f, stats)
+                qc_stats.append(stats)
+                append_merged_qc(merged_path, [result])
+                if acc is not None:
+                    mc2_path = os.path.join(step2_dir, result['sample_name'] + "_mc2.tsv")
+                    compare_stats.append(measure(lambda: acc.add(sample_long_table(read_mc2(mc2_path))))[1])
+                logs.append(f"✔ QC of {result['sample_name']} was added to {merged_path}")
+                progress.sample_done()
+                if on_result:
+                    on_result(f, result, None)
+
+        qc_wall = time.perf_counter() - qc_started[0] if qc_started else 0
+        metrics.stage_stats("qc", {**combine_stats(qc_stats, wall_s=qc_wall), "status": "failed" if failed else "done"},
+                            rows=sum(stats.get("rows", 0) for stats in qc_stats))
+        progress.stage("qc", "failed" if failed else "done")
+        progress.stage("compare", "running")
+        log("📈 Finishing Compare step...")
+
+        def _finish_compare():
+            if acc is not None:
+                acc.finish()
+                logs.extend(renderer.close())
+                acc.close()
+            else:
+                renderer.close()
+                logs.extend(compare_all(param))
+            merge_qc(param)
+
+        compare_stats.append(measure(_finish_compare, profile_path=metrics.profile_path("compare"))[1])
+        metrics.stage_stats("compare", combine_stats(compare_stats), rows=_mc2_rows(output_dir))
+        progress.stage("compare", "done")
+        if failed:
+            log(f"⚠ Compare outputs cover only the samples that passed QC; failed: {failed}")
+    finally:
+        renderer.close()  # ✅ Never leave the figure pool or the compare database open, even if a stage fails
+        if acc is not None:
+            acc.close()
+    return logs
+
+
+def run_pipeline(param, stages=None, force=False, log=print, progress=None):
+    """
+    Runs the pipeline stages in order, skipping every stage whose inputs and
+    parameters are unchanged since it last completed. Failed QC samples are retried
+    on the next run without re-running the samples that succeeded.
+    :param param: Dictionary of parameters loaded from YAML.
+    :param stages: Subset of `STAGES` to run (default: all).
+    :param force: Re-run every selected stage regardless of the manifest.
+    :param log: Callback for progress messages (e.g. `st.write`).
+    :param progress: Optional `tools.progress.Progress` to report stage/sample progress.
+    :return: List of logs/messages for Streamlit UI.
+
+    Wall/CPU time, peak RSS and throughput of every stage and QC sample are written
+    to `metrics.json` in `output_dir`; `profile_stage` names a stage to cProfile.
+    With `concurrent: True` and split out of date, the stages run overlapped through
+    `run_concurrent` (together with Prepare if it is requested and out of date, else
+    on the existing peptide database) and are then recorded in the manifest.
+    """
+    stages = stages or STAGES
+    progress = progress or NullProgress()
+    force = force or param.get('force', False)
+    output_dir = param['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(output_dir)
+    metrics = Metrics(output_dir, profile_stage=param.get('profile_stage'))
+    logs = []
+
+    def _log(msg):
+        logs.append(msg)
+        log(msg)
+
+    sqlite_path = peptide_db_path(param)
+    prepare_fp = _fingerprint(file_hash(param['fasta_path']), _stage_param(param, "prepare"))
+    qc_params = _stage_param(param, "qc")
+    samples = manifest.data["qc_samples"]
+
+    def _sample_fp(f):
+        return _fingerprint(file_hash(os.path.join(output_dir, "step1-split", f)), prepare_fp, qc_params)
+
+    def _record(f, result, error):
+        samples[f] = {"fingerprint": _sample_fp(f), "status": "ok" if error is None else "failed",
+                      "error": None if error is None else str(error)}
+        manifest.save()
+
+    def _rollup_fp():
+        return _fingerprint(file_hash(param['input_file']), prepare_fp, _stage_param(param, "rollup"))
+
+    def _run_rollup():
+        if not os.path.exists(sqlite_path):
+            _log("⚠ Missing peptide database; skipping Rollup step.")
+            progress.stage("rollup", "failed")
+            return
+        rollup_fp = _rollup_fp()
+        if (not force and manifest.is_current("rollup", rollup_fp)
+                and os.path.exists(os.path.join(output_dir, ROLLUP_DIR, "protein_mcr.tsv"))):
+            _log("⏭ Rollup step is up to date, skipping.")
+            progress.stage("rollup", "skipped")
+            metrics.skipped("rollup")
+            return
+        _log("🧬 Running Rollup step...")
+        progress.stage("rollup", "running")
+        manifest.invalidate("rollup")
+        with metrics.stage("rollup") as m:
+            logs.extend(rollup_all(param))
+            m["rows"] = count_rows(param['input_file'])
+        manifest.complete("rollup", rollup_fp)
+        progress.stage("rollup", "done")
+        _log("✔ Rollup step completed!")
+
+    # ✅ Rollup reads the DIA report and the peptide database directly, so in concurrent
+    # mode it runs in its own worker alongside QC and compare as soon as Prepare is done
+    rollup_future = []
+
+    def _start_rollup(pool):
+        _log("🧬 Running Rollup step alongside QC...")
+        progress.stage("rollup", "running")
+        rollup_future.append(pool.submit(measure, rollup_all, param, profile_path=metrics.profile_path("rollup")))
+
+    def _finish_rollup():
+        try:
+            rollup_logs, stats = rollup_future[0].result()
+        except Exception:
+            progress.stage("rollup", "failed")
+            metrics.stage_stats("rollup", {"status": "failed"})
+            raise
+        logs.extend(rollup_logs)
+        if metrics.profile_path("rollup"):
+            stats["profile"] = metrics.profile_path("rollup")
+        metrics.stage_stats("rollup", stats, rows=count_rows(param['input_file']))
+        manifest.complete("rollup", _rollup_fp())
+        progress.stage("rollup", "done")
+        _log("✔ Rollup step completed!")
+
+    # ✅ The chain needs every stage after Prepare; Prepare itself may come from a pre-built
+    # database (`run_job` with an upload store digests it before the pipeline starts)
+    chain = set(STAGES) - {"prepare"} <= set(stages)
+    if param.get('concurrent', False) and not chain:
+        _log("⚠ `concurrent` needs the split, qc, rollup and compare stages; running the stages one by one.")
+    if param.get('concurrent', False) and chain:
+        split_fp = _fingerprint(file_hash(param['input_file']), _stage_param(param, "split"))
+        prepare_stale = "prepare" in stages and (
+            force or not (manifest.is_current("prepare", prepare_fp) and os.path.exists(sqlite_path)))
+        split_stale = force or not (manifest.is_current("split", split_fp) and _split_files(output_dir))
+        if split_stale and (prepare_stale or os.path.exists(sqlite_path)):
+            if "prepare" in stages and not prepare_stale:
+                _log("⏭ Prepare step is up to date, skipping.")
+                progress.stage("prepare", "skipped")
+                metrics.skipped("prepare")
+            for stage in STAGES + ["figures"]:
+                if stage != "prepare" or prepare_stale:
+                    manifest.invalidate(stage)
+            # ✅ Under a memory budget Rollup waits for QC instead of competing with its workers
+            overlap_rollup = not memory_budget(param).limited
+            with ProcessPoolExecutor(max_workers=1) as rollup_pool:
+                # ✅ run_concurrent records prepare, split, qc and compare itself; the overall entry
+                # sums them (a stage sampler here would reset the peaks they measure)
+                started, status = time.perf_counter(), "failed"
+                try:
+                    logs.extend(run_concurrent(param, log=_log, on_result=_record, progress=progress, metrics=metrics,
+                                               on_prepared=(lambda: _start_rollup(rollup_pool)) if overlap_rollup else None,
+                                               prepare=prepare_stale))
+                    status = "done"
+                finally:
+                    parts = [entry for stage, entry in metrics.data["stages"].items()
+                             if stage in ("prepare", "split", "qc", "compare") and "wall_s" in entry]
+                    metrics.stage_stats("concurrent", {**combine_stats(parts, wall_s=time.perf_counter() - started),
+                                                       "status": status},
+                                        rows=sum(stats.get("rows", 0) for stats in metrics.data["samples"].values()))
+                if prepare_stale:
+                    manifest.complete("prepare", prepare_fp)
+                manifest.complete("split", split_fp)
+                if overlap_rollup:
+                    _finish_rollup()
+                else:
+                    _run_rollup()
+            qc_fp = _fingerprint(sorted(_sample_fp(f) for f in _split_files(output_dir)))
+            if all(samples.get(f, {}).get("status") == "ok" for f in _split_files(output_dir)):
+                compare_fp = _fingerprint(qc_fp, _stage_param(param, "compare"))
+                manifest.complete("qc", qc_fp)
+                manifest.complete("compare", compare_fp)
+                manifest.complete("figures", _fingerprint(compare_fp, _stage_param(param, "figures")))
+                _log("✅ Full pipeline completed!")
+            else:
+                _log("❌ Some QC samples failed; re-run to retry only those.")
+            return logs
+
+    # 🔹 Step 1: Prepare
+    if "prepare" in stages:
+        if not force and manifest.is_current("prepare", prepare_fp) and os.path.exists(sqlite_path):
+            _log("⏭ Prepare step is up to date, skipping.")
+            progress.stage("prepare", "skipped")
+            metrics.skipped("prepare")
+        else:
+            _log("🛠 Running Prepare step...")
+            progress.stage("prepare", "running")
+            manifest.invalidate("prepare")
+            with metrics.stage("prepare") as m:
+                get_peptides(param)
+                m["rows"] = _peptide_count(sqlite_path)
+            manifest.complete("prepare", prepare_fp)
+            progress.stage("prepare", "done")
+            _log("✔ Prepare step completed!")
+
+    # 🔹 Step 2: Split
+    if "split" in stages:
+        split_fp = _fingerprint(file_hash(param['input_file']), _stage_param(param, "split"))
+        if not force and manifest.is_current("split", split_fp) and _split_files(output_dir):
+            _log("⏭ Split step is up to date, skipping.")
+            progress.stage("split", "skipped")
+            metrics.skipped("split")
+        else:
+            _log("🔬 Running Split step...")
+            progress.stage("split", "running")
+            manifest.invalidate("split")
+            with metrics.stage("split") as m:
+                logs.extend(split_dia(param))
+                m["rows"] = count_rows(param['input_file']) if os.path.exists(param['input_file']) else 0
+            if not _split_files(output_dir):
+                progress.stage("split", "failed")
+                _log("❌ Split step produced no sample files!")
+                return logs
+            manifest.complete("split", split_fp)
+            progress.stage("split", "done")
+            _log("✔ Split step completed!")
+
+    # 🔹 Step 3: QC (tracked per sample)
+    sample_fps = {f: _sample_fp(f) for f in _split_files(output_dir)}
+    qc_fp = _fingerprint(sorted(sample_fps.values()))
+    if "qc" in stages:
+        todo = [f for f, fp in sample_fps.items()
+                if force or samples.get(f, {}).get("fingerprint") != fp
+                or samples[f].get("status") != "ok" or not _qc_outputs_exist(output_dir, f)]
+        if not todo and manifest.is_current("qc", qc_fp):
+            _log("⏭ QC step is up to date, skipping.")
+            progress.stage("qc", "skipped")
+            metrics.skipped("qc")
+        else:
+            _log(f"📊 Running QC step on {len(todo)} of {len(sample_fps)} samples...")
+            progress.stage("qc", "running")
+            progress.samples_total(len(todo))
+            manifest.invalidate("qc")
+            if todo:
+                all_samples = len(todo) == len(sample_fps)
+
+                def _on_qc(f, result, error):
+                    progress.sample_done(failed=error is not None)
+                    _record(f, result, error)
+
+                with metrics.stage("qc") as m:
+                    logs.extend(qc_all(param, files=None if all_samples else todo, on_result=_on_qc, metrics=metrics))
+                    m["rows"] = sum(metrics.data["samples"].get(f, {}).get("rows", 0) for f in todo)
+            failed = [f for f in sample_fps if samples.get(f, {}).get("status") != "ok"]
+            if failed:
+                progress.stage("qc", "failed")
+                _log(f"❌ QC failed for {len(failed)} samples; re-run to retry only those: {failed}")
+            else:
+                manifest.complete("qc", qc_fp)
+                progress.stage("qc", "done")
+                _log("✔ QC step completed!")
+
+    # 🔹 Step 4: Rollup
+    if "rollup" in stages:
+        _run_rollup()
+
+    # 🔹 Step 5: Compare
+    compare_fp = _fingerprint(qc_fp, _stage_param(param, "compare"))
+    figures_fp = _fingerprint(compare_fp, _stage_param(param, "figures"))
+    if "compare" in stages:
+        if not manifest.is_current("qc", qc_fp):
+            _log("⚠ QC is incomplete; skipping Compare step.")
+            progress.stage("compare", "failed")
+        elif not force and manifest.is_current("compare", compare_fp):
+            if manifest.is_current("figures", figures_fp):
+                _log("⏭ Compare step is up to date, skipping.")
+                progress.stage("compare", "skipped")
+                metrics.skipped("compare")
+            else:
+                # ✅ Only plotting options changed: re-render from the saved tables
+                _log("🎨 Re-rendering figures...")
+                progress.stage("compare", "running")
+                with metrics.stage("figures"):
+                    logs.extend(render_figures(param))
+                manifest.complete("figures", figures_fp)
+                progress.stage("compare", "done")
+                _log("✔ Figures updated!")
+        else:
+            _log("📈 Running Compare step...")
+            progress.stage("compare", "running")
+            manifest.invalidate("compare")
+            with metrics.stage("compare") as m:
+                logs.extend(compare_all(param))
+                merge_qc(param)
+                m["rows"] = _mc2_rows(output_dir)
+            manifest.complete("compare", compare_fp)
+            manifest.complete("figures", figures_fp)
+            progress.stage("compare", "done")
+            _log("✅ Full pipeline completed!")
+
+    return logs
@@ -0,0 +1,176 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from tools import store
+
+
+# Each figure is rendered from one table saved in `step3-compare`, so figures can
+# be (re)generated in a worker process without touching the compare data work.
+# figure name -> (render function name, source table, output file, default dpi)
+FIGURES = {
+    "histogram": ("render_histogram", "median_mcr", "histogram.png", 300),
+    "clustermap": ("render_clustermap", "wdf", "clustermap.png", None),
+    "clustermap_zscore": ("render_clustermap_zscore", "wdf", "clustermap_zscore.png", None),
+    "boxplot": ("render_boxplot", "rdf2", "boxplot.png", 300),
+    "violinplot": ("render_violinplot", "rdf", "violinplot.png", 300),
+    "heatmap_mc_aa_count": ("render_heatmap_mc_aa_count", "mc_aa_count", "heatmap_mc_aa_count.png", None),
+}
+
+
+def read_source(step3_dir, table_name, columns=None):
+    """
+    Reads a compare table from its CSV if it was written, otherwise from the
+    compare database.
+    """
+    csv_path = os.path.join(step3_dir, table_name + ".csv")
+    if os.path.exists(csv_path):
+        return pd.read_csv(csv_path, usecols=columns)
+    return store.read_compare_table(step3_dir, table_name, columns=columns)
+
+
+def source_exists(step3_dir, table_name):
+    return (os.path.exists(os.path.join(step3_dir, table_name + ".csv"))
+            or os.path.exists(store.compare_db_path(step3_dir)))
+
+
+def _pyplot():
+    # ✅ Headless backend: workers never have a display
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    return plt, sns
+
+
+def render_histogram(step3_dir, output_path, dpi=300):
+    plt, sns = _pyplot()
+    med_df = read_source(step3_dir, "median_mcr")
+    sns.histplot(list(med_df["Median.MCR"]))
+    plt.savefig(output_path, dpi=dpi, bbox_inches="tight")
+    plt.close()
+
+
+def render_clustermap(step3_dir, output_path, dpi=None, z_score=None):
+    plt, sns = _pyplot()
+    wdf = read_source(step3_dir, "wdf").set_index("MC_PEP")
+    g = sns.clustermap(wdf, cmap="vlag", center=0, figsize=(20, 8), z_score=z_score)
+    g.savefig(output_path, **({"dpi": dpi} if dpi else {}))
+    plt.close()
+
+
+def render_clustermap_zscore(step3_dir, output_path, dpi=None):
+    render_clustermap(step3_dir, output_path, dpi=dpi, z_score=0)
+
+
+def render_boxplot(step3_dir, output_path, dpi=300):
+    plt, sns = _pyplot()
+    rdf2 = read_source(step3_dir, "rdf2", columns=["Condition", "MCR"])
+    fig, ax = plt.subplots(figsize=(20, 8))
+    sns.boxplot(data=rdf2, x='Condition', y='MCR')
+    plt.xticks(rotation=90)
+    plt.savefig(output_path, dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+
+
+def render_violinplot(step3_dir, output_path, dpi=300):
+    plt, sns = _pyplot()
+    rdf = read_source(step3_dir, "rdf", columns=["Condition", "MCR"])
+    fig, ax = plt.subplots(figsize=(20, 8))
+    sns.violinplot(data=rdf, x='Condition', y='MCR', hue="Condition")
+    plt.xticks(rotation=90)
+    plt.savefig(output_path, dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+
+
+def render_heatmap_mc_aa_count(step3_dir, output_path, dpi=None):
+    plt, sns = _pyplot()
+    xdf = read_source(step3_dir, "mc_aa_count")
+    g = sns.clustermap(xdf.set_index(["Sample", "PRE_AA"]), cmap="vlag", center=0, figsize=(20, 8),
+                       row_cluster=False, col_cluster=False)
+    g.savefig(output_path, **({"dpi": dpi} if dpi else {}))
+    plt.close()
+
+
+def render_figure(name, step3_dir, dpi=None):
+    """
+    Renders a single figure from its saved source table. Runs inside a worker process.
+    :return: Log message for Streamlit UI.
+    """
+    func_name, source, output, default_dpi = FIGURES[name]
+    output_path = os.path.join(step3_dir, output)
+    globals()[func_name](step3_dir, output_path, dpi=dpi or default_dpi)
+    return f"✔ {name} was saved to {output_path}"
+
+
+def selected_figures(param):
+    """
+    Returns the figure names requested by `figures` in the YAML (default: all),
+    or an empty list when `make_figures` is False (table-only batch runs).
+    """
+    if not param.get('make_figures', True):
+        return []
+    names = param.get('figures') or list(FIGURES)
+    unknown = [n for n in names if n not in FIGURES]
+    if unknown:
+        raise ValueError(f"Unknown figure(s): {unknown}. Choose from {list(FIGURES)}")
+    return list(names)
+
+
+class FigureRenderer:
+    """
+    Process pool that renders figures while the compare stage keeps writing tables.
+    Call `table_written` after each table is saved; every selected figure that reads
+    that table is submitted right away. `close` waits for all renders and returns logs.
+    """
+
+    def __init__(self, param, step3_dir):
+        self.step3_dir = step3_dir
+        self.dpi = param.get('figure_dpi')
+        self.pending = selected_figures(param)
+        self.futures = {}
+        self.executor = None
+        if self.pending:
+            workers = int(param.get('figure_workers', min(len(self.pending), os.cpu_count() or 1)))
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def table_written(self, table_name):
+        if self.executor is None:
+            return
+        for name in [n for n in self.pending if FIGURES[n][1] == table_name]:
+            self.futures[self.executor.submit(render_figure, name, self.step3_dir, self.dpi)] = name
+            self.pending.remove(name)
+
+    def close(self):
+        logs = []
+        if self.executor is None:
+            return logs
+        for future in as_completed(self.futures):
+            try:
+                logs.append(future.result())
+            except Exception as e:
+                error_msg = f"❌ Error rendering {self.futures[future]}: {e}"
+                logs.append(error_msg)
+                print(error_msg)
+        self.executor.shutdown()
+        self.executor = None
+        return logs
+
+
+def render_figures(param):
+    """
+    Re-renders the selected figures from the tables already saved in `step3-compare`,
+    without recomputing the compare stage.
+    :param param: Dictionary of parameters loaded from YAML.
+    :return: List of logs/messages for Streamlit UI.
+    """
+    step3_dir = os.path.join(param['output_dir'], "step3-compare")
+    renderer = FigureRenderer(param, step3_dir)
+    logs = []
+    for table_name in {FIGURES[n][1] for n in renderer.pending}:
+        if source_exists(step3_dir, table_name):
+            renderer.table_written(table_name)
+        else:
+            logs.append(f"⚠ Missing `{table_name}`! Run 'Compare Task' first.")
+    return logs + renderer.close()
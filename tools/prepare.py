@@ -1,54 +1,261 @@
-from pyteomics import fasta, parser
 from tqdm import tqdm
+import hashlib
+import json
 import os
 import sqlite3
 
+from tools.budget import memory_budget, mapping_size_mb
+from tools.fasta_index import open_fasta_index
+from tools.enzymes import get_enzyme, enzyme_slug
+from tools.fragments import write_fragments
+
+# parameters that change the digested peptide database
+DIGEST_PARAMS = ["enzyme", "missed_cleavage", "min_length", "max_length", "m_cleavage"]
+
+
+def peptide_db_path(param):
+    """
+    Location of the digested peptide database: `peptide_db` if set (a database
+    shared between studies), otherwise `peptides.sqlite` in `output_dir`.
+    """
+    return param.get('peptide_db') or os.path.join(param['output_dir'], "peptides.sqlite")
+
+
+def enzyme_db_path(param, enzyme):
+    """
+    Peptide database of one enzyme of a run: `peptide_db_path` for `enzyme`, and
+    `<peptide db>.<enzyme>.sqlite` next to it for the extra `enzymes`.
+    """
+    path = peptide_db_path(param)
+    if enzyme == param['enzyme']:
+        return path
+    return f"{os.path.splitext(path)[0]}.{enzyme_slug(enzyme)}.sqlite"
+
+
+def run_enzymes(param):
+    """`enzyme` followed by the extra `enzymes` of a run, without duplicates."""
+    return list(dict.fromkeys([param['enzyme']] + list(param.get('enzymes') or [])))
+
+
+def digest_key(param):
+    """
+    Content key of a digestion: the FASTA contents plus the digestion parameters.
+    Two studies with the same key can share one peptide database.
+    """
+    h = hashlib.sha256()
+    with open(param['fasta_path'], "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(json.dumps({k: param.get(k) for k in DIGEST_PARAMS}, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def stored_digest_key(sqlite_path):
+    """
+    `digest_key` recorded in a peptide database, or None if the database is missing,
+    unfinished or from before the `meta` table.
+    """
+    if not os.path.exists(sqlite_path):
+        return None
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE name = 'digest_key';").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    finally:
+        conn.close()
+    return row and row[0]
+
+
+SPILL_SCHEMA = """
+CREATE TABLE peptide_hits (peptide TEXT, protein TEXT);
+CREATE TABLE peptide_known (peptide TEXT, protein TEXT);
+CREATE TABLE peptide_replaced (peptide TEXT, protein TEXT);
+"""
+
+# Everything spilled, merged back: all hits, the m_cleavage additions to peptides
+# found in the first pass, and the last replacement of each replaced peptide
+SPILL_MERGE_QUERY = """
+SELECT peptide, protein FROM peptide_hits WHERE peptide NOT IN (SELECT peptide FROM peptide_replaced)
+UNION
+SELECT peptide, protein FROM peptide_known WHERE peptide IN (SELECT peptide FROM peptide_hits)
+UNION
+SELECT peptide, protein FROM peptide_replaced r
+WHERE rowid = (SELECT MAX(rowid) FROM peptide_replaced WHERE peptide = r.peptide)
+ORDER BY peptide, protein;
+"""
+
+
+class PeptideMap:
+    """
+    Peptide -> set of `protein:start:pre:post` entries built while digesting.
+    With a `spill_mb` threshold (from `memory_budget`) the in-memory part is
+    flushed to a side SQLite file (`<peptide db>.spill`) whenever its estimated
+    size passes it, and `rows()` merges the spilled entries back on disk.
+    """
+
+    CHECK_EVERY = 20000  # entries added between two size estimates
+
+    def __init__(self, spill_path, spill_mb=None, batch_size=5000):
+        self.mem = {}
+        self.spill_path = spill_path
+        self.spill_mb = spill_mb
+        self.batch_size = batch_size
+        self.spill = None  # connection once spilled
+        self.pending = {"peptide_hits": [], "peptide_known": [], "peptide_replaced": []}
+        self._added = 0
+
+    @property
+    def spilled(self):
+        return self.spill is not None
+
+    def add(self, peptide, protein_info):
+        """First pass: records a protein entry of a peptide."""
+        if peptide in self.mem:
+            self.mem[peptide].add(protein_info)
+        else:
+            self.mem[peptide] = {protein_info}
+        self._grew()
+
+    def add_if_known(self, peptide, protein_info):
+        """m_cleavage pass: adds the entry only to peptides of the first pass."""
+        if peptide in self.mem:
+            self.mem[peptide].add(protein_info)
+        elif self.spilled:
+            self._pend("peptide_known", peptide, protein_info)  # ✅ Resolved when merging
+
+    def replace(self, peptide, protein_info):
+        """m_cleavage pass: replaces all entries of a peptide."""
+        if self.spilled:
+            self.mem.pop(peptide, None)
+            self._pend("peptide_replaced", peptide, protein_info)
+        else:
+            self.mem[peptide] = {protein_info}
+            self._grew()
+
+    def _grew(self):
+        self._added += 1
+        if self.spill_mb is not None and self._added % self.CHECK_EVERY == 0:
+            if mapping_size_mb(self.mem) > self.spill_mb:
+                self.flush()
+
+    def _pend(self, table, peptide, protein_info):
+        self.pending[table].append((peptide, protein_info))
+        if len(self.pending[table]) >= self.batch_size:
+            self._write(table)
+
+    def _write(self, table):
+        self.spill.executemany(f"INSERT INTO {table} VALUES (?, ?);", self.pending[table])
+        self.pending[table] = []
+
+    def flush(self):
+        """Moves the in-memory entries to the spill file."""
+        if not self.spilled:
+            if os.path.exists(self.spill_path):
+                os.remove(self.spill_path)
+            self.spill = sqlite3.connect(self.spill_path)
+            self.spill.executescript(SPILL_SCHEMA)
+            print(f"💾 Peptide map passed {self.spill_mb:,.0f} MB; spilling to {self.spill_path}")
+        for peptide, protein_set in self.mem.items():
+            for protein_info in protein_set:
+                self._pend("peptide_hits", peptide, protein_info)
+        self.mem = {}
+        for table in self.pending:
+            self._write(table)
+        self.spill.commit()
+
+    def __len__(self):
+        if not self.spilled:
+            return len(self.mem)
+        self.flush()
+        return self.spill.execute("SELECT COUNT(*) FROM (SELECT peptide FROM peptide_hits UNION "
+                                  "SELECT peptide FROM peptide_replaced);").fetchone()[0]
+
+    def rows(self):
+        """Yields `(peptide, sorted protein entries)` for every peptide."""
+        if not self.spilled:
+            for peptide, protein_set in self.mem.items():
+                yield peptide, sorted(protein_set)
+            return
+        self.flush()
+        self.spill.execute("CREATE INDEX IF NOT EXISTS idx_hits ON peptide_hits(peptide);")
+        self.spill.execute("CREATE INDEX IF NOT EXISTS idx_replaced ON peptide_replaced(peptide);")
+        peptide, proteins = None, []
+        for row_peptide, protein_info in self.spill.execute(SPILL_MERGE_QUERY):
+            if row_peptide != peptide:
+                if peptide is not None:
+                    yield peptide, proteins
+                peptide, proteins = row_peptide, []
+            proteins.append(protein_info)
+        if peptide is not None:
+            yield peptide, proteins
+
+    def close(self):
+        if self.spilled:
+            self.spill.close()
+            self.spill = None
+            os.remove(self.spill_path)
+
+
 def get_peptides(param):
     """
     Function to digest a FASTA file into peptides and store the results in an SQLite database.
-    Uses `pep_map` to maintain unique peptide-to-protein relationships while streaming data.
+    With `enzymes` set, those enzymes are digested in the same pass over the FASTA file,
+    each into its own database (see `enzyme_db_path`).
+    :return: Path of the database of `enzyme`.
     """
+    targets = {enzyme: enzyme_db_path(param, enzyme) for enzyme in run_enzymes(param)}
+    return digest_enzymes(param, targets)[param['enzyme']]
+
+
+def digest_enzymes(param, targets):
+    """
+    Digests a FASTA file for several enzymes in one pass over its proteins and stores
+    every enzyme's peptides in its own SQLite database.
+    Uses `pep_map` to maintain unique peptide-to-protein relationships while streaming data;
+    under a `memory_budget` it spills to disk instead of outgrowing its share.
+    :param targets: Enzyme name -> peptide database path.
+    :return: `targets`
+    """
+    from pyteomics import parser  # ✅ Only the Prepare stage needs pyteomics
 
     fasta_path = param['fasta_path']
     output_dir = param['output_dir']  # ✅ Ensure we use the same output directory
     os.makedirs(output_dir, exist_ok=True)  # ✅ Make sure the output directory exists
 
-    sqlite_path = os.path.join(output_dir, "peptides.sqlite")  # ✅ Store SQLite in output_dir
-    print(f"📂 Storing peptides in: {sqlite_path}")
+    for sqlite_path in targets.values():  # ✅ Store SQLite in output_dir (or the shared `peptide_db`)
+        os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+        print(f"📂 Storing peptides in: {sqlite_path}")
 
-    enzyme = param['enzyme']
+    # ✅ Compiled cleavage rules, the same ones QC detects missed cleavages with
+    enzymes = {name: get_enzyme(name) for name in targets}
     missed_cleavages = int(param['missed_cleavage'])
     min_length = int(param['min_length'])
     max_length = int(param['max_length'])
     m_cleavege = bool(param['m_cleavage'])
 
-    if enzyme == "trypsin/p":
-        enzyme = r'[KR]'
-
-    # ✅ Connect to SQLite and create table
-    conn = sqlite3.connect(sqlite_path)
-    cursor = conn.cursor()
-    cursor.execute("DROP TABLE IF EXISTS peptides;")
-    cursor.execute("CREATE TABLE peptides (peptide TEXT, protein TEXT);")
-    conn.commit()
-
     print("🔍 Reading FASTA file and processing proteins...")
+    proteins = open_fasta_index(fasta_path)  # ✅ Offset index + mmap: both passes read without parsing
 
-    pep_map = {}  # ✅ Store unique peptide-to-protein mappings
-    batch_data = []  # ✅ Store small batches before inserting into SQLite
-    batch_size = 5000  # ✅ Prevent memory overflow
+    budget = memory_budget(param)
+    batch_size = budget.insert_batch()  # ✅ Prevent memory overflow
+    spill_mb = budget.digest_spill_mb()
+    # ✅ Store unique peptide-to-protein mappings, one map per enzyme sharing the budget
+    pep_maps = {name: PeptideMap(path + ".spill", spill_mb=spill_mb and spill_mb / len(targets), batch_size=batch_size)
+                for name, path in targets.items()}
 
     # ✅ Process FASTA file
-    with fasta.read(fasta_path) as entries:
-        for header, sequence in tqdm(entries, desc="Processing Proteins"):
+    for protein, sequence in tqdm(proteins.records(), total=len(proteins), desc="Processing Proteins"):
+        for name, enzyme in enzymes.items():
+            pep_map = pep_maps[name]
             peptides = parser.xcleave(
                 sequence,
-                enzyme,
+                enzyme.rule,
                 missed_cleavages=missed_cleavages,
-                min_length=min_length
+                min_length=min_length,
+                regex=True
             )
 
-            protein = header.split(" ")[0].split("|")[-1]
             for start, peptide in peptides:
                 if len(peptide) <= max_length:
                     pre_aa = sequence[start - 1] if start > 0 else "_"
@@ -56,46 +263,65 @@ def get_peptides(param):
                     protein_info = f"{protein}:{start}:{pre_aa}:{post_aa}"
 
                     # ✅ Ensure uniqueness using `pep_map`
-                    if peptide in pep_map:
-                        pep_map[peptide].add(protein_info)
-                    else:
-                        pep_map[peptide] = {protein_info}
+                    pep_map.add(peptide, protein_info)
 
-    print(f"✅ Total unique peptides stored BEFORE m_cleavege: {len(pep_map)}")
+    for name, pep_map in pep_maps.items():
+        print(f"✅ Total unique {name} peptides stored BEFORE m_cleavege: {len(pep_map)}")
 
     # ✅ If `m_cleavege` flag is enabled, process again
     if m_cleavege:
         print("🔄 Running m_cleavage processing...")
 
-        with fasta.read(fasta_path) as entries:
-            for header, sequence in tqdm(entries, desc="Processing m_cleavege Proteins"):
+        for protein, sequence in tqdm(proteins.records(), total=len(proteins),
+                                      desc="Processing m_cleavege Proteins"):
+            for name, enzyme in enzymes.items():
+                pep_map = pep_maps[name]
                 peptides = parser.xcleave(
                     sequence[1:],  # Shift sequence by 1
-                    enzyme,
+                    enzyme.rule,
                     missed_cleavages=missed_cleavages,
-                    min_length=min_length
+                    min_length=min_length,
+                    regex=True
                 )
-                protein = header.split(" ")[0].split("|")[-1]
 
                 for start, peptide in peptides:
+                    # ✅ Every peptide gets the entry of its own protein and position
+                    pre_aa = sequence[start] if start > 0 else sequence[0]
+                    post_aa = sequence[start+1+len(peptide)] if start+1+len(peptide) < len(sequence) else "_"
+                    protein_info = f"{protein}:{start+1}:{pre_aa}:{post_aa}"
                     if len(peptide) <= max_length:
-                        pre_aa = sequence[start] if start > 0 else sequence[0]
-                        post_aa = sequence[start+1+len(peptide)] if start+1+len(peptide) < len(sequence) else "_"
-                        protein_info = f"{protein}:{start+1}:{pre_aa}:{post_aa}"
-
                         # ✅ Ensure uniqueness using `pep_map`
-                        if peptide in pep_map:
-                            pep_map[peptide].add(protein_info)
+                        pep_map.add_if_known(peptide, protein_info)
                     else:
-                        pep_map[peptide] = {protein_info}
+                        pep_map.replace(peptide, protein_info)
 
-    print(f"✅ Total unique peptides stored AFTER m_cleavege: {len(pep_map)}")
+        for name, pep_map in pep_maps.items():
+            print(f"✅ Total unique {name} peptides stored AFTER m_cleavege: {len(pep_map)}")
 
-    print("Writing peptides to SQLite...")
+    for name, sqlite_path in targets.items():
+        write_peptide_db({**param, 'enzyme': name}, enzymes[name], sqlite_path, pep_maps[name], batch_size)
+    return targets
+
+
+def write_peptide_db(param, enzyme, sqlite_path, pep_map, batch_size):
+    """Writes the peptides, fragments and meta tables of one enzyme's digestion."""
+    # ✅ Connect to SQLite and create table
+    conn = sqlite3.connect(sqlite_path)
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS peptides;")
+    cursor.execute("CREATE TABLE peptides (peptide TEXT, protein TEXT);")
+    cursor.execute("DROP TABLE IF EXISTS meta;")
+    cursor.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);")
+    conn.commit()
+
+    print(f"Writing {enzyme.name} peptides to SQLite...")
+    batch_data = []  # ✅ Store small batches before inserting into SQLite
 
     # ✅ Write Unique Peptides to SQLite in Batches
-    for peptide, protein_set in tqdm(pep_map.items(), desc="Inserting into SQLite"):
-        proteins_str = ";".join(sorted(protein_set))
+    peptide_count = 0
+    for peptide, protein_list in tqdm(pep_map.rows(), desc="Inserting into SQLite"):
+        proteins_str = ";".join(protein_list)
+        peptide_count += 1
         batch_data.append((peptide, proteins_str))
 
         if len(batch_data) >= batch_size:
@@ -108,10 +334,25 @@ def get_peptides(param):
         cursor.executemany("INSERT INTO peptides VALUES (?, ?);", batch_data)
         conn.commit()
 
+    # ✅ Precompute the MC1 fragments QC joins against
+    print("🧩 Writing missed-cleavage fragments...")
+    fragment_count = write_fragments(conn, enzyme, None if pep_map.spilled else pep_map.mem, batch_size)
+    print(f"✅ {fragment_count} missed-cleavage fragments written.")
+
+    # ✅ Lets `qc.load_pep_map` recognise the same digestion across databases
+    cursor.execute("INSERT INTO meta VALUES ('digest_key', ?);", (digest_key(param),))
+    # ✅ Lets `fasta_index.fasta_index_for` open the FASTA for QC's flanking residue lookups
+    fasta_stat = os.stat(param['fasta_path'])
+    cursor.execute("INSERT INTO meta VALUES ('fasta_path', ?);", (os.path.abspath(param['fasta_path']),))
+    cursor.execute("INSERT INTO meta VALUES ('fasta_stat', ?);", (f"{fasta_stat.st_size}:{fasta_stat.st_mtime_ns}",))
+    cursor.execute("INSERT INTO meta VALUES ('enzyme', ?);", (enzyme.name,))
+    cursor.execute("INSERT INTO meta VALUES ('cleavage_rule', ?);", (enzyme.pattern,))
+    conn.commit()
     conn.close()
+    pep_map.close()
 
     print(f"✅ Peptides written to `{sqlite_path}`.")
-    print(f"📊 Final database contains {len(pep_map)} peptides.")
+    print(f"📊 Final database contains {peptide_count} peptides.")
     print(f"📁 SQLite file size: {os.path.getsize(sqlite_path) / 1024:.2f} KB")
 
-    return sqlite_path  # ✅ Return SQLite path (no separate temp_dir needed)
+    return sqlite_path
@@ -0,0 +1,103 @@
+import json
+import os
+import time
+
+
+PROGRESS_FILE = "progress.json"
+
+
+class Progress:
+    """
+    Per-stage and per-sample progress of one pipeline run, written atomically to
+    `progress.json` in `output_dir` so another process (the Streamlit page) can poll it.
+    """
+
+    def __init__(self, output_dir, stages):
+        self.path = os.path.join(output_dir, PROGRESS_FILE)
+        self.data = {
+            "started": time.time(),
+            "updated": time.time(),
+            "status": "running",
+            "stages": {stage: {"status": "pending"} for stage in stages},
+            "samples": {"total": 0, "done": 0, "failed": 0, "started": None},
+            "error": None,
+        }
+        self.save()
+
+    def save(self):
+        self.data["updated"] = time.time()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def stage(self, name, status):
+        """Marks a stage as running, done, skipped or failed."""
+        entry = self.data["stages"].setdefault(name, {})
+        entry["status"] = status
+        entry["running" if status == "running" else "finished"] = time.time()
+        self.save()
+
+    def samples_total(self, total):
+        self.data["samples"].update(total=total, done=0, failed=0, started=time.time())
+        self.save()
+
+    def sample_done(self, failed=False):
+        self.data["samples"]["failed" if failed else "done"] += 1
+        self.save()
+
+    def finish(self, error=None):
+        self.data["status"] = "failed" if error else "done"
+        self.data["error"] = None if error is None else str(error)
+        self.save()
+
+
+def read_progress(output_dir):
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def summarize(progress):
+    """
+    Overall completion (0-1) and ETA in seconds (None if unknown) from a progress
+    dict. Every stage counts equally; QC counts by the fraction of samples finished.
+    """
+    stages = progress["stages"]
+    samples = progress["samples"]
+    finished = {"done", "skipped"}
+    completed = 0.0
+    for name, entry in stages.items():
+        if entry["status"] in finished:
+            completed += 1
+        elif name == "qc" and entry["status"] == "running" and samples["total"]:
+            completed += (samples["done"] + samples["failed"]) / samples["total"]
+    fraction = completed / len(stages) if stages else 0.0
+
+    eta = None
+    elapsed = time.time() - progress["started"]
+    sample_count = samples["done"] + samples["failed"]
+    if stages.get("qc", {}).get("status") == "running" and sample_count and samples["started"]:
+        per_sample = (time.time() - samples["started"]) / sample_count
+        eta = per_sample * (samples["total"] - sample_count)
+    elif 0 < fraction < 1:
+        eta = elapsed / fraction * (1 - fraction)
+    return fraction, eta
+
+
+class NullProgress:
+    """Stand-in used when nobody is polling the run."""
+
+    def stage(self, name, status):
+        pass
+
+    def samples_total(self, total):
+        pass
+
+    def sample_done(self, failed=False):
+        pass
+
+    def finish(self, error=None):
+        pass
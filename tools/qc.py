@@ -1,14 +1,129 @@
 import pandas as pd
 import os,re,sys
-import yaml
 from tqdm import tqdm
 import sqlite3
 import gc
+import functools
+from collections import OrderedDict
+
+from tools.prepare import peptide_db_path
+from tools.fasta_index import fasta_index_for
+from tools.fragments import FRAGMENT_COLUMNS, fragments_for
+from tools.metrics import measure, count_rows, NullMetrics
+from tools.budget import memory_budget, mapping_size_mb, pep_map_estimate_mb, qc_sample_mb
+from tools.enzymes import get_enzyme
 
 
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
+# Fixed schema of `merged_qc.tsv`: the union of the columns written by `qc_one`
+# and `qc_one_trypsinp` (the trypsin/p-only columns are left empty otherwise).
+QC_COLUMNS = [
+    'sample_name', 'peptide_count', 'protein_count', 'protein_human_count', 'protein_mouse_count',
+    'mc_pep_count_withP', 'mc_pep_count', 'mcr_pep', 'ratio_peptide_uniquness',
+    'ratio_multiproteins_in_group', 'ratio_uniquness_mc1_peptide', 'sum_mc_pep_quant', 'sum_pep_quant',
+    'mcr_pep_quant', 'ratio_mc1_and_uniq_peptide', 'mc1_peptide_count', 'mc2_peptide_count',
+    'mc100_pep_count', 'mc100_pep_count_len',
+]
+
+
+def merged_qc_path(output_dir):
+    return os.path.join(output_dir, "step3-compare", "merged_qc.tsv")
+
+
+def start_merged_qc(path):
+    """Creates `merged_qc.tsv` with only the header row, replacing any previous one."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(columns=QC_COLUMNS).to_csv(path, sep="\t", index=False)
+
+
+def drop_merged_qc(path, samples):
+    """Removes the rows of `samples` from `merged_qc.tsv` before they are re-run."""
+    if not os.path.exists(path):
+        start_merged_qc(path)
+        return
+    merged = pd.read_csv(path, sep="\t", dtype={'sample_name': str})
+    merged[~merged['sample_name'].isin(samples)].to_csv(path, sep="\t", index=False)
+
+
+def append_merged_qc(path, rows):
+    """
+    Appends per-sample QC rows (dicts or a DataFrame) to `merged_qc.tsv` using the
+    fixed `QC_COLUMNS` schema.
+    """
+    if not os.path.exists(path):
+        start_merged_qc(path)
+    df = pd.DataFrame(rows)
+    extra = [c for c in df.columns if c not in QC_COLUMNS]
+    if extra:
+        print(f"⚠ Ignoring unknown QC columns: {extra}")
+    df.reindex(columns=QC_COLUMNS).to_csv(path, sep="\t", index=False, header=False, mode="a")
+
+
+# Process-wide cache of loaded peptide maps, keyed by the digest key stored in the
+# peptide database (FASTA contents + digestion parameters), so repeat runs in the
+# same process (a job worker of the Streamlit server, a QC worker handling several
+# samples) skip reading and parsing the whole `peptides` table. Least recently used
+# maps are dropped once the estimated size exceeds `MC_PARSER_PEP_MAP_CACHE_MB`.
+PEP_MAP_CACHE = OrderedDict()
+PEP_MAP_CACHE_MB = float(os.environ.get("MC_PARSER_PEP_MAP_CACHE_MB", 2048))
+
+
+def _pep_map_key(sqlite_path):
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE name = 'digest_key';").fetchone()
+    except sqlite3.OperationalError:
+        row = None  # database from before the `meta` table
+    finally:
+        conn.close()
+    if row is not None:
+        return row[0]
+    stat = os.stat(sqlite_path)
+    return f"{os.path.abspath(sqlite_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def load_pep_map(sqlite_path, peptides=None):
+    """
+    Peptide -> list of `protein:start:pre:post` entries from the peptide database,
+    served from the process-wide cache when the same digestion was loaded before.
+    :param peptides: Optional peptides to load only (the out-of-core `"sample"` scope
+        of a memory budget); such partial maps are never cached.
+    """
+    if peptides is not None:
+        conn = sqlite3.connect(sqlite_path)
+        try:
+            conn.execute("CREATE TEMP TABLE wanted (peptide TEXT PRIMARY KEY) WITHOUT ROWID;")
+            conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?);", ((p,) for p in peptides))
+            rows = conn.execute("SELECT p.peptide, p.protein FROM peptides p "
+                                "JOIN wanted w ON w.peptide = p.peptide;").fetchall()
+        finally:
+            conn.close()
+        return {peptide: protein.split(";") for peptide, protein in rows}
+
+    key = _pep_map_key(sqlite_path)
+    if key in PEP_MAP_CACHE:
+        PEP_MAP_CACHE.move_to_end(key)
+        return PEP_MAP_CACHE[key][0]
+
+    print(f"Fetch the protein information for each peptide from {sqlite_path}")
+    conn = sqlite3.connect(sqlite_path)
+    rows = conn.execute("SELECT peptide, protein FROM peptides").fetchall()
+    conn.close()
+    pep_map = {peptide: protein.split(";") for peptide, protein in rows}
+    del rows
+
+    size_mb = mapping_size_mb(pep_map)
+    if size_mb <= PEP_MAP_CACHE_MB:
+        PEP_MAP_CACHE[key] = (pep_map, size_mb)
+        while sum(size for _, size in PEP_MAP_CACHE.values()) > PEP_MAP_CACHE_MB:
+            PEP_MAP_CACHE.popitem(last=False)
+    return pep_map
+
+
+TRYPSIN_P = get_enzyme("trypsin/p")
+
 
 def is_unique_peptide(peptide, pep_map):
     if peptide not in pep_map:
@@ -18,51 +133,76 @@ def is_unique_peptide(peptide, pep_map):
     else:
         return False
 
-# calculate Missed Cleavage Rate (MCR) for single table (sample)
-def check_missed_cleavages(sequence, target_AAs = "KR", pos=1, omit_AAs = "P"):
-    target_aa_list = list(target_AAs)
-    omit_aa_list = list(omit_AAs)
-    sequence = list(sequence)
-    mc_list = []
-    if pos == 1:
-        for i, aa in enumerate(sequence):
-            if aa in target_aa_list:
-                if i < len(sequence) - 1 and sequence[i + pos] not in omit_aa_list:
-                    mc_list.append(i)
-    elif pos == -1:
-        for i, aa in enumerate(sequence):
-            if i == 0 :
-                continue
-            if aa in target_aa_list:
-                if i < len(sequence) and sequence[i + pos] not in omit_aa_list:
-                    mc_list.append(i)
-                    
-    return mc_list
-
-def check_missed_cleavages_for_trypsin(sequence,pep_map):
-    
-    mc_list = []
+def check_missed_cleavages_for_enzyme(sequence, pep_map, enzyme, fasta_index=None):
+    """
+    Missed cleavage sites `(i, next_aa)` of a digested peptide under the compiled
+    rule of `enzyme` (see `tools.enzymes`), using the residues flanking its first
+    protein entry. Peptides missing from `pep_map` have none.
+    :param fasta_index: Optional `FastaIndex` of the digested FASTA; the flanking residues
+        are then read from the protein itself, the stored ones are the fallback.
+    """
     if sequence not in pep_map:
-        return mc_list
-    
-    proteins = pep_map.get(sequence,"")
-    proteins = [i.split(":") for i in proteins] 
-    sequence = list(sequence)
-    for i,aa in enumerate(sequence):
-        if i == 0 and sequence[0] in ["K","R"] and proteins[0][2] in ["K","R"]:
-            continue
-        elif i == len(sequence) - 2 and sequence[-1] in ["K","R"] and sequence[-2] in ["K","R"]:
-            continue
-        elif aa in ['K',"R"] and i < len(sequence) - 1:
-            mc_list.append((i,sequence[i+1]))
-    return mc_list
+        return []
+    protein, start, pre_aa, post_aa = pep_map[sequence][0].rsplit(":", 3)  # ✅ Protein ids may contain ":"
+    if fasta_index is not None and protein in fasta_index:
+        pre_aa, post_aa = fasta_index.flanks(protein, int(start), len(sequence))
+    return enzyme.missed_cleavages(sequence, pre_aa, post_aa)
+
+def check_missed_cleavages_for_trypsin(sequence,pep_map, fasta_index=None):
+    return check_missed_cleavages_for_enzyme(sequence, pep_map, TRYPSIN_P, fasta_index)
 
  
 
-def qc_all(param):
+def qc_function(enzyme, pep_map_scope="all"):
+    """
+    Returns the per-sample QC job for an enzyme.
+    :param pep_map_scope: "all" (the whole cached peptide map) or "sample" (only the
+        peptides of each sample, see `MemoryBudget.qc_plan`).
+    """
+    qc_job = qc_one_trypsinp if get_enzyme(enzyme).name == "trypsin/p" else qc_one  # ✅ Any spelling or alias
+    return qc_job if pep_map_scope == "all" else functools.partial(qc_job, pep_map_scope=pep_map_scope)
+
+
+def sample_peptides(df, pep_map_scope):
+    """Peptides to load for a sample: None (the whole map) unless the scope is "sample"."""
+    return None if pep_map_scope == "all" else df['PEP.StrippedSequence'].dropna().unique()
+
+
+def plan_qc(param, sqlite_path, sample_paths):
+    """
+    Worker count and peptide map scope of a QC run under `memory_budget`.
+    :return: `(workers, pep_map_scope, message)`
+    """
+    requested = int(param.get('workers', 4))  # Default to 4 workers if not specified
+    budget = memory_budget(param)
+    if not budget.limited:
+        return requested, "all", f"🚀 Running QC with {requested} workers..."
+    pep_map_mb = pep_map_estimate_mb(sqlite_path)
+    workers, scope = budget.qc_plan(requested, pep_map_mb, qc_sample_mb(sample_paths))
+    return workers, scope, (f"🚀 Running QC with {workers} workers (memory budget {budget}, "
+                            f"peptide map ~{pep_map_mb:,.0f} MB, {scope} peptides per worker)...")
+
+
+def run_qc_sample(qc_job, path, output_dir, sqlite_path, enz, profile_path=None):
+    """
+    Runs one QC job in a pool worker and measures it.
+    :return: `(result, stats)`; `stats` holds wall/CPU time, peak RSS and the
+        number of peptide rows in the split file.
+    """
+    result, stats = measure(qc_job, path, output_dir, sqlite_path, enz, profile_path=profile_path)
+    stats["rows"] = count_rows(path)
+    return result, stats
+
+
+def qc_all(param, files=None, on_result=None, metrics=None):
     """
     Function to run QC on all split files.
     :param param: Dictionary of parameters loaded from YAML.
+    :param files: Optional subset of `.split.tsv` file names to (re-)run; their old
+        rows in `merged_qc.tsv` are replaced, the other samples are kept.
+    :param on_result: Optional callback `on_result(file_name, result, error)` called
+        in the main process as each sample finishes (`error` is None on success).
+    :param metrics: Optional `tools.metrics.Metrics` to record per-sample timings.
     :return: List of logs/messages for Streamlit UI.
     """
 
@@ -83,7 +223,7 @@ def qc_all(param):
         return logs
 
     # ✅ Ensure SQLite database exists
-    sqlite_path = os.path.join(output_dir, "peptides.sqlite")
+    sqlite_path = peptide_db_path(param)
     if not os.path.exists(sqlite_path):
         error_msg = "❌ Error: Missing `peptides.sqlite`! Run 'Prepare Task' first."
         logs.append(error_msg)
@@ -91,7 +231,9 @@ def qc_all(param):
         return logs
 
     # ✅ List all split files
-    files = [f for f in os.listdir(step1_dir) if f.endswith(".split.tsv")]
+    subset = files is not None
+    if not subset:
+        files = [f for f in os.listdir(step1_dir) if f.endswith(".split.tsv")]
 
     if not files:
         warning_msg = "⚠ No split files found! Skipping QC."
@@ -99,31 +241,45 @@ def qc_all(param):
         print(warning_msg)
         return logs
 
-    workers = int(param.get('workers', 4))  # Default to 4 workers if not specified
-    logs.append(f"🚀 Running QC with {workers} workers...")
+    workers, pep_map_scope, msg = plan_qc(param, sqlite_path, [os.path.join(step1_dir, f) for f in files])
+    logs.append(msg)
+    print(msg)
+
+    # ✅ Each finished sample is appended to the merged QC table right away
+    merged_path = merged_qc_path(output_dir)
+    if subset:
+        drop_merged_qc(merged_path, [re.sub('.split.tsv', '', f) for f in files])
+    else:
+        start_merged_qc(merged_path)
+
+    # ✅ Load the peptide map once here; forked workers inherit the cached copy
+    if pep_map_scope == "all":
+        load_pep_map(sqlite_path)
 
     # ✅ Run QC in parallel using ProcessPoolExecutor
-    futures = []
+    futures = {}
+    qc_job = qc_function(enzyme, pep_map_scope)
+    metrics = metrics or NullMetrics()
     with ProcessPoolExecutor(max_workers=workers) as executor:
-        if enzyme == "trypsin/p":
-            for f in files:
-                futures.append(
-                    executor.submit(qc_one_trypsinp, os.path.join(step1_dir, f), step2_dir, sqlite_path, enzyme)
-                )
-        else:
-            for f in files:
-                futures.append(
-                    executor.submit(qc_one, os.path.join(step1_dir, f), step2_dir, sqlite_path, enzyme)
-                )
+        for f in files:
+            profile_path = metrics.profile_path("qc", re.sub('.split.tsv', '', f))
+            futures[executor.submit(run_qc_sample, qc_job, os.path.join(step1_dir, f), step2_dir, sqlite_path,
+                                    enzyme, profile_path)] = f
 
         for future in as_completed(futures):
             try:
-                result = future.result()  # Catch errors
-                logs.append(result)
+                result, stats = future.result()  # Catch errors
+                metrics.sample(futures[future], stats)
+                append_merged_qc(merged_path, [result])
+                logs.append(f"✔ QC of {result['sample_name']} was added to {merged_path}")
+                if on_result:
+                    on_result(futures[future], result, None)
             except Exception as e:
-                error_msg = f"❌ Error processing a file: {e}"
+                error_msg = f"❌ Error processing {futures[future]}: {e}"
                 logs.append(error_msg)
                 print(error_msg)
+                if on_result:
+                    on_result(futures[future], None, e)
 
     logs.append(f"✅ QC completed. Output stored in `{step2_dir}`")
     print(f"✅ QC completed. Output stored in `{step2_dir}`")
@@ -171,33 +327,49 @@ def calc_quant_for_fragment_pep(df_mc, pep_map, pep_quant_map, sample):
     df_mc2 = pd.DataFrame(rows)
     return df_mc2
 
-
-def qc_one_trypsinp(path, output_dir,sqlite_path, enz):
-    
-    # Connect to the SQLite database
-    print(f"Fetch the protein information for each peptide from {sqlite_path}")
-    conn = sqlite3.connect(sqlite_path)
-    cursor = conn.cursor()
-    
-    # peptide_list = list(df_nodup['PEP.StrippedSequence'])
-    # placeholders = ','.join('?' for _ in peptide_list)
-    # query = f"SELECT peptide, protein FROM peptides WHERE peptide IN ({placeholders})"
-    
-    # Execute the query with the peptide list as parameters
-    # cursor.execute(query, peptide_list)
-    
-    cursor.execute("SELECT peptide, protein FROM peptides")
-
-    rows = cursor.fetchall()
-
-    # Convert the results into a dictionary (if each peptide is unique)
-    pep_map = {peptide: protein.split(";") for peptide, protein in tqdm(rows)}
-
-    # Close the connection
-    conn.close()
-    
+def join_fragments(df_mc, fragments, pep_quant_map, sample):
+    """
+    Same columns as `calc_quant_for_fragment_pep`, but the fragments and their
+    uniqueness come from the precomputed fragment table and the quantities are
+    looked up column-wise instead of row by row.
+    :param fragments: Rows from `fragments_for` for the peptides of `df_mc`.
+    """
+    fragments = pd.DataFrame(fragments, columns=FRAGMENT_COLUMNS).set_index('mc_peptide')
+    joined = fragments.reindex(df_mc['PEP.StrippedSequence'].values)
+    df_mc2 = df_mc.copy()
+
+    uniq = {'True': True, 'False': False, 'NA': 'NA'}  # ✅ Values `is_unique_peptide` returns
+    values = []
+    for n, col in ((1, 'pep1'), (2, 'pep2')):
+        pep = joined[col].values
+        pep_uniq = joined[col + '_unique'].map(uniq).values
+        # ✅ Missing quantities stay int 0, as with `pep_quant_map.get(pep, 0)`
+        pep_quant = pd.Series(pep).map(pep_quant_map).astype(object)
+        pep_quant = pep_quant.where(pep_quant.notna(), 0).values
+        df_mc2[f'PEP.{n}'] = pep
+        values.append(pd.Series([q if u == True and q > 0 else 0 for u, q in zip(pep_uniq, pep_quant)],
+                                dtype=object))
+        df_mc2[f'PEP.{n}.Uniquness'] = pep_uniq
+        df_mc2[f'PEP.{n}.Quantity'] = pep_quant
+    df_mc2 = df_mc2[list(df_mc.columns) + ['PEP.1', 'PEP.2', 'PEP.1.Uniquness', 'PEP.2.Uniquness',
+                                           'PEP.1.Quantity', 'PEP.2.Quantity']]
+
+    max_value = [max(v1, v2) for v1, v2 in zip(*values)]
+    df_mc2['NMC.PEP.Quantity'] = pd.Series(max_value, index=df_mc2.index, dtype=object)
+    df_mc2['Missed.Cleavage.Ratio'] = pd.Series(
+        [q / (m + q) * 100 if m > 0 else 100 for q, m in zip(df_mc2[sample].values, max_value)],
+        index=df_mc2.index, dtype=object)
+    return df_mc2.infer_objects()  # ✅ Same dtype inference as building from rows
+
+
+def qc_one_trypsinp(path, output_dir,sqlite_path, enz, pep_map_scope="all"):
     
     df = pd.read_csv(path,sep="\t")
+    # Peptide -> protein entries (cached per process, see `load_pep_map`); with the
+    # "sample" scope of a memory budget only this sample's peptides are loaded
+    pep_map = load_pep_map(sqlite_path, sample_peptides(df, pep_map_scope))
+    fasta_index = fasta_index_for(sqlite_path)  # ✅ None when the FASTA moved or changed
+    
     sample = df.columns[-1]
     # QC 1 identified peptides
     # remove nan values, only keep the peptides identified in this sample
@@ -205,17 +377,18 @@ def qc_one_trypsinp(path, output_dir,sqlite_path, enz):
     
     
     peptide_count = df_na['PEP.StrippedSequence'].unique().shape[0]
-    protein_count = df_na['PG.ProteinNames'].unique().shape[0]
-
-    protein_human_count = df_na[df_na['PG.ProteinNames'].str.contains('_HUMAN')]['PG.ProteinNames'].unique().shape[0]
-    protein_mouse_count = df_na[df_na['PG.ProteinNames'].str.contains('_MOUSE')]['PG.ProteinNames'].unique().shape[0]
+    protein_names = df_na['PG.ProteinNames'].unique()
+    protein_count = protein_names.shape[0]
+    # ✅ Species are counted on the unique protein groups, not scanned row by row
+    protein_human_count = sum('_HUMAN' in name for name in protein_names)
+    protein_mouse_count = sum('_MOUSE' in name for name in protein_names)
     
     # remove duplicates
     df_nodup = df_na.drop_duplicates()
     df_nodup = df_nodup.copy()
     
 
-    df_nodup.loc[:,'Missed.Cleavages.Sites'] = df_nodup['PEP.StrippedSequence'].apply(lambda x: check_missed_cleavages_for_trypsin(x, pep_map))
+    df_nodup.loc[:,'Missed.Cleavages.Sites'] = df_nodup['PEP.StrippedSequence'].apply(lambda x: check_missed_cleavages_for_trypsin(x, pep_map, fasta_index))
     df_nodup = df_nodup.copy()
     df_nodup.loc[:,'Missed.Cleavages.Count'] = df_nodup['Missed.Cleavages.Sites'].apply(len)
     
@@ -280,7 +453,14 @@ def qc_one_trypsinp(path, output_dir,sqlite_path, enz):
     MC2_peptide_count = df_nodup_uniq[(df_nodup_uniq['Missed.Cleavages.Count'] == 2) & (df_nodup_uniq["Missed.Cleavages.notP"]==True)].shape[0]
     
     
-    df_mc2 = calc_quant_for_fragment_pep(df_mc, pep_map, pep_quant_map, sample)
+    # ✅ Join the fragment table written by Prepare; databases without one take the row-wise path
+    fragments = fragments_for(sqlite_path, df_mc['PEP.StrippedSequence'])
+    if fragments is None:
+        if pep_map_scope == "sample":
+            pep_map = load_pep_map(sqlite_path)  # ✅ The fragments need the uniqueness of any peptide
+        df_mc2 = calc_quant_for_fragment_pep(df_mc, pep_map, pep_quant_map, sample)
+    else:
+        df_mc2 = join_fragments(df_mc, fragments, pep_quant_map, sample)
     
     
     
@@ -345,33 +525,15 @@ def qc_one_trypsinp(path, output_dir,sqlite_path, enz):
     gc.collect()
 
     print(f"Results have been written to {output_path}")
+    return results
     
-def qc_one(path, output_dir,sqlite_path, enz):
-    
-    # Connect to the SQLite database
-    print(f"Fetch the protein information for each peptide from {sqlite_path}")
-    conn = sqlite3.connect(sqlite_path)
-    cursor = conn.cursor()
-    
-    # peptide_list = list(df_nodup['PEP.StrippedSequence'])
-    # placeholders = ','.join('?' for _ in peptide_list)
-    # query = f"SELECT peptide, protein FROM peptides WHERE peptide IN ({placeholders})"
-    
-    # Execute the query with the peptide list as parameters
-    # cursor.execute(query, peptide_list)
-    
-    cursor.execute("SELECT peptide, protein FROM peptides")
-
-    rows = cursor.fetchall()
-
-    # Convert the results into a dictionary (if each peptide is unique)
-    pep_map = {peptide: protein.split(";") for peptide, protein in tqdm(rows)}
-
-    # Close the connection
-    conn.close()
-    
+def qc_one(path, output_dir,sqlite_path, enz, pep_map_scope="all"):
     
     df = pd.read_csv(path,sep="\t")
+    # Peptide -> protein entries (cached per process, see `load_pep_map`)
+    pep_map = load_pep_map(sqlite_path, sample_peptides(df, pep_map_scope))
+    fasta_index = fasta_index_for(sqlite_path)  # ✅ None when the FASTA moved or changed
+    
     sample = df.columns[-1]
     # QC 1 identified peptides
     # remove nan values, only keep the peptides identified in this sample
@@ -379,17 +541,20 @@ def qc_one(path, output_dir,sqlite_path, enz):
     
     
     peptide_count = df_na['PEP.StrippedSequence'].unique().shape[0]
-    protein_count = df_na['PG.ProteinNames'].unique().shape[0]
-
-    protein_human_count = df_na[df_na['PG.ProteinNames'].str.contains('_HUMAN')]['PG.ProteinNames'].unique().shape[0]
-    protein_mouse_count = df_na[df_na['PG.ProteinNames'].str.contains('_MOUSE')]['PG.ProteinNames'].unique().shape[0]
+    protein_names = df_na['PG.ProteinNames'].unique()
+    protein_count = protein_names.shape[0]
+    # ✅ Species are counted on the unique protein groups, not scanned row by row
+    protein_human_count = sum('_HUMAN' in name for name in protein_names)
+    protein_mouse_count = sum('_MOUSE' in name for name in protein_names)
     
     # remove duplicates
     df_nodup = df_na.drop_duplicates()
     df_nodup = df_nodup.copy()
     
 
-    df_nodup.loc[:,'Missed.Cleavages.Sites'] = df_nodup['PEP.StrippedSequence'].apply(lambda x: check_missed_cleavages(x, target_AAs="KR", pos=-1, omit_AAs="P"))
+    # ✅ Same compiled cleavage rule the peptide database was digested with
+    enzyme = get_enzyme(enz)
+    df_nodup.loc[:,'Missed.Cleavages.Sites'] = df_nodup['PEP.StrippedSequence'].apply(lambda x: check_missed_cleavages_for_enzyme(x, pep_map, enzyme, fasta_index))
     df_nodup = df_nodup.copy()
     df_nodup.loc[:,'Missed.Cleavages.Count'] = df_nodup['Missed.Cleavages.Sites'].apply(len)
     
@@ -434,7 +599,13 @@ def qc_one(path, output_dir,sqlite_path, enz):
     MC2_peptide_count = df_nodup_uniq[df_nodup_uniq['Missed.Cleavages.Count'] == 2].shape[0]
     
     
-    df_mc2 = calc_quant_for_fragment_pep(df_mc, pep_map, pep_quant_map, sample)
+    fragments = fragments_for(sqlite_path, df_mc['PEP.StrippedSequence'])
+    if fragments is None:
+        if pep_map_scope == "sample":
+            pep_map = load_pep_map(sqlite_path)  # ✅ The fragments need the uniqueness of any peptide
+        df_mc2 = calc_quant_for_fragment_pep(df_mc, pep_map, pep_quant_map, sample)
+    else:
+        df_mc2 = join_fragments(df_mc, fragments, pep_quant_map, sample)
     
     
     
@@ -446,6 +617,8 @@ def qc_one(path, output_dir,sqlite_path, enz):
     output_path = os.path.join(output_dir,base_name + "_qc.tsv")
     
     out_mc2_path = os.path.join(output_dir,base_name + "_mc2.tsv")
+    # ✅ Same `pos,aa;...` site format as the trypsin/p output, which compare parses
+    df_mc2['Missed.Cleavages.Sites'] = df_mc2['Missed.Cleavages.Sites'].apply(lambda sites: ";".join(f'{pos},{aa}' for pos, aa in sites))
     df_mc2.to_csv(out_mc2_path,sep="\t",index=False)
     del df_mc2
     gc.collect()
@@ -477,6 +650,7 @@ def qc_one(path, output_dir,sqlite_path, enz):
     gc.collect()
 
     print(f"Results have been written to {output_path}")
+    return results
 
     # peptide_count, protein_count, protein_human_count, protein_mouse_count
     
\ No newline at end of file
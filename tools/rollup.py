@@ -0,0 +1,253 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from tools.budget import memory_budget
+from tools.enzymes import get_enzyme
+from tools.fasta_index import fasta_index_for
+from tools.prepare import peptide_db_path
+from tools.qc import load_pep_map, check_missed_cleavages_for_enzyme
+from tools.split_dia import split_name
+
+
+# Protein-level rollup of the missed cleavage rate, written to `step4-rollup`:
+#   protein_mcr.tsv        protein group x sample, quantity-weighted MCR
+#                          (sum of missed cleavage peptide quantities / sum of all)
+#   protein_mcr_count.tsv  protein group x sample, count-based MCR
+#                          (missed cleavage peptides / identified peptides)
+#   species_mcr.tsv        the same per species tag (`_HUMAN`, `_MOUSE`, ...) and
+#                          sample, with protein and peptide counts
+# Peptides are the deduplicated (protein group, peptide, quantity) rows QC counts,
+# and a missed cleavage peptide is one QC counts in `mc_pep_count`. Empty cells in
+# the matrices are groups not identified in that sample.
+ROLLUP_DIR = "step4-rollup"
+
+HEADERS = ["PG.ProteinNames", "PEP.StrippedSequence"]
+
+SPECIES_PATTERN = re.compile(r"_([A-Za-z0-9]+)$")
+
+# Protein groups turned dense at a time while writing the matrices
+BLOCK_ROWS = 5000
+
+
+class Codes:
+    """Growing string -> integer code vocabulary; new values get the next codes."""
+
+    def __init__(self, dtype=object):
+        self.index = pd.Index([], dtype=dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    def encode(self, values):
+        codes = self.index.get_indexer(values)
+        new = codes < 0
+        if new.any():
+            self.index = self.index.append(pd.Index(pd.unique(values[new])))
+            codes[new] = self.index.get_indexer(values[new])
+        return codes
+
+
+def species_tags(group):
+    """Species tags of a protein group (`P1_HUMAN;P2_MOUSE` -> `["HUMAN", "MOUSE"]`)."""
+    tags = {m.group(1) for name in group.split(";") for m in [SPECIES_PATTERN.search(name)] if m}
+    return sorted(tags)
+
+
+def missed_cleavage_flags(peptides, pep_map, enzyme_name, fasta_index=None):
+    """
+    1 for the peptides QC counts as missed cleavage peptides, else 0. trypsin/p
+    ignores sites before a proline, as in `qc_one_trypsinp`. Flanking residues come
+    from `fasta_index` when given, as in QC.
+    """
+    enzyme = get_enzyme(enzyme_name)
+    not_p = enzyme.name == "trypsin/p"
+    flags = np.zeros(len(peptides), dtype=np.int8)
+    for i, peptide in enumerate(peptides):
+        sites = check_missed_cleavages_for_enzyme(peptide, pep_map, enzyme, fasta_index)
+        flags[i] = any(aa != "P" for _, aa in sites) if not_p else bool(sites)
+    return flags
+
+
+def drop_duplicate_entries(pair, sample, quantity):
+    """Drops repeated `(pair, sample, quantity)` entries (sorted, without hashing rows)."""
+    order = np.lexsort((quantity, sample, pair))
+    pair, sample, quantity = pair[order], sample[order], quantity[order]
+    keep = np.ones(len(pair), dtype=bool)
+    keep[1:] = (pair[1:] != pair[:-1]) | (sample[1:] != sample[:-1]) | (quantity[1:] != quantity[:-1])
+    return pair[keep], sample[keep], quantity[keep]
+
+
+def read_report_codes(param, logs):
+    """
+    Reads the DIA report once (in chunks under `memory_budget`) and encodes every
+    identified row as integer codes.
+    :return: `(samples, groups, peptides, pair_group, pair_peptide, entries)`;
+        `entries` are `(pair, sample, quantity)` arrays with one deduplicated entry
+        per identified peptide row of a sample; pairs index `pair_group`/`pair_peptide`.
+    """
+    path = param['input_file']
+    header = list(pd.read_csv(path, sep="\t", nrows=0).columns)
+    columns = [c for c in header if re.search(r".PEP.Quantity", c)]
+    samples = [split_name(c)[:-len(".split.tsv")] for c in columns]
+
+    chunk_rows = memory_budget(param).csv_chunk_rows(path)
+    if chunk_rows:
+        msg = f"🧮 Report exceeds the memory budget; reading it in chunks of {chunk_rows} rows"
+        logs.append(msg)
+        print(msg)
+    chunks = pd.read_csv(path, sep="\t", usecols=HEADERS + columns, chunksize=chunk_rows)
+    if not chunk_rows:
+        chunks = [chunks]
+
+    groups, peptides, pairs = Codes(), Codes(), Codes(np.int64)
+    fields, row_pairs = ([], [], []), []
+    for chunk in tqdm(chunks, desc="Encoding report"):
+        chunk = chunk.dropna(subset=HEADERS)
+        g = groups.encode(chunk[HEADERS[0]].values)
+        p = peptides.encode(chunk[HEADERS[1]].values)
+        pair = pairs.encode(g.astype(np.int64) << 32 | p).astype(np.int32)
+        row_pairs.append(pair)
+        for j, column in enumerate(columns):
+            quant = chunk[column].to_numpy(dtype=np.float64)
+            found = ~np.isnan(quant)
+            for field, values in zip(fields, (pair[found], np.full(found.sum(), j, dtype=np.int32), quant[found])):
+                field.append(values)
+
+    entries = []
+    for field, dtype in zip(fields, (np.int32, np.int32, np.float64)):
+        entries.append(np.concatenate(field) if field else np.array([], dtype=dtype))
+        field.clear()  # ✅ Keep at most one field twice in memory
+    # ✅ As QC's `drop_duplicates` of each sample's rows; only pairs on several report rows can repeat
+    repeated = np.bincount(np.concatenate(row_pairs), minlength=len(pairs))[entries[0]] > 1 if row_pairs else None
+    if repeated is not None and repeated.any():
+        unique = drop_duplicate_entries(*(a[repeated] for a in entries))
+        entries = [np.concatenate([a[~repeated], u]) for a, u in zip(entries, unique)]
+    keys = pairs.index.values.astype(np.int64)
+    return samples, groups.index, peptides.index, keys >> 32, keys & 0xFFFFFFFF, tuple(entries)
+
+
+def mcr_tables(totals):
+    """
+    Quantity-weighted and count-based MCR from rows of `[Q | MQ | I | MI]` sums;
+    NaN where no peptide was identified.
+    """
+    sum_quant, sum_mc_quant, pep_count, mc_count = np.split(totals, 4, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mcr_quant = np.where(pep_count > 0, sum_mc_quant / sum_quant, np.nan)
+        mcr_count = np.where(pep_count > 0, mc_count / pep_count, np.nan)
+    return mcr_quant, mcr_count
+
+
+def rollup_all(param):
+    """
+    Rolls the missed cleavage rate of all samples up to protein groups and species.
+    Peptides and protein groups become integer codes, and every sum (quantities and
+    peptide counts, all and missed cleavage only, per group and per species) comes
+    out of one sparse product `[G; GM] @ [Q | I]` over all samples: `G` maps
+    peptide/group pairs to their group, `M` masks the missed cleavage peptides, and
+    `Q`/`I` hold the quantities and identified rows of every pair and sample. Species
+    sum the groups tagged with them, so the cost grows with the identified rows, not
+    with groups times samples.
+    :param param: Dictionary of parameters loaded from YAML.
+    :return: List of logs/messages for Streamlit UI.
+    """
+    from scipy import sparse  # ✅ Only the Rollup stage needs scipy
+
+    logs = []
+    output_dir = os.path.join(param['output_dir'], ROLLUP_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+
+    sqlite_path = peptide_db_path(param)
+    for path, name in ((param['input_file'], "DIA report"), (sqlite_path, "peptides.sqlite")):
+        if not os.path.exists(path):
+            error_msg = f"❌ Error: Missing {name} at {path}"
+            logs.append(error_msg)
+            print(error_msg)
+            return logs
+
+    samples, groups, peptides, pair_group, pair_peptide, entries = read_report_codes(param, logs)
+    if not len(entries[0]):
+        warning_msg = "⚠ No identified peptides found! Skipping rollup."
+        logs.append(warning_msg)
+        print(warning_msg)
+        return logs
+    n_pairs, n_samples = len(pair_group), len(samples)
+    msg = f"🧬 Rolling up {len(entries[0])} peptide rows: {len(groups)} protein groups, {len(peptides)} peptides, {n_samples} samples"
+    logs.append(msg)
+    print(msg)
+
+    # ✅ Missed cleavage status once per peptide, not once per sample
+    pep_map = load_pep_map(sqlite_path, peptides)
+    is_mc = missed_cleavage_flags(peptides, pep_map, param['enzyme'], fasta_index_for(sqlite_path))[pair_peptide]
+
+    # pairs x samples: quantities (duplicate pairs add up) and identified rows
+    pair, sample, quantity = entries
+    del entries
+    values = sparse.csr_matrix((np.concatenate([quantity, np.ones(len(quantity))]),
+                                (np.concatenate([pair, pair]), np.concatenate([sample, sample + n_samples]))),
+                               shape=(n_pairs, 2 * n_samples))
+    del pair, sample, quantity
+
+    # [all; missed cleavage] groups x pairs: each pair belongs to one group
+    n_groups = len(groups)
+    to_group = sparse.csr_matrix((np.ones(n_pairs), (pair_group, np.arange(n_pairs))), shape=(n_groups, n_pairs))
+    left = sparse.vstack([to_group, to_group @ sparse.diags(is_mc.astype(np.float64))], format="csr")
+    # species x groups: a group counts for each of its species tags
+    tags = [species_tags(g) for g in groups]
+    species = sorted({t for group_tags in tags for t in group_tags})
+    species_code = {t: i for i, t in enumerate(species)}
+    tag_rows = [species_code[t] for group_tags in tags for t in group_tags]
+    tag_cols = [i for i, group_tags in enumerate(tags) for _ in group_tags]
+    to_species = sparse.csr_matrix((np.ones(len(tag_rows)), (tag_rows, tag_cols)), shape=(len(species), n_groups))
+
+    # ✅ The one aggregation over all samples; reordered into [Q | MQ | I | MI] per group
+    totals = left @ values
+    all_, mc = totals[:n_groups], totals[n_groups:]
+    group_totals = sparse.hstack([all_[:, :n_samples], mc[:, :n_samples],
+                                  all_[:, n_samples:], mc[:, n_samples:]], format="csr")
+    del left, values, totals, all_, mc
+    species_totals = (to_species @ group_totals).toarray()
+
+    # ✅ Matrices are written a block of protein groups at a time, never fully dense
+    order = np.argsort(groups.values.astype(str), kind="stable")
+    group_totals = group_totals[order]
+    group_names = groups.values[order]
+    group_species = np.array([";".join(t) if t else "NA" for t in tags], dtype=object)[order]
+    paths = [os.path.join(output_dir, f) for f in ("protein_mcr.tsv", "protein_mcr_count.tsv")]
+    for start in range(0, n_groups, BLOCK_ROWS):
+        block = slice(start, start + BLOCK_ROWS)
+        for path, mcr in zip(paths, mcr_tables(group_totals[block].toarray())):
+            matrix = pd.DataFrame(mcr, columns=samples)
+            matrix.insert(0, "Species", group_species[block])
+            matrix.insert(0, "PG.ProteinNames", group_names[block])
+            matrix.to_csv(path, sep="\t", index=False, float_format="%.6g", mode="w" if start == 0 else "a",
+                          header=start == 0)
+    for path in paths:
+        logs.append(f"✔ {n_groups} protein groups x {n_samples} samples saved to {path}")
+
+    # ✅ Identified groups per species and sample, with the same species product
+    sum_quant, sum_mc_quant, pep_count, mc_count = np.split(species_totals, 4, axis=1)
+    mcr_quant, mcr_count = mcr_tables(species_totals)
+    identified = (group_totals[:, 2 * n_samples:3 * n_samples] > 0).astype(np.float64)
+    protein_count = (to_species[:, order] @ identified).toarray()
+    species_df = pd.DataFrame({
+        "Species": np.repeat(species, n_samples),
+        "sample_name": np.tile(samples, len(species)),
+        "protein_count": protein_count.ravel().astype(np.int64),
+        "peptide_count": pep_count.ravel().astype(np.int64),
+        "mc_pep_count": mc_count.ravel().astype(np.int64),
+        "mcr_pep": mcr_count.ravel(),
+        "sum_pep_quant": sum_quant.ravel(),
+        "sum_mc_pep_quant": sum_mc_quant.ravel(),
+        "mcr_pep_quant": mcr_quant.ravel(),
+    })
+    out_path = os.path.join(output_dir, "species_mcr.tsv")
+    species_df.to_csv(out_path, sep="\t", index=False)
+    logs.append(f"✔ {len(species)} species x {n_samples} samples saved to {out_path}")
+
+    logs.append(f"✅ Rollup completed. Output stored in `{output_dir}`")
+    print(f"✅ Rollup completed. Output stored in `{output_dir}`")
+    return logs
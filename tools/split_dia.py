@@ -2,10 +2,37 @@ import os
 import re
 import pandas as pd
 
-def split_dia(param):
+from tools.budget import memory_budget
+
+
+def split_name(sample):
+    """Split file name of a `<n> <name>.PEP.Quantity` sample column."""
+    return f"{sample.split('.')[0].split(' ')[1]}.split.tsv"
+
+
+def split_in_chunks(path, output_dir, headers, samples, chunk_rows):
+    """
+    Out-of-core split: reads only the needed columns of the DIA report,
+    `chunk_rows` rows at a time, and appends each chunk to every sample's file.
+    :return: Paths of the split files, in sample order.
+    """
+    paths = [os.path.join(output_dir, split_name(sample)) for sample in samples]
+    for output_path in paths:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    for chunk in pd.read_csv(path, sep="\t", usecols=headers + samples, chunksize=chunk_rows):
+        for sample, output_path in zip(samples, paths):
+            chunk.loc[:, headers + [sample]].to_csv(output_path, mode="a", header=not os.path.exists(output_path),
+                                                  index=False, sep="\t")
+    return paths
+
+
+def split_dia(param, on_file=None):
     """
     Function to split DIA search results into separate sample files.
     :param param: Dictionary of parameters loaded from YAML.
+    :param on_file: Optional callback called with the path of each split file as
+        soon as it is written (used to start QC on it right away).
     :return: List of logs/messages for Streamlit UI.
     """
 
@@ -19,9 +46,10 @@ def split_dia(param):
         print(error_msg)
         return logs
 
-    # ✅ Read DIA results
+    # ✅ Read DIA results (only the header if the report exceeds its share of `memory_budget`)
+    chunk_rows = memory_budget(param).csv_chunk_rows(path)
     try:
-        data = pd.read_csv(path, sep="\t")
+        data = pd.read_csv(path, sep="\t", nrows=0 if chunk_rows else None)
     except Exception as e:
         error_msg = f"❌ Error reading input file: {e}"
         logs.append(error_msg)
@@ -46,20 +74,40 @@ def split_dia(param):
     headers = ["PG.ProteinNames", "PEP.StrippedSequence"]
     num_files = 0
 
-    for sample in samples:
+    if chunk_rows:
+        msg = f"🧮 Report exceeds the memory budget; splitting in chunks of {chunk_rows} rows"
+        logs.append(msg)
+        print(msg)
         try:
-            df = data.loc[:, headers + [sample]]
-            base_name = sample.split(".")[0].split(" ")[1]
-            output_path = os.path.join(output_dir, f"{base_name}.split.tsv")
-            df.to_csv(output_path, index=False, sep="\t")
+            paths = split_in_chunks(path, output_dir, headers, samples, chunk_rows)
+        except Exception as e:
+            error_msg = f"❌ Error splitting input file: {e}"
+            logs.append(error_msg)
+            print(error_msg)
+            return logs
+        for sample, output_path in zip(samples, paths):
             success_msg = f"✔ {sample} was saved to {output_path}"
             logs.append(success_msg)
             print(success_msg)
             num_files += 1
-        except Exception as e:
-            error_msg = f"❌ Error processing {sample}: {e}"
-            logs.append(error_msg)
-            print(error_msg)
+            if on_file:
+                on_file(output_path)
+    else:
+        for sample in samples:
+            try:
+                df = data.loc[:, headers + [sample]]
+                output_path = os.path.join(output_dir, split_name(sample))
+                df.to_csv(output_path, index=False, sep="\t")
+                success_msg = f"✔ {sample} was saved to {output_path}"
+                logs.append(success_msg)
+                print(success_msg)
+                num_files += 1
+                if on_file:
+                    on_file(output_path)
+            except Exception as e:
+                error_msg = f"❌ Error processing {sample}: {e}"
+                logs.append(error_msg)
+                print(error_msg)
 
     if num_files == 0:
         logs.append("⚠ No split files were created! Exiting...")
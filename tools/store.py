@@ -0,0 +1,262 @@
+import hashlib
+import os
+import sqlite3
+
+import pandas as pd
+
+
+# Persistent per-study aggregate of everything `step2-qc` produces. Each sample is
+# keyed by name together with the content hash of the file it was loaded from, so
+# re-running compare/merge only parses the `_mc2.tsv` / `_qc.tsv` files that are new
+# or changed and updates their rows in place. The compare outputs themselves are
+# still rebuilt from all stored samples on every run.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    sample TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    PRIMARY KEY (sample, kind)
+);
+CREATE TABLE IF NOT EXISTS mc_long (
+    sample TEXT NOT NULL,
+    condition TEXT,
+    mc_pep TEXT,
+    mc_pep_quant REAL,
+    nmc_pep_quant REAL,
+    mcr REAL,
+    mc_count INTEGER,
+    pre_aa TEXT,
+    post_aa TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_mc_long_sample ON mc_long (sample);
+DROP TABLE IF EXISTS aa_counts;
+CREATE TABLE IF NOT EXISTS merged_qc (
+    sample_name TEXT PRIMARY KEY
+);
+"""
+
+# mc_long column -> long table column used by compare
+LONG_COLUMNS = {
+    "condition": "Condition",
+    "mc_pep": "MC_PEP",
+    "mc_pep_quant": "MC_PEP_Quant",
+    "nmc_pep_quant": "NMC_PEP_Quant",
+    "mcr": "MCR",
+    "mc_count": "MC_Count",
+    "pre_aa": "PRE_AA",
+    "post_aa": "POST_AA",
+}
+
+
+def results_db_path(param):
+    return param.get('results_db') or os.path.join(param['output_dir'], "results.sqlite")
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def open_store(param):
+    """Opens (and creates if needed) the study results database."""
+    db_path = results_db_path(param)
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def is_current(conn, sample, kind, digest):
+    row = conn.execute("SELECT file_hash FROM samples WHERE sample = ? AND kind = ?;", (sample, kind)).fetchone()
+    return row is not None and row[0] == digest
+
+
+def _mark(conn, sample, kind, digest):
+    conn.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?);", (sample, kind, digest))
+
+
+def replace_sample_mc(conn, sample, digest, long_df):
+    """
+    Replaces one sample's rows in `mc_long`.
+    :param long_df: Per-sample long table (see `compare.sample_long_table`).
+    """
+    db_df = long_df.rename(columns={v: k for k, v in LONG_COLUMNS.items()})[list(LONG_COLUMNS)]
+    db_df.insert(0, "sample", sample)
+
+    with conn:
+        conn.execute("DELETE FROM mc_long WHERE sample = ?;", (sample,))
+        db_df.to_sql("mc_long", conn, if_exists="append", index=False)
+        _mark(conn, sample, "mc2", digest)
+
+
+def replace_sample_qc(conn, sample, digest, qc_df):
+    """
+    Upserts one sample's QC row into `merged_qc`, adding any column not seen before
+    so samples from `qc_one` and `qc_one_trypsinp` share one table.
+    """
+    known = {r[1] for r in conn.execute("PRAGMA table_info(merged_qc);")}
+    with conn:
+        for col in qc_df.columns:
+            if col not in known:
+                conn.execute(f'ALTER TABLE merged_qc ADD COLUMN "{col}";')
+        cols = ", ".join(f'"{c}"' for c in qc_df.columns)
+        marks = ", ".join("?" for _ in qc_df.columns)
+        conn.executemany(f"INSERT OR REPLACE INTO merged_qc ({cols}) VALUES ({marks});",
+                         qc_df.astype(object).where(qc_df.notna(), None).values.tolist())
+        _mark(conn, sample, "qc", digest)
+
+
+def drop_missing_samples(conn, kind, samples):
+    """
+    Deletes the stored rows of every `kind` ("mc2" or "qc") sample not in `samples`
+    (its file was deleted or renamed in `step2-qc`).
+    :return: Names of the dropped samples.
+    """
+    stored = {r[0] for r in conn.execute("SELECT sample FROM samples WHERE kind = ?;", (kind,))}
+    if kind == "mc2":
+        stored |= {r[0] for r in conn.execute("SELECT DISTINCT sample FROM mc_long;")}
+    else:
+        stored |= {r[0] for r in conn.execute("SELECT sample_name FROM merged_qc;")}
+    dropped = sorted(stored - set(samples))
+    with conn:
+        for sample in dropped:
+            if kind == "mc2":
+                conn.execute("DELETE FROM mc_long WHERE sample = ?;", (sample,))
+            else:
+                conn.execute("DELETE FROM merged_qc WHERE sample_name = ?;", (sample,))
+            conn.execute("DELETE FROM samples WHERE sample = ? AND kind = ?;", (sample, kind))
+    return dropped
+
+
+def iter_long_tables(conn):
+    """Yields the long table one sample at a time, in the order samples were added."""
+    samples = [r[0] for r in conn.execute("SELECT sample FROM mc_long GROUP BY sample ORDER BY MIN(rowid);")]
+    query = "SELECT " + ", ".join(f"{k} AS {v}" for k, v in LONG_COLUMNS.items()) + \
+            " FROM mc_long WHERE sample = ? ORDER BY rowid;"
+    for sample in samples:
+        long_df = pd.read_sql_query(query, conn, params=(sample,))
+        long_df.insert(2, 'NMC_PEP', "NA")
+        yield long_df
+
+
+def read_merged_qc(conn):
+    return pd.read_sql_query("SELECT * FROM merged_qc ORDER BY rowid;", conn)
+
+
+# Consolidated compare output (`step3-compare/compare.sqlite`): one long table with
+# indexes on condition and peptide. The filtered variants that used to be written
+# as separate CSV copies are views, and the wide matrices are pivoted on demand.
+COMPARE_DB = "compare.sqlite"
+
+COMPARE_VIEWS = {
+    "rdf": "SELECT Condition, MC_PEP, 'NA' AS NMC_PEP, MC_PEP_Quant, NMC_PEP_Quant, MCR, "
+           "Log2MC_PEP_Quant, Log2NMC_PEP_Quant FROM mcr_long ORDER BY rowid",
+    "rdf2": "SELECT Condition, MC_PEP, 'NA' AS NMC_PEP, MC_PEP_Quant, NMC_PEP_Quant, MCR, "
+            "Log2MC_PEP_Quant, Log2NMC_PEP_Quant FROM mcr_long "
+            "WHERE Log2MC_PEP_Quant IS NOT NULL AND Log2NMC_PEP_Quant IS NOT NULL ORDER BY rowid",
+    "new_rdf": "SELECT Condition, MC_PEP, 'NA' AS NMC_PEP, MC_PEP_Quant, NMC_PEP_Quant, MCR, PRE_AA, POST_AA "
+               "FROM mcr_long WHERE MC_Count = 1 ORDER BY rowid",
+    "new_rdf2": "SELECT Condition, MC_PEP, 'NA' AS NMC_PEP, MC_PEP_Quant, NMC_PEP_Quant, MCR, PRE_AA, POST_AA "
+                "FROM mcr_long WHERE MC_Count = 1 AND POST_AA != 'P' ORDER BY rowid",
+}
+
+# Pre-binned MCR counts per condition (0.1 % MCR bins, split by whether both
+# quantities are present), built once when compare finishes so distribution plots
+# and quantiles never have to scan `mcr_long`.
+MCR_BIN_WIDTH = 0.1
+MCR_BINS = 1000
+
+MCR_BINS_QUERY = (
+    "SELECT Condition, MIN(CAST(MCR / {width} AS INTEGER), {last}) AS Bin, "
+    "(Log2MC_PEP_Quant IS NOT NULL AND Log2NMC_PEP_Quant IS NOT NULL) AS Quantified, "
+    "COUNT(*) AS Count, SUM(MCR) AS Total FROM mcr_long GROUP BY Condition, Bin, Quantified"
+).format(width=MCR_BIN_WIDTH, last=MCR_BINS - 1)
+
+# compare tables that can still be exported as the legacy per-variant CSV files
+LEGACY_TABLES = ["rdf", "rdf2", "wide_df", "wdf", "new_rdf", "new_rdf2"]
+
+
+def compare_db_path(step3_dir):
+    return os.path.join(step3_dir, COMPARE_DB)
+
+
+def create_compare_db(step3_dir):
+    """
+    Creates an empty compare database, replacing any previous one. It is in WAL mode
+    until `close_compare_db`, so figure workers can read finished tables while the
+    indexes and bins are still being written.
+    """
+    db_path = compare_db_path(step3_dir)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("""
+        CREATE TABLE mcr_long (
+            Condition TEXT, MC_PEP TEXT, MC_PEP_Quant REAL, NMC_PEP_Quant REAL, MCR REAL,
+            Log2MC_PEP_Quant REAL, Log2NMC_PEP_Quant REAL, MC_Count INTEGER, PRE_AA TEXT, POST_AA TEXT
+        );""")
+    return conn
+
+
+def define_compare_views(conn):
+    """Defines the filtered views once all rows of the long table are in."""
+    with conn:
+        for name, query in COMPARE_VIEWS.items():
+            conn.execute(f"CREATE VIEW {name} AS {query};")
+
+
+def finish_compare_db(conn):
+    """Indexes the long table and bins MCR."""
+    with conn:
+        conn.execute("CREATE INDEX idx_mcr_long_condition ON mcr_long (Condition);")
+        conn.execute("CREATE INDEX idx_mcr_long_peptide ON mcr_long (MC_PEP);")
+        conn.execute(f"CREATE TABLE mcr_bins AS {MCR_BINS_QUERY};")
+        conn.execute("CREATE INDEX idx_mcr_bins_condition ON mcr_bins (Condition);")
+
+
+def close_compare_db(conn):
+    """Back to a single-file database (no `-wal`/`-shm`) once no figure worker reads it."""
+    try:
+        conn.execute("PRAGMA journal_mode=DELETE;")
+    finally:
+        conn.close()
+
+
+def read_compare_table(step3_dir, name, columns=None):
+    """
+    Reads a compare table from the compare database with the same layout as its
+    legacy CSV. `wide_df` and `wdf` are pivoted from `rdf2` on demand.
+    """
+    conn = sqlite3.connect(compare_db_path(step3_dir))
+    try:
+        if name in ("wide_df", "wdf"):
+            rdf2 = pd.read_sql_query("SELECT MC_PEP, Condition, MCR FROM rdf2;", conn)
+            wide_df = rdf2.pivot(index='MC_PEP', columns='Condition', values='MCR').reset_index()
+            table = wide_df if name == "wide_df" else wide_df.dropna()
+        else:
+            cols = ", ".join(columns) if columns else "*"
+            table = pd.read_sql_query(f"SELECT {cols} FROM {name};", conn)
+    finally:
+        conn.close()
+    return table
+
+
+def export_compare_table(step3_dir, name, path=None):
+    """Exports one compare table as its legacy CSV (default: `step3-compare/<name>.csv`)."""
+    path = path or os.path.join(step3_dir, name + ".csv")
+    table = read_compare_table(step3_dir, name)
+    if name == "wdf":
+        table.set_index('MC_PEP').to_csv(path)
+    else:
+        table.to_csv(path, index=False)
+    return path
+
+
+def export_legacy_csv(step3_dir):
+    """Exports every legacy compare CSV from the compare database."""
+    return [export_compare_table(step3_dir, name) for name in LEGACY_TABLES]
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import ExitStack
+
+from filelock import FileLock
+
+from tools.fasta_index import index_path
+from tools.prepare import digest_enzymes, digest_key, run_enzymes
+
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+
+class UploadStore:
+    """
+    Content-addressed file store shared by every session of the server. Uploaded
+    files are stored once per content hash (`blobs/<sha256><ext>`) and digested
+    peptide databases once per `digest_key` (`peptides/<key>.sqlite`), so the same
+    FASTA uploaded by several people is written and digested only once.
+
+    When the store grows past `max_bytes`, the least recently used entries are
+    deleted, except those used in the last `min_age` seconds (a running job may
+    still be reading them).
+    """
+
+    def __init__(self, root, max_bytes=None, min_age=6 * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.blob_dir = os.path.join(root, "blobs")
+        self.peptide_dir = os.path.join(root, "peptides")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.peptide_dir, exist_ok=True)
+        self.lock = FileLock(os.path.join(root, "index.lock"))
+        with self._index() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    def _index(self):
+        return sqlite3.connect(os.path.join(self.root, "index.sqlite"), timeout=60)
+
+    def _record(self, path, kind):
+        with self._index() as conn:
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?);",
+                         (path, kind, os.path.getsize(path), time.time()))
+
+    def put(self, fileobj, name, chunk_size=1 << 20):
+        """
+        Stores an uploaded file (any binary file object) unless the same content is
+        already stored.
+        :return: Path of the stored file.
+        """
+        h = hashlib.sha256()
+        fileobj.seek(0)
+        for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+            h.update(chunk)
+        path = os.path.join(self.blob_dir, h.hexdigest() + os.path.splitext(name)[1].lower())
+
+        with self.lock:
+            if not os.path.exists(path):
+                fileobj.seek(0)
+                with tempfile.NamedTemporaryFile(dir=self.blob_dir, delete=False) as tmp:
+                    shutil.copyfileobj(fileobj, tmp, chunk_size)
+                os.replace(tmp.name, path)  # ✅ Readers never see a half-written file
+            self._record(path, "upload")
+        self.evict()
+        return path
+
+    def peptide_db(self, param):
+        """
+        Path of the digested peptide database for the FASTA and digestion parameters
+        in `param`, digesting it first if no session has done so yet. The extra
+        `enzymes` are stored (and digested in the same pass) under their own keys.
+        """
+        paths = {enzyme: os.path.join(self.peptide_dir, digest_key({**param, 'enzyme': enzyme}) + ".sqlite")
+                 for enzyme in run_enzymes(param)}
+        with ExitStack() as stack:
+            for path in sorted(paths.values()):  # ✅ Two sessions never digest the same FASTA at once
+                stack.enter_context(FileLock(path + ".lock"))
+            missing = {enzyme: path for enzyme, path in paths.items() if not os.path.exists(path)}
+            for path in paths.values():
+                if path not in missing.values():
+                    print(f"♻ Reusing peptide database {path}")
+            if missing:
+                digest_enzymes(param, {enzyme: path + ".partial" for enzyme, path in missing.items()})
+                for path in missing.values():
+                    os.replace(path + ".partial", path)
+            with self.lock:
+                for path in paths.values():
+                    self._record(path, "peptides")
+        self.evict()
+        return paths[param['enzyme']]
+
+    def evict(self):
+        """Deletes least recently used entries until the store fits in `max_bytes`."""
+        if self.max_bytes is None:
+            return []
+        removed = []
+        with self.lock, self._index() as conn:
+            entries = conn.execute("SELECT path, size, last_used FROM entries ORDER BY last_used;").fetchall()
+            total = sum(size for _, size, _ in entries)
+            for path, size, last_used in entries:
+                if total <= self.max_bytes:
+                    break
+                if time.time() - last_used < self.min_age:
+                    continue
+                for stale in (path, index_path(path)):  # ✅ A FASTA blob takes its offset index along
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                conn.execute("DELETE FROM entries WHERE path = ?;", (path,))
+                total -= size
+                removed.append(path)
+        if removed:
+            print(f"🧹 Evicted {len(removed)} least recently used files from {self.root}")
+        return removed